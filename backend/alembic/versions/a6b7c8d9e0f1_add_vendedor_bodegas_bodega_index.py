@@ -0,0 +1,31 @@
+"""add vendedor_bodegas bodega lookup index
+
+Revision ID: a6b7c8d9e0f1
+Revises: f5a6b7c8d9e0
+Create Date: 2026-10-16 17:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "a6b7c8d9e0f1"
+down_revision: Union[str, Sequence[str], None] = "f5a6b7c8d9e0"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_vendedor_bodegas_bodega_vendedor",
+        "vendedor_bodegas",
+        ["bodega_id", "vendedor_id"],
+        unique=False,
+        if_not_exists=True,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_vendedor_bodegas_bodega_vendedor", table_name="vendedor_bodegas", if_exists=True)
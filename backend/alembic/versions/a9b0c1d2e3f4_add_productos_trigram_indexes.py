@@ -0,0 +1,44 @@
+"""add productos cod_producto/descripcion trigram indexes
+
+Revision ID: a9b0c1d2e3f4
+Revises: f8a9b0c1d2e3
+Create Date: 2026-10-16 11:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "a9b0c1d2e3f4"
+down_revision: Union[str, Sequence[str], None] = "f8a9b0c1d2e3"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.create_index(
+        "ix_productos_cod_producto_trgm",
+        "productos",
+        ["cod_producto"],
+        unique=False,
+        postgresql_using="gin",
+        postgresql_ops={"cod_producto": "gin_trgm_ops"},
+        if_not_exists=True,
+    )
+    op.create_index(
+        "ix_productos_descripcion_trgm",
+        "productos",
+        ["descripcion"],
+        unique=False,
+        postgresql_using="gin",
+        postgresql_ops={"descripcion": "gin_trgm_ops"},
+        if_not_exists=True,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_productos_descripcion_trgm", table_name="productos", if_exists=True)
+    op.drop_index("ix_productos_cod_producto_trgm", table_name="productos", if_exists=True)
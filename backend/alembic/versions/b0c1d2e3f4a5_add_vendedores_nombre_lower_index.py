@@ -0,0 +1,32 @@
+"""add vendedores lower(nombre) index
+
+Revision ID: b0c1d2e3f4a5
+Revises: a9b0c1d2e3f4
+Create Date: 2026-10-16 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "b0c1d2e3f4a5"
+down_revision: Union[str, Sequence[str], None] = "a9b0c1d2e3f4"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_vendedores_nombre_lower",
+        "vendedores",
+        [sa.text("lower(nombre)")],
+        unique=False,
+        if_not_exists=True,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_vendedores_nombre_lower", table_name="vendedores", if_exists=True)
@@ -0,0 +1,44 @@
+"""add inventory_import_jobs active token unique index
+
+Revision ID: b7c8d9e0f1a2
+Revises: a6b7c8d9e0f1
+Create Date: 2026-10-16 18:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "b7c8d9e0f1a2"
+down_revision: Union[str, Sequence[str], None] = "a6b7c8d9e0f1"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute(
+        """
+        UPDATE inventory_import_jobs j
+        SET estado = 'ERROR', mensaje = 'Importacion interrumpida'
+        WHERE j.estado IN ('PENDIENTE', 'PROCESANDO')
+          AND EXISTS (
+              SELECT 1 FROM inventory_import_jobs o
+              WHERE o.token = j.token AND o.id > j.id AND o.estado IN ('PENDIENTE', 'PROCESANDO')
+          )
+        """
+    )
+    op.create_index(
+        "ix_inventory_import_jobs_token_active",
+        "inventory_import_jobs",
+        ["token"],
+        unique=True,
+        postgresql_where=sa.text("estado IN ('PENDIENTE', 'PROCESANDO')"),
+        if_not_exists=True,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_inventory_import_jobs_token_active", table_name="inventory_import_jobs", if_exists=True)
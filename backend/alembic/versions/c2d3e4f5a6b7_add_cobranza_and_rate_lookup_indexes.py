@@ -0,0 +1,39 @@
+"""add cobranza abonos and exchange rate lookup indexes
+
+Revision ID: c2d3e4f5a6b7
+Revises: b0c1d2e3f4a5
+Create Date: 2026-10-16 13:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "c2d3e4f5a6b7"
+down_revision: Union[str, Sequence[str], None] = "b0c1d2e3f4a5"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_cobranza_abonos_bodega_secuencia",
+        "cobranza_abonos",
+        ["bodega_id", "secuencia"],
+        unique=False,
+        if_not_exists=True,
+    )
+    op.create_index(
+        "ix_exchange_rates_effective_date",
+        "exchange_rates",
+        ["effective_date"],
+        unique=False,
+        if_not_exists=True,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_exchange_rates_effective_date", table_name="exchange_rates", if_exists=True)
+    op.drop_index("ix_cobranza_abonos_bodega_secuencia", table_name="cobranza_abonos", if_exists=True)
@@ -0,0 +1,49 @@
+"""add total_abonado_usd/cs to ventas_facturas
+
+Revision ID: d3e4f5a6b7c8
+Revises: c2d3e4f5a6b7
+Create Date: 2026-10-16 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "d3e4f5a6b7c8"
+down_revision: Union[str, Sequence[str], None] = "c2d3e4f5a6b7"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "ventas_facturas",
+        sa.Column("total_abonado_usd", sa.Numeric(14, 2), nullable=True, server_default="0"),
+    )
+    op.add_column(
+        "ventas_facturas",
+        sa.Column("total_abonado_cs", sa.Numeric(14, 2), nullable=True, server_default="0"),
+    )
+    op.execute(
+        """
+        UPDATE ventas_facturas f
+        SET total_abonado_usd = t.total_usd, total_abonado_cs = t.total_cs
+        FROM (
+            SELECT
+                factura_id,
+                COALESCE(SUM(CASE WHEN UPPER(TRIM(tipo_mov)) = 'NOTA_DEBITO' THEN -monto_usd ELSE monto_usd END), 0) AS total_usd,
+                COALESCE(SUM(CASE WHEN UPPER(TRIM(tipo_mov)) = 'NOTA_DEBITO' THEN -monto_cs ELSE monto_cs END), 0) AS total_cs
+            FROM cobranza_abonos
+            GROUP BY factura_id
+        ) t
+        WHERE t.factura_id = f.id
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("ventas_facturas", "total_abonado_cs")
+    op.drop_column("ventas_facturas", "total_abonado_usd")
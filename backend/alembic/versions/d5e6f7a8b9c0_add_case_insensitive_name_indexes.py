@@ -0,0 +1,38 @@
+"""add case-insensitive name indexes
+
+Revision ID: d5e6f7a8b9c0
+Revises: c3d4e5f6a7b8
+Create Date: 2026-10-16 09:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "d5e6f7a8b9c0"
+down_revision: Union[str, Sequence[str], None] = "c3d4e5f6a7b8"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+_INDEXES = (
+    ("ix_lineas_linea_lower", "lineas", "linea"),
+    ("ix_lineas_cod_linea_lower", "lineas", "cod_linea"),
+    ("ix_segmentos_segmento_lower", "segmentos", "segmento"),
+    ("ix_marcas_nombre_lower", "marcas", "nombre"),
+    ("ix_proveedores_nombre_lower", "proveedores", "nombre"),
+    ("ix_clientes_nombre_lower", "clientes", "nombre"),
+)
+
+
+def upgrade() -> None:
+    for name, table, column in _INDEXES:
+        op.create_index(name, table, [sa.text(f"lower({column})")], unique=False, if_not_exists=True)
+
+
+def downgrade() -> None:
+    for name, table, _column in reversed(_INDEXES):
+        op.drop_index(name, table_name=table, if_exists=True)
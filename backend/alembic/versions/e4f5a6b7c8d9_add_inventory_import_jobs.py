@@ -0,0 +1,41 @@
+"""add inventory_import_jobs
+
+Revision ID: e4f5a6b7c8d9
+Revises: d3e4f5a6b7c8
+Create Date: 2026-10-16 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "e4f5a6b7c8d9"
+down_revision: Union[str, Sequence[str], None] = "d3e4f5a6b7c8"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "inventory_import_jobs",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("token", sa.String(length=64), nullable=False),
+        sa.Column("filename", sa.String(length=255), nullable=True),
+        sa.Column("estado", sa.String(length=20), nullable=False, server_default="PENDIENTE"),
+        sa.Column("mensaje", sa.String(length=300), nullable=True),
+        sa.Column("usuario_registro", sa.String(length=120), nullable=True),
+        sa.Column("created_at", sa.DateTime(), server_default=sa.text("now()"), nullable=True),
+        sa.Column("finished_at", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(op.f("ix_inventory_import_jobs_id"), "inventory_import_jobs", ["id"], unique=False)
+    op.create_index(op.f("ix_inventory_import_jobs_token"), "inventory_import_jobs", ["token"], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_inventory_import_jobs_token"), table_name="inventory_import_jobs")
+    op.drop_index(op.f("ix_inventory_import_jobs_id"), table_name="inventory_import_jobs")
+    op.drop_table("inventory_import_jobs")
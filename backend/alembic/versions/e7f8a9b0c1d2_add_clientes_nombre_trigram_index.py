@@ -0,0 +1,34 @@
+"""add clientes nombre trigram index
+
+Revision ID: e7f8a9b0c1d2
+Revises: d5e6f7a8b9c0
+Create Date: 2026-10-16 09:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "e7f8a9b0c1d2"
+down_revision: Union[str, Sequence[str], None] = "d5e6f7a8b9c0"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.create_index(
+        "ix_clientes_nombre_trgm",
+        "clientes",
+        ["nombre"],
+        unique=False,
+        postgresql_using="gin",
+        postgresql_ops={"nombre": "gin_trgm_ops"},
+        if_not_exists=True,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_clientes_nombre_trgm", table_name="clientes", if_exists=True)
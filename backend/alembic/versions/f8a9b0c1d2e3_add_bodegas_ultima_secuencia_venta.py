@@ -0,0 +1,38 @@
+"""add ultima_secuencia_venta to bodegas
+
+Revision ID: f8a9b0c1d2e3
+Revises: e7f8a9b0c1d2
+Create Date: 2026-10-16 11:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "f8a9b0c1d2e3"
+down_revision: Union[str, Sequence[str], None] = "e7f8a9b0c1d2"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("bodegas", sa.Column("ultima_secuencia_venta", sa.Integer(), nullable=True))
+    op.execute(
+        """
+        UPDATE bodegas b
+        SET ultima_secuencia_venta = s.max_seq
+        FROM (
+            SELECT bodega_id, MAX(secuencia) AS max_seq
+            FROM ventas_facturas
+            GROUP BY bodega_id
+        ) s
+        WHERE s.bodega_id = b.id
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("bodegas", "ultima_secuencia_venta")
@@ -35,7 +35,7 @@ def get_current_user(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Token invalido"
         )
 
-    user = db.query(User).filter(User.email == email).first()
+    user = db.query(User).filter(User.email == email.lower()).first()
     if not user or not user.is_active:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Usuario no valido"
@@ -2,6 +2,7 @@ from datetime import date
 from decimal import Decimal
 
 from sqlalchemy import func, inspect, text
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
 
 from ..config import get_active_company_key, settings
@@ -44,6 +45,78 @@ from ..models.sales import (
 )
 from .security import hash_password
 
+# Indices funcionales para las busquedas func.lower(col) == valor; create_all
+# solo los crea en tablas nuevas, por eso se aseguran tambien aqui.
+CASE_INSENSITIVE_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS ix_lineas_linea_lower ON lineas (lower(linea))",
+    "CREATE INDEX IF NOT EXISTS ix_lineas_cod_linea_lower ON lineas (lower(cod_linea))",
+    "CREATE INDEX IF NOT EXISTS ix_segmentos_segmento_lower ON segmentos (lower(segmento))",
+    "CREATE INDEX IF NOT EXISTS ix_marcas_nombre_lower ON marcas (lower(nombre))",
+    "CREATE INDEX IF NOT EXISTS ix_proveedores_nombre_lower ON proveedores (lower(nombre))",
+    "CREATE INDEX IF NOT EXISTS ix_clientes_nombre_lower ON clientes (lower(nombre))",
+    "CREATE INDEX IF NOT EXISTS ix_vendedores_nombre_lower ON vendedores (lower(nombre))",
+    "CREATE INDEX IF NOT EXISTS ix_users_email_lower ON users (lower(email))",
+)
+
+# Importaciones activas repetidas (mismo archivo) de antes del indice unico
+# parcial; se conserva la mas reciente.
+INVENTORY_IMPORT_JOBS_DEDUP_SQL = """
+    UPDATE inventory_import_jobs j
+    SET estado = 'ERROR', mensaje = 'Importacion interrumpida'
+    WHERE j.estado IN ('PENDIENTE', 'PROCESANDO')
+      AND EXISTS (
+          SELECT 1 FROM inventory_import_jobs o
+          WHERE o.token = j.token AND o.id > j.id AND o.estado IN ('PENDIENTE', 'PROCESANDO')
+      )
+"""
+
+# Ultimo registro por bodega / fecha (ORDER BY ... DESC LIMIT 1); el recorrido
+# inverso del btree cubre el orden descendente.
+LOOKUP_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS ix_cobranza_abonos_bodega_secuencia ON cobranza_abonos (bodega_id, secuencia)",
+    "CREATE INDEX IF NOT EXISTS ix_exchange_rates_effective_date ON exchange_rates (effective_date)",
+    "CREATE INDEX IF NOT EXISTS ix_vendedor_bodegas_bodega_vendedor ON vendedor_bodegas (bodega_id, vendedor_id)",
+    # Una sola importacion activa por archivo (token de idempotencia).
+    (
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_inventory_import_jobs_token_active ON inventory_import_jobs (token) "
+        "WHERE estado IN ('PENDIENTE', 'PROCESANDO')"
+    ),
+)
+
+# Acumulado de abonos por factura (NOTA_DEBITO resta) para las columnas
+# ventas_facturas.total_abonado_*; se mantiene de forma incremental en cobranza.
+COBRANZA_TOTALS_BACKFILL_SQL = """
+    UPDATE ventas_facturas f
+    SET total_abonado_usd = t.total_usd, total_abonado_cs = t.total_cs
+    FROM (
+        SELECT
+            factura_id,
+            COALESCE(SUM(CASE WHEN UPPER(TRIM(tipo_mov)) = 'NOTA_DEBITO' THEN -monto_usd ELSE monto_usd END), 0) AS total_usd,
+            COALESCE(SUM(CASE WHEN UPPER(TRIM(tipo_mov)) = 'NOTA_DEBITO' THEN -monto_cs ELSE monto_cs END), 0) AS total_cs
+        FROM cobranza_abonos
+        GROUP BY factura_id
+    ) t
+    WHERE t.factura_id = f.id
+"""
+
+# Emails guardados antes de normalizarlos; se omiten los que chocarian con otro
+# usuario que solo difiere en mayusculas.
+USERS_EMAIL_LOWER_SQL = """
+    UPDATE users u
+    SET email = lower(u.email)
+    WHERE u.email <> lower(u.email)
+      AND NOT EXISTS (
+          SELECT 1 FROM users o WHERE o.id <> u.id AND lower(o.email) = lower(u.email)
+      )
+"""
+
+# Busquedas por subcadena (ILIKE '%texto%'); requieren la extension pg_trgm.
+TRIGRAM_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS ix_clientes_nombre_trgm ON clientes USING gin (nombre gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_productos_cod_producto_trgm ON productos USING gin (cod_producto gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_productos_descripcion_trgm ON productos USING gin (descripcion gin_trgm_ops)",
+)
+
 
 def _seed_roles(db: Session) -> None:
     role_names = ["administrador", "vendedor", "cajero", "seguridad", "contador", "bodega"]
@@ -55,7 +128,7 @@ def _seed_roles(db: Session) -> None:
 
 
 def _seed_admin(db: Session) -> None:
-    admin = db.query(User).filter(User.email == settings.ADMIN_EMAIL).first()
+    admin = db.query(User).filter(User.email == settings.ADMIN_EMAIL.strip().lower()).first()
     admin_role = db.query(Role).filter(Role.name == "administrador").first()
     if admin:
         if admin_role and admin_role not in admin.roles:
@@ -351,7 +424,7 @@ def _seed_accounting_policy_settings(db: Session) -> None:
 
 
 def _seed_admin_branch_access(db: Session) -> None:
-    admin = db.query(User).filter(User.email == settings.ADMIN_EMAIL).first()
+    admin = db.query(User).filter(User.email == settings.ADMIN_EMAIL.strip().lower()).first()
     if not admin:
         return
     active_branches = db.query(Branch).filter(Branch.activo.is_(True)).order_by(Branch.id).all()
@@ -1589,6 +1662,8 @@ def init_db() -> None:
         if "default_bodega_id" not in columns:
             with engine.begin() as conn:
                 conn.execute(text("ALTER TABLE users ADD COLUMN default_bodega_id INTEGER"))
+        with engine.begin() as conn:
+            conn.execute(text(USERS_EMAIL_LOWER_SQL))
     if "branches" in inspector.get_table_names():
         columns = {column["name"] for column in inspector.get_columns("branches")}
         if "activo" not in columns:
@@ -1752,6 +1827,12 @@ def init_db() -> None:
             with engine.begin() as conn:
                 conn.execute(text("ALTER TABLE cobranza_abonos ADD COLUMN tipo_mov VARCHAR(20) DEFAULT 'ABONO'"))
                 conn.execute(text("UPDATE cobranza_abonos SET tipo_mov = 'ABONO' WHERE tipo_mov IS NULL OR tipo_mov = ''"))
+        factura_columns = {column["name"] for column in inspector.get_columns("ventas_facturas")}
+        if "total_abonado_usd" not in factura_columns:
+            with engine.begin() as conn:
+                conn.execute(text("ALTER TABLE ventas_facturas ADD COLUMN total_abonado_usd NUMERIC(14, 2) DEFAULT 0"))
+                conn.execute(text("ALTER TABLE ventas_facturas ADD COLUMN total_abonado_cs NUMERIC(14, 2) DEFAULT 0"))
+                conn.execute(text(COBRANZA_TOTALS_BACKFILL_SQL))
     if "recibos_rubros" in inspector.get_table_names():
         columns = {column["name"] for column in inspector.get_columns("recibos_rubros")}
         if "cuenta_id" not in columns:
@@ -1882,6 +1963,9 @@ def init_db() -> None:
             with engine.begin() as conn:
                 conn.execute(text("ALTER TABLE bodegas ADD COLUMN permite_facturacion BOOLEAN DEFAULT TRUE"))
                 conn.execute(text("UPDATE bodegas SET permite_facturacion = TRUE WHERE permite_facturacion IS NULL"))
+        if "ultima_secuencia_venta" not in columns:
+            with engine.begin() as conn:
+                conn.execute(text("ALTER TABLE bodegas ADD COLUMN ultima_secuencia_venta INTEGER"))
     if "ventas_preventas" in inspector.get_table_names():
         columns = {column["name"] for column in inspector.get_columns("ventas_preventas")}
         if "is_frozen" not in columns:
@@ -2066,6 +2150,20 @@ def init_db() -> None:
             with engine.begin() as conn:
                 conn.execute(text("ALTER TABLE restaurant_tables ADD COLUMN height_units INTEGER DEFAULT 1"))
                 conn.execute(text("UPDATE restaurant_tables SET height_units = 1 WHERE height_units IS NULL"))
+    with engine.begin() as conn:
+        for statement in CASE_INSENSITIVE_INDEX_SQL:
+            conn.execute(text(statement))
+        conn.execute(text(INVENTORY_IMPORT_JOBS_DEDUP_SQL))
+        for statement in LOOKUP_INDEX_SQL:
+            conn.execute(text(statement))
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            for statement in TRIGRAM_INDEX_SQL:
+                conn.execute(text(statement))
+    except SQLAlchemyError:
+        # Sin permisos para la extension la busqueda sigue funcionando sin indice.
+        pass
     db = get_session_local()()
     try:
         _seed_unidades_medida(db)
@@ -1,6 +1,6 @@
-from sqlalchemy import Boolean, Column, Date, DateTime, ForeignKey, Integer, Numeric, String, UniqueConstraint
+from sqlalchemy import Boolean, Column, Date, DateTime, ForeignKey, Index, Integer, Numeric, String, UniqueConstraint
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, text
 
 from ..database import Base
 from .user import Branch
@@ -18,6 +18,10 @@ class Linea(Base):
     productos = relationship("Producto", back_populates="linea")
 
 
+Index("ix_lineas_linea_lower", func.lower(Linea.linea))
+Index("ix_lineas_cod_linea_lower", func.lower(Linea.cod_linea))
+
+
 class Segmento(Base):
     __tablename__ = "segmentos"
 
@@ -28,6 +32,9 @@ class Segmento(Base):
     productos = relationship("Producto", back_populates="segmento")
 
 
+Index("ix_segmentos_segmento_lower", func.lower(Segmento.segmento))
+
+
 class Marca(Base):
     __tablename__ = "marcas"
 
@@ -38,6 +45,9 @@ class Marca(Base):
     registro = Column(DateTime, server_default=func.now())
 
 
+Index("ix_marcas_nombre_lower", func.lower(Marca.nombre))
+
+
 class UnidadMedida(Base):
     __tablename__ = "unidades_medida"
 
@@ -257,6 +267,7 @@ class SaldoProducto(Base):
 
 class ExchangeRate(Base):
     __tablename__ = "exchange_rates"
+    __table_args__ = (Index("ix_exchange_rates_effective_date", "effective_date"),)
 
     id = Column(Integer, primary_key=True, index=True)
     effective_date = Column(Date, nullable=False)
@@ -274,6 +285,7 @@ class Bodega(Base):
     branch_id = Column(Integer, ForeignKey("branches.id"), nullable=False)
     activo = Column(Boolean, default=True)
     permite_facturacion = Column(Boolean, nullable=False, default=True)
+    ultima_secuencia_venta = Column(Integer, nullable=True)
     created_at = Column(DateTime, server_default=func.now())
 
     branch = relationship(Branch)
@@ -289,6 +301,9 @@ class Proveedor(Base):
     created_at = Column(DateTime, server_default=func.now())
 
 
+Index("ix_proveedores_nombre_lower", func.lower(Proveedor.nombre))
+
+
 class IngresoTipo(Base):
     __tablename__ = "ingreso_tipos"
 
@@ -338,6 +353,27 @@ class IngresoItem(Base):
     variante = relationship("ShoeProductVariant")
 
 
+class InventoryImportJob(Base):
+    __tablename__ = "inventory_import_jobs"
+    __table_args__ = (
+        Index(
+            "ix_inventory_import_jobs_token_active",
+            "token",
+            unique=True,
+            postgresql_where=text("estado IN ('PENDIENTE', 'PROCESANDO')"),
+        ),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    token = Column(String(64), nullable=False, index=True)
+    filename = Column(String(255), nullable=True)
+    estado = Column(String(20), nullable=False, default="PENDIENTE")
+    mensaje = Column(String(300), nullable=True)
+    usuario_registro = Column(String(120), nullable=True)
+    created_at = Column(DateTime, server_default=func.now())
+    finished_at = Column(DateTime, nullable=True)
+
+
 class EgresoTipo(Base):
     __tablename__ = "egreso_tipos"
 
@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, Date, DateTime, ForeignKey, Integer, Numeric, String, Text, UniqueConstraint
+from sqlalchemy import Boolean, Column, Date, DateTime, ForeignKey, Index, Integer, Numeric, String, Text, UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 
@@ -19,6 +19,9 @@ class Cliente(Base):
     created_at = Column(DateTime, server_default=func.now())
 
 
+Index("ix_clientes_nombre_lower", func.lower(Cliente.nombre))
+
+
 class Vendedor(Base):
     __tablename__ = "vendedores"
 
@@ -31,9 +34,15 @@ class Vendedor(Base):
     assignments = relationship("VendedorBodega", back_populates="vendedor", cascade="all, delete-orphan")
 
 
+Index("ix_vendedores_nombre_lower", func.lower(Vendedor.nombre))
+
+
 class VendedorBodega(Base):
     __tablename__ = "vendedor_bodegas"
-    __table_args__ = (UniqueConstraint("vendedor_id", "bodega_id", name="uq_vendedor_bodega"),)
+    __table_args__ = (
+        UniqueConstraint("vendedor_id", "bodega_id", name="uq_vendedor_bodega"),
+        Index("ix_vendedor_bodegas_bodega_vendedor", "bodega_id", "vendedor_id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     vendedor_id = Column(Integer, ForeignKey("vendedores.id"), nullable=False)
@@ -269,6 +278,8 @@ class VentaFactura(Base):
     usuario_registro = Column(String(120), nullable=True)
     estado = Column(String(20), nullable=False, default="ACTIVA")
     estado_cobranza = Column(String(20), nullable=False, default="PENDIENTE")
+    total_abonado_usd = Column(Numeric(14, 2), default=0)
+    total_abonado_cs = Column(Numeric(14, 2), default=0)
     setato_excluida = Column(Boolean, nullable=False, default=False)
     setato_actualizado_por = Column(String(160), nullable=True)
     setato_actualizado_at = Column(DateTime, nullable=True)
@@ -559,6 +570,7 @@ class RestaurantOrderItem(Base):
 
 class CobranzaAbono(Base):
     __tablename__ = "cobranza_abonos"
+    __table_args__ = (Index("ix_cobranza_abonos_bodega_secuencia", "bodega_id", "secuencia"),)
 
     id = Column(Integer, primary_key=True, index=True)
     factura_id = Column(Integer, ForeignKey("ventas_facturas.id"), nullable=False)
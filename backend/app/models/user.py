@@ -1,5 +1,6 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Table
-from sqlalchemy.orm import relationship
+from sqlalchemy import Boolean, Column, ForeignKey, Index, Integer, String, Table
+from sqlalchemy.orm import relationship, validates
+from sqlalchemy.sql import func
 
 from ..database import Base
 
@@ -77,6 +78,11 @@ class User(Base):
 
     roles = relationship("Role", secondary=user_roles, back_populates="users")
     branches = relationship("Branch", secondary=user_branches, back_populates="users")
+
+    @validates("email")
+    def _normalize_email(self, key, value):
+        # Se guarda en minusculas para buscar por igualdad simple sobre el indice unico.
+        return value.strip().lower() if value else value
     default_branch = relationship("Branch", foreign_keys=[default_branch_id])
     default_bodega = relationship("Bodega", foreign_keys=[default_bodega_id])
     vendedor = relationship("Vendedor", foreign_keys=[vendedor_id])
@@ -88,3 +94,6 @@ class User(Base):
             for perm in role.permissions:
                 permission_map[perm.id] = perm
         return list(permission_map.values())
+
+
+Index("ix_users_email_lower", func.lower(User.email))
@@ -22,7 +22,7 @@ def register(
     db: Session = Depends(get_db),
     _: User = Depends(require_admin),
 ):
-    existing = db.query(User).filter(User.email == user.email).first()
+    existing = db.query(User).filter(User.email == user.email.strip().lower()).first()
     if existing:
         raise HTTPException(status_code=400, detail="Email ya registrado")
 
@@ -1,7 +1,10 @@
 from collections import defaultdict
 from difflib import SequenceMatcher
-from typing import Optional
+from functools import lru_cache
+from itertools import chain, repeat
+from typing import BinaryIO, Optional
 import asyncio
+import atexit
 
 import csv
 import hashlib
@@ -11,15 +14,19 @@ import json
 import mimetypes
 import os
 import re
+import secrets
 import smtplib
 import subprocess
 import tempfile
+import textwrap
+import time
 import unicodedata
 from email.message import EmailMessage
 from email.utils import make_msgid
 
 import io
 from pathlib import Path
+from threading import Lock
 from urllib import request as urlrequest
 from urllib.parse import parse_qs, quote_plus, urlencode, urlparse, urlunparse
 from dotenv import dotenv_values
@@ -27,13 +34,18 @@ from openpyxl import Workbook, load_workbook
 from openpyxl.styles import Alignment, Font
 from openpyxl.utils import get_column_letter
 from reportlab.lib import colors
+from reportlab.lib.units import mm
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
 from PIL import Image, ImageDraw, ImageFont
 
-from fastapi import APIRouter, Depends, File, Form, HTTPException, Request, UploadFile
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
+from fastapi import APIRouter, BackgroundTasks, Depends, File, Form, HTTPException, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse, RedirectResponse, Response, StreamingResponse
 from jose import JWTError, jwt
-from sqlalchemy import String, and_, create_engine, func, or_
-from sqlalchemy.orm import Session, aliased, object_session
+from sqlalchemy import String, and_, case, create_engine, func, insert, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session, aliased, contains_eager, joinedload, load_only, object_session, selectinload
 
 from ..config import (
     get_active_company_key,
@@ -52,7 +64,7 @@ from ..core.security import (
     verify_password,
 )
 from ..core.utils import local_now, local_now_naive, local_today
-from ..database import get_current_database_url, refresh_engine
+from ..database import get_current_database_url, get_session_local, refresh_engine
 from datetime import date, datetime, timedelta, timezone
 from decimal import Decimal, ROUND_HALF_UP
 from decimal import InvalidOperation
@@ -67,6 +79,7 @@ from ..models.inventory import (
     IngresoInventario,
     IngresoItem,
     IngresoTipo,
+    InventoryImportJob,
     Linea,
     Marca,
     Producto,
@@ -142,6 +155,12 @@ except Exception:  # pragma: no cover - graceful fallback when dependency is una
 
 router = APIRouter()
 
+_STATIC_DIR = Path(__file__).resolve().parents[1] / "static"
+_POS_LOGO_PATH = _STATIC_DIR / "logopos.png"
+_FALLBACK_LOGO_PATH = _STATIC_DIR / "logo_hollywood.png"
+_ENV_PATH = Path(__file__).resolve().parents[2] / ".env"
+_CODE_SLUG_RE = re.compile(r"[^A-Za-z0-9]+")
+
 SALES_INTERFACE_OPTIONS = [
     {"code": "ropa", "label": "Interfaz Ventas Ropa"},
     {"code": "ferreteria", "label": "Interfaz Ferreteria"},
@@ -448,6 +467,39 @@ def to_decimal(value: Optional[float]) -> Decimal:
     return Decimal(str(value or 0))
 
 
+def _zip_form_lists(primary: list, *others: list):
+    # Filas paralelas de un formulario: una por valor de `primary`, el resto se
+    # rellena con None cuando su lista es mas corta.
+    return zip(primary, *(chain(values, repeat(None)) for values in others))
+
+
+_MONEY_STRIP_RE = re.compile(r"[^0-9.,-]")
+
+
+def _parse_money_decimal(value: Optional[str]) -> Decimal:
+    # Acepta montos con separadores locales ("1.234,50", "1,234.50", "150,00").
+    raw = _MONEY_STRIP_RE.sub("", str(value or "0"))
+    if "," in raw and "." in raw:
+        if raw.rfind(",") > raw.rfind("."):
+            raw = raw.replace(".", "").replace(",", ".")
+        else:
+            raw = raw.replace(",", "")
+    elif "," in raw and "." not in raw:
+        parts = raw.split(",")
+        if len(parts) == 2 and len(parts[1]) == 2:
+            raw = raw.replace(",", ".")
+        else:
+            raw = raw.replace(",", "")
+    elif "." in raw and "," not in raw:
+        parts = raw.split(".")
+        if not (len(parts) == 2 and len(parts[1]) == 2):
+            raw = raw.replace(".", "")
+    try:
+        return Decimal(raw)
+    except Exception:
+        return Decimal("0")
+
+
 def _ascii_lower(value: Optional[str]) -> str:
     return (
         unicodedata.normalize("NFKD", str(value or ""))
@@ -522,35 +574,92 @@ def _smart_product_match(producto: Producto, query: str) -> dict[str, object]:
     return {"score": score, "reason": reason}
 
 
-def _get_user_from_cookie(request: Request, db: Session) -> Optional[User]:
-    token = request.cookies.get("access_token")
-    if not token:
-        return None
+# Cache corto de tokens ya verificados: cada pagina y cada fetch decodifica la
+# cookie. La entrada nunca vive mas alla del exp del propio token.
+_TOKEN_CACHE_TTL_SECONDS = 30.0
+_TOKEN_CACHE_MAX_ENTRIES = 4096
+_token_cache: dict[str, tuple[float, dict]] = {}
+_token_cache_lock = Lock()
+
+
+def _decode_token(token: str) -> Optional[dict]:
+    now = time.monotonic()
+    with _token_cache_lock:
+        hit = _token_cache.get(token)
+    if hit is not None and hit[0] > now:
+        return hit[1]
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
     except JWTError:
         return None
-    email = payload.get("sub")
-    if not email:
-        return None
-    return db.query(User).filter(func.lower(User.email) == email.lower()).first()
+    ttl = _TOKEN_CACHE_TTL_SECONDS
+    exp = payload.get("exp")
+    if isinstance(exp, (int, float)):
+        ttl = min(ttl, exp - time.time())
+    if ttl > 0:
+        with _token_cache_lock:
+            if len(_token_cache) >= _TOKEN_CACHE_MAX_ENTRIES:
+                _token_cache.clear()
+            _token_cache[token] = (now + ttl, payload)
+    return payload
+
+
+def _get_user_from_cookie(request: Request, db: Session) -> Optional[User]:
+    # Memo por request: las dependencias y los handlers pueden resolverlo varias veces.
+    cached = getattr(request.state, "current_user", _CACHE_MISS)
+    if cached is not _CACHE_MISS:
+        return cached
+    user = None
+    token = request.cookies.get("access_token")
+    payload = _decode_token(token) if token else None
+    email = payload.get("sub") if payload else None
+    if email:
+        # Roles (con sus permisos) y sucursales se consultan en casi todo request.
+        user = (
+            db.query(User)
+            .options(
+                selectinload(User.roles).selectinload(Role.permissions),
+                selectinload(User.branches),
+            )
+            .filter(User.email == email.lower())
+            .first()
+        )
+    request.state.current_user = user
+    return user
 
 
 def _permission_names(user: User) -> set[str]:
-    return {perm.name for perm in (user.permissions or [])}
+    # User.permissions recorre roles y permisos en cada acceso; se calcula una
+    # vez por instancia (la sesion, y con ella el usuario, vive un request).
+    cached = getattr(user, "_permission_names_cache", None)
+    if cached is None:
+        cached = {perm.name for perm in (user.permissions or [])}
+        user._permission_names_cache = cached
+    return cached
+
+
+def _is_admin_user(user: User) -> bool:
+    # Igual que _permission_names: se resuelve una vez por instancia de usuario.
+    cached = getattr(user, "_is_admin_cache", None)
+    if cached is None:
+        cached = any(role.name == "administrador" for role in user.roles or [])
+        user._is_admin_cache = cached
+    return cached
 
 
 def _has_permission(user: User, perm: str) -> bool:
-    if any(role.name == "administrador" for role in user.roles or []):
+    if _is_admin_user(user):
         return True
     return perm in _permission_names(user)
 
 
 def _set_request_permissions(request: Request, user: User) -> None:
-    if any(role.name == "administrador" for role in user.roles or []):
+    is_admin = _is_admin_user(user)
+    if is_admin:
         perm_names = _permission_catalog_names()
     else:
         perm_names = _permission_names(user)
+    request.state.is_admin = is_admin
     request.state.permission_names = perm_names
     request.state.has_permissions = True
 
@@ -775,12 +884,12 @@ PERMISSION_GROUPS = [
 ]
 
 
-def _permission_catalog_names() -> set[str]:
-    names: set[str] = set()
-    for group in PERMISSION_GROUPS:
-        for item in group["items"]:
-            names.add(item["name"])
-    return names
+# El catalogo es estatico: el conjunto de nombres se arma una sola vez.
+_PERMISSION_CATALOG_NAMES = frozenset(item["name"] for group in PERMISSION_GROUPS for item in group["items"])
+
+
+def _permission_catalog_names() -> frozenset[str]:
+    return _PERMISSION_CATALOG_NAMES
 
 
 def _ensure_permission_catalog_in_db(db: Session) -> None:
@@ -823,24 +932,42 @@ def _require_user_web(
 def _resolve_branch_bodega(db: Session, user: User) -> tuple[Optional[Branch], Optional[Bodega]]:
     allowed_codes = _allowed_branch_codes(db)
     user_branches = [b for b in (user.branches or []) if (b.code or "").lower() in allowed_codes]
-    allowed_branch_ids = {b.id for b in user_branches}
-    bodega = None
+    user_branches_by_id = {b.id: b for b in user_branches}
+    allowed_branch_ids = set(user_branches_by_id)
+    # Una sola consulta trae la bodega por defecto y las bodegas activas de las
+    # sucursales candidatas; la eleccion se hace en memoria.
+    loaded_branch_ids = set(allowed_branch_ids)
+    if user.default_branch_id:
+        loaded_branch_ids.add(user.default_branch_id)
+    bodega_filters = []
     if user.default_bodega_id:
-        bodega = (
+        bodega_filters.append(Bodega.id == user.default_bodega_id)
+    if loaded_branch_ids:
+        bodega_filters.append(Bodega.branch_id.in_(loaded_branch_ids))
+    candidate_bodegas: list[Bodega] = []
+    if bodega_filters:
+        candidate_bodegas = (
             db.query(Bodega)
             .join(Branch, Branch.id == Bodega.branch_id)
-            .filter(Bodega.id == user.default_bodega_id, Bodega.activo.is_(True))
+            .options(contains_eager(Bodega.branch))
+            .filter(or_(*bodega_filters), Bodega.activo.is_(True))
             .filter(func.lower(Branch.code).in_(allowed_codes))
-            .first()
+            .order_by(Bodega.id)
+            .all()
         )
+    bodega = None
+    if user.default_bodega_id:
+        bodega = next((b for b in candidate_bodegas if b.id == user.default_bodega_id), None)
         if bodega and allowed_branch_ids and bodega.branch_id not in allowed_branch_ids:
             bodega = None
 
     branch = None
     if bodega:
-        branch = db.query(Branch).filter(Branch.id == bodega.branch_id).first()
+        branch = user_branches_by_id.get(bodega.branch_id) or bodega.branch
     if not branch and user.default_branch_id:
-        if not allowed_branch_ids or user.default_branch_id in allowed_branch_ids:
+        # Las sucursales del usuario ya vienen cargadas y filtradas por codigo.
+        branch = user_branches_by_id.get(user.default_branch_id)
+        if not branch and not allowed_branch_ids:
             branch = (
                 db.query(Branch)
                 .filter(Branch.id == user.default_branch_id)
@@ -858,12 +985,15 @@ def _resolve_branch_bodega(db: Session, user: User) -> tuple[Optional[Branch], O
         )
 
     if branch and (not bodega or bodega.branch_id != branch.id):
-        bodega = (
-            db.query(Bodega)
-            .filter(Bodega.branch_id == branch.id, Bodega.activo.is_(True))
-            .order_by(Bodega.id)
-            .first()
-        )
+        if branch.id in loaded_branch_ids:
+            bodega = next((b for b in candidate_bodegas if b.branch_id == branch.id), None)
+        else:
+            bodega = (
+                db.query(Bodega)
+                .filter(Bodega.branch_id == branch.id, Bodega.activo.is_(True))
+                .order_by(Bodega.id)
+                .first()
+            )
     return branch, bodega
 
 
@@ -873,19 +1003,24 @@ def _bodega_permite_facturacion(bodega: Optional[Bodega]) -> bool:
     return bool(getattr(bodega, "permite_facturacion", True))
 
 
-def _vendedores_for_bodega(db: Session, bodega: Optional[Bodega]) -> list[Vendedor]:
-    base = db.query(Vendedor).filter(Vendedor.activo.is_(True))
+def _vendedores_with_default(db: Session, bodega: Optional[Bodega]) -> tuple[list, Optional[int]]:
+    # Los selectores solo usan id y nombre; filas livianas en vez de entidades.
+    # El vendedor por defecto sale de la misma consulta de asignaciones.
+    base = select(Vendedor.id, Vendedor.nombre).where(Vendedor.activo.is_(True)).order_by(Vendedor.nombre)
     if not bodega:
-        return base.order_by(Vendedor.nombre).all()
-    assigned = (
-        base.join(VendedorBodega, VendedorBodega.vendedor_id == Vendedor.id)
-        .filter(VendedorBodega.bodega_id == bodega.id)
-        .order_by(Vendedor.nombre)
-        .all()
-    )
+        return db.execute(base).all(), None
+    assigned = db.execute(
+        base.add_columns(VendedorBodega.is_default)
+        .join(VendedorBodega, VendedorBodega.vendedor_id == Vendedor.id)
+        .where(VendedorBodega.bodega_id == bodega.id)
+    ).all()
     if assigned:
-        return assigned
-    return base.order_by(Vendedor.nombre).all()
+        return assigned, next((row.id for row in assigned if row.is_default), None)
+    return db.execute(base).all(), None
+
+
+def _vendedores_for_bodega(db: Session, bodega: Optional[Bodega]) -> list:
+    return _vendedores_with_default(db, bodega)[0]
 
 
 def _vendedores_for_branch(db: Session, branch_id: Optional[int]) -> list[Vendedor]:
@@ -1678,23 +1813,42 @@ def _get_or_create_consumidor_final(db: Session) -> Cliente:
     return cliente
 
 
+_BRANCH_SERIES_LETTERS = {"central": "C", "esteli": "E"}
+_SHOES_BRANCH_SERIES_LETTERS = {"central": "A", "kg": "B", "kgf": "C"}
+
+
 def _branch_sales_series_letter(branch_code: Optional[str]) -> str:
     normalized = (branch_code or "").strip().lower()
     if (get_active_company_key() or "").strip().lower() == "barrera":
         return "LB"
-    if _is_shoes_mode():
-        shoes_mapping = {
-            "central": "A",
-            "kg": "B",
-            "kgf": "C",
-        }
-        if normalized in shoes_mapping:
-            return shoes_mapping[normalized]
-    if normalized == "central":
-        return "C"
-    if normalized == "esteli":
-        return "E"
-    return (normalized[:1] or "X").upper()
+    if _is_shoes_mode() and normalized in _SHOES_BRANCH_SERIES_LETTERS:
+        return _SHOES_BRANCH_SERIES_LETTERS[normalized]
+    return _BRANCH_SERIES_LETTERS.get(normalized) or (normalized[:1] or "X").upper()
+
+
+def _next_venta_secuencia(db: Session, bodega_id: int) -> int:
+    # Incremento atomico del contador de la bodega; el UPDATE bloquea la fila
+    # hasta el commit, por lo que dos cajas no obtienen la misma secuencia.
+    # GREATEST cubre bodegas sin contador inicializado (toma el max existente).
+    max_existing = (
+        select(func.coalesce(func.max(VentaFactura.secuencia), 0))
+        .where(VentaFactura.bodega_id == bodega_id)
+        .scalar_subquery()
+    )
+    stmt = (
+        update(Bodega)
+        .where(Bodega.id == bodega_id)
+        .values(
+            ultima_secuencia_venta=func.greatest(
+                func.coalesce(Bodega.ultima_secuencia_venta, 0),
+                max_existing,
+            )
+            + 1
+        )
+        .returning(Bodega.ultima_secuencia_venta)
+        .execution_options(synchronize_session=False)
+    )
+    return int(db.execute(stmt).scalar_one())
 
 
 def _branch_cobranza_series_meta(branch_code: Optional[str]) -> tuple[str, int]:
@@ -2102,8 +2256,8 @@ def _repair_preventa_currency_if_needed(db: Session, preventa: Optional[Preventa
     return touched
 
 
-def _get_sumatra_path(config_path: Optional[str] = None) -> Optional[Path]:
-    env_path = os.getenv("SUMATRA_PATH")
+@lru_cache(maxsize=8)
+def _resolve_sumatra_path(config_path: Optional[str], env_path: Optional[str]) -> Optional[Path]:
     candidates = [
         config_path,
         env_path,
@@ -2120,6 +2274,14 @@ def _get_sumatra_path(config_path: Optional[str] = None) -> Optional[Path]:
     return None
 
 
+def _get_sumatra_path(config_path: Optional[str] = None) -> Optional[Path]:
+    path = _resolve_sumatra_path(config_path, os.getenv("SUMATRA_PATH"))
+    if path is None:
+        # No se recuerda la ausencia: si instalan Sumatra no hace falta reiniciar.
+        _resolve_sumatra_path.cache_clear()
+    return path
+
+
 def _balances_by_bodega(
     db: Session,
     bodega_ids: list[int],
@@ -2127,39 +2289,126 @@ def _balances_by_bodega(
 ) -> dict[tuple[int, int], Decimal]:
     if not bodega_ids or not product_ids:
         return {}
-    ingreso_rows = (
-        db.query(IngresoItem.producto_id, IngresoInventario.bodega_id, func.sum(IngresoItem.cantidad))
+    movimientos = _inventory_movements_subquery(bodega_ids, product_ids)
+    stmt = select(
+        movimientos.c.producto_id,
+        movimientos.c.bodega_id,
+        func.sum(movimientos.c.qty),
+    ).group_by(movimientos.c.producto_id, movimientos.c.bodega_id)
+    # SUM sobre numeric ya llega como Decimal; no hace falta pasar por str().
+    return {
+        (producto_id, bodega_id): qty if qty is not None else Decimal("0")
+        for producto_id, bodega_id, qty in db.execute(stmt).all()
+    }
+
+
+def _bodega_balance_totals(
+    db: Session,
+    bodega_ids: list[int],
+    product_ids: list[int],
+) -> tuple[dict[int, tuple[Decimal, int]], int]:
+    # Por bodega: existencia total y productos con saldo positivo; ademas los
+    # productos con saldo positivo en alguna bodega. Todo se agrega en SQL.
+    if not bodega_ids or not product_ids:
+        return {}, 0
+    movimientos = _inventory_movements_subquery(bodega_ids, product_ids)
+    saldos = (
+        select(
+            movimientos.c.producto_id,
+            movimientos.c.bodega_id,
+            func.sum(movimientos.c.qty).label("saldo"),
+        )
+        .group_by(movimientos.c.producto_id, movimientos.c.bodega_id)
+        .cte("saldos")
+    )
+    global_items = (
+        select(func.count(func.distinct(saldos.c.producto_id)))
+        .where(saldos.c.saldo > 0)
+        .scalar_subquery()
+    )
+    per_bodega = select(
+        saldos.c.bodega_id,
+        func.coalesce(func.sum(saldos.c.saldo), 0),
+        func.count(case((saldos.c.saldo > 0, 1))),
+        global_items,
+    ).group_by(saldos.c.bodega_id)
+    totals: dict[int, tuple[Decimal, int]] = {}
+    total_global_items = 0
+    for bodega_id, total, count_items, global_count in db.execute(per_bodega).all():
+        totals[bodega_id] = (total if total is not None else Decimal("0"), int(count_items or 0))
+        total_global_items = int(global_count or 0)
+    return totals, total_global_items
+
+
+def _inventory_movements_subquery(
+    bodega_ids: list[int],
+    product_ids: list[int],
+    cutoff_date: Optional[date] = None,
+):
+    # Ingresos suman, egresos y ventas no anuladas restan; un solo viaje a la
+    # base con UNION ALL y la suma final agrupada en SQL. Con cutoff_date solo
+    # cuentan los movimientos hasta ese dia inclusive.
+    ingresos = (
+        select(
+            IngresoItem.producto_id.label("producto_id"),
+            IngresoInventario.bodega_id.label("bodega_id"),
+            IngresoItem.cantidad.label("qty"),
+        )
         .join(IngresoInventario, IngresoInventario.id == IngresoItem.ingreso_id)
-        .filter(IngresoInventario.bodega_id.in_(bodega_ids))
-        .filter(IngresoItem.producto_id.in_(product_ids))
-        .group_by(IngresoItem.producto_id, IngresoInventario.bodega_id)
-        .all()
+        .where(IngresoInventario.bodega_id.in_(bodega_ids))
+        .where(IngresoItem.producto_id.in_(product_ids))
     )
-    egreso_rows = (
-        db.query(EgresoItem.producto_id, EgresoInventario.bodega_id, func.sum(EgresoItem.cantidad))
+    egresos = (
+        select(EgresoItem.producto_id, EgresoInventario.bodega_id, -EgresoItem.cantidad)
         .join(EgresoInventario, EgresoInventario.id == EgresoItem.egreso_id)
-        .filter(EgresoInventario.bodega_id.in_(bodega_ids))
-        .filter(EgresoItem.producto_id.in_(product_ids))
-        .group_by(EgresoItem.producto_id, EgresoInventario.bodega_id)
-        .all()
+        .where(EgresoInventario.bodega_id.in_(bodega_ids))
+        .where(EgresoItem.producto_id.in_(product_ids))
     )
-    venta_rows = (
-        db.query(VentaItem.producto_id, VentaFactura.bodega_id, func.sum(VentaItem.cantidad))
+    ventas = (
+        select(VentaItem.producto_id, VentaFactura.bodega_id, -VentaItem.cantidad)
         .join(VentaFactura, VentaFactura.id == VentaItem.factura_id)
-        .filter(VentaFactura.bodega_id.in_(bodega_ids))
-        .filter(VentaItem.producto_id.in_(product_ids))
-        .filter(VentaFactura.estado != "ANULADA")
-        .group_by(VentaItem.producto_id, VentaFactura.bodega_id)
-        .all()
+        .where(VentaFactura.bodega_id.in_(bodega_ids))
+        .where(VentaItem.producto_id.in_(product_ids))
+        .where(VentaFactura.estado != "ANULADA")
     )
-    balances: dict[tuple[int, int], Decimal] = {}
-    for producto_id, bodega_id, qty in ingreso_rows:
-        balances[(producto_id, bodega_id)] = Decimal(str(qty or 0))
-    for producto_id, bodega_id, qty in egreso_rows:
-        balances[(producto_id, bodega_id)] = balances.get((producto_id, bodega_id), Decimal("0")) - Decimal(str(qty or 0))
-    for producto_id, bodega_id, qty in venta_rows:
-        balances[(producto_id, bodega_id)] = balances.get((producto_id, bodega_id), Decimal("0")) - Decimal(str(qty or 0))
-    return balances
+    if cutoff_date is not None:
+        cutoff_dt = datetime.combine(cutoff_date + timedelta(days=1), datetime.min.time())
+        ingresos = ingresos.where(IngresoInventario.fecha <= cutoff_date)
+        egresos = egresos.where(EgresoInventario.fecha <= cutoff_date)
+        ventas = ventas.where(VentaFactura.fecha < cutoff_dt)
+    return ingresos.union_all(egresos, ventas).subquery()
+
+
+def _saldos_por_bodega_matrix(
+    db: Session,
+    bodega_ids: list[int],
+    product_ids: list[int],
+) -> dict[int, dict[int, float]]:
+    # Matriz producto x bodega en float para los formularios: se parte de filas
+    # en cero y solo se recorren los pares con movimientos, no todo P x B.
+    zero_row = dict.fromkeys(bodega_ids, 0.0)
+    saldos = {producto_id: dict(zero_row) for producto_id in product_ids}
+    for (producto_id, bodega_id), qty in _balances_by_bodega(db, bodega_ids, product_ids).items():
+        saldos[producto_id][bodega_id] = float(qty or 0)
+    return saldos
+
+
+def _apply_saldo_deltas(db: Session, deltas: dict[int, Decimal]) -> None:
+    # Un solo INSERT ... ON CONFLICT para todos los productos tocados; crea el
+    # saldo si no existe y suma el delta sobre el valor actual en la base.
+    rows = [
+        {"producto_id": producto_id, "existencia": delta}
+        for producto_id, delta in deltas.items()
+        if delta
+    ]
+    if not rows:
+        return
+    stmt = pg_insert(SaldoProducto).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[SaldoProducto.producto_id],
+        set_={"existencia": func.coalesce(SaldoProducto.existencia, 0) + stmt.excluded.existencia},
+    )
+    db.execute(stmt)
 
 
 def _balances_by_bodega_until(
@@ -2170,43 +2419,16 @@ def _balances_by_bodega_until(
 ) -> dict[tuple[int, int], Decimal]:
     if not bodega_ids or not product_ids:
         return {}
-    cutoff_dt = datetime.combine(cutoff_date + timedelta(days=1), datetime.min.time())
-    ingreso_rows = (
-        db.query(IngresoItem.producto_id, IngresoInventario.bodega_id, func.sum(IngresoItem.cantidad))
-        .join(IngresoInventario, IngresoInventario.id == IngresoItem.ingreso_id)
-        .filter(IngresoInventario.bodega_id.in_(bodega_ids))
-        .filter(IngresoItem.producto_id.in_(product_ids))
-        .filter(IngresoInventario.fecha <= cutoff_date)
-        .group_by(IngresoItem.producto_id, IngresoInventario.bodega_id)
-        .all()
-    )
-    egreso_rows = (
-        db.query(EgresoItem.producto_id, EgresoInventario.bodega_id, func.sum(EgresoItem.cantidad))
-        .join(EgresoInventario, EgresoInventario.id == EgresoItem.egreso_id)
-        .filter(EgresoInventario.bodega_id.in_(bodega_ids))
-        .filter(EgresoItem.producto_id.in_(product_ids))
-        .filter(EgresoInventario.fecha <= cutoff_date)
-        .group_by(EgresoItem.producto_id, EgresoInventario.bodega_id)
-        .all()
-    )
-    venta_rows = (
-        db.query(VentaItem.producto_id, VentaFactura.bodega_id, func.sum(VentaItem.cantidad))
-        .join(VentaFactura, VentaFactura.id == VentaItem.factura_id)
-        .filter(VentaFactura.bodega_id.in_(bodega_ids))
-        .filter(VentaItem.producto_id.in_(product_ids))
-        .filter(VentaFactura.estado != "ANULADA")
-        .filter(VentaFactura.fecha < cutoff_dt)
-        .group_by(VentaItem.producto_id, VentaFactura.bodega_id)
-        .all()
-    )
-    balances: dict[tuple[int, int], Decimal] = {}
-    for producto_id, bodega_id, qty in ingreso_rows:
-        balances[(producto_id, bodega_id)] = Decimal(str(qty or 0))
-    for producto_id, bodega_id, qty in egreso_rows:
-        balances[(producto_id, bodega_id)] = balances.get((producto_id, bodega_id), Decimal("0")) - Decimal(str(qty or 0))
-    for producto_id, bodega_id, qty in venta_rows:
-        balances[(producto_id, bodega_id)] = balances.get((producto_id, bodega_id), Decimal("0")) - Decimal(str(qty or 0))
-    return balances
+    movimientos = _inventory_movements_subquery(bodega_ids, product_ids, cutoff_date)
+    stmt = select(
+        movimientos.c.producto_id,
+        movimientos.c.bodega_id,
+        func.sum(movimientos.c.qty),
+    ).group_by(movimientos.c.producto_id, movimientos.c.bodega_id)
+    return {
+        (producto_id, bodega_id): qty if qty is not None else Decimal("0")
+        for producto_id, bodega_id, qty in db.execute(stmt).all()
+    }
 
 
 def _default_company_profile_payload() -> dict[str, str]:
@@ -2341,7 +2563,67 @@ def _company_profile_payload(db: Session) -> dict[str, str]:
     return payload
 
 
+_CACHE_MISS = object()
+
+# Cache corto (por proceso) para configuracion que casi no cambia. La clave
+# incluye la URL de la base activa porque el ERP puede cambiar de empresa.
+# _invalidate_settings_cache solo limpia el worker que atendio el cambio; los
+# demas lo ven al vencer el TTL, asi que aqui no van montos ni tasas.
+_SETTINGS_CACHE_TTL_SECONDS = 60.0
+_settings_cache: dict[tuple[str, str], tuple[float, object]] = {}
+_settings_cache_lock = Lock()
+
+
+def _settings_cache_get(db: Session, name: str) -> object:
+    key = (str(db.get_bind().url), name)
+    with _settings_cache_lock:
+        hit = _settings_cache.get(key)
+    if hit is None or hit[0] <= time.monotonic():
+        return _CACHE_MISS
+    return hit[1]
+
+
+def _settings_cache_set(db: Session, name: str, value: object) -> None:
+    key = (str(db.get_bind().url), name)
+    with _settings_cache_lock:
+        _settings_cache[key] = (time.monotonic() + _SETTINGS_CACHE_TTL_SECONDS, value)
+
+
+def _invalidate_settings_cache(prefix: str = "") -> None:
+    with _settings_cache_lock:
+        for key in [key for key in _settings_cache if key[1].startswith(prefix)]:
+            _settings_cache.pop(key, None)
+
+
+def _latest_exchange_rate(db: Session, request: Optional[Request] = None) -> Optional[ExchangeRate]:
+    # Memo por request: varios pasos del mismo handler consultan la tasa vigente.
+    # No va al cache por proceso: con varios workers la invalidacion solo llega
+    # al que recibio el cambio, y la tasa debe verse al instante en todos.
+    if request is not None:
+        cached = getattr(request.state, "latest_exchange_rate", _CACHE_MISS)
+        if cached is not _CACHE_MISS:
+            return cached
+    rate = (
+        db.query(ExchangeRate)
+        .filter(ExchangeRate.effective_date <= local_today())
+        .order_by(ExchangeRate.effective_date.desc())
+        .first()
+    )
+    if request is not None:
+        request.state.latest_exchange_rate = rate
+    return rate
+
+
 def _inventory_cs_only_mode(db: Session) -> bool:
+    cached = _settings_cache_get(db, "inventory_cs_only")
+    if cached is not _CACHE_MISS:
+        return bool(cached)
+    value = _inventory_cs_only_mode_uncached(db)
+    _settings_cache_set(db, "inventory_cs_only", value)
+    return value
+
+
+def _inventory_cs_only_mode_uncached(db: Session) -> bool:
     # Los entornos de Pacas/Holl y Amajo/Comestibles trabajan
     # inventario base en USD. Aunque exista un flag global en el
     # perfil empresarial, no debe forzar interpretacion en C$.
@@ -2547,7 +2829,7 @@ def _text_initials(value: str, limit: int = 4) -> str:
 
 
 def _sanitize_code_token(value: str, limit: int = 14) -> str:
-    clean = re.sub(r"[^A-Za-z0-9]+", "", (value or "").upper())
+    clean = _CODE_SLUG_RE.sub("", (value or "").upper())
     return clean[:limit] if clean else "X"
 
 
@@ -2597,7 +2879,7 @@ def _user_scoped_branch_ids(db: Session, user: User) -> set[int]:
 
 
 def _resolve_logo_path(logo_url: str, *, prefer_pos: bool = False, pos_logo_url: Optional[str] = None) -> Path:
-    static_dir = Path(__file__).resolve().parents[1] / "static"
+    static_dir = _STATIC_DIR
     if prefer_pos:
         normalized_pos = (pos_logo_url or "").strip()
         if normalized_pos:
@@ -2609,9 +2891,8 @@ def _resolve_logo_path(logo_url: str, *, prefer_pos: bool = False, pos_logo_url:
             if absolute_pos_candidate.exists():
                 return absolute_pos_candidate
         # Compatibilidad con instalaciones antiguas.
-        pos_logo = static_dir / "logopos.png"
-        if pos_logo.exists():
-            return pos_logo
+        if _POS_LOGO_PATH.exists():
+            return _POS_LOGO_PATH
 
     normalized = (logo_url or "").strip()
     if normalized:
@@ -2623,8 +2904,15 @@ def _resolve_logo_path(logo_url: str, *, prefer_pos: bool = False, pos_logo_url:
         if absolute_candidate.exists():
             return absolute_candidate
 
-    fallback = static_dir / "logo_hollywood.png"
-    return fallback
+    return _FALLBACK_LOGO_PATH
+
+
+@lru_cache(maxsize=32)
+def _ticket_logo_path(logo_url: str, pos_logo_url: str) -> Optional[Path]:
+    # Los logos subidos reciben un nombre nuevo por carga, asi que la URL basta
+    # como clave; se evita sondear el disco en cada ticket impreso.
+    logo_path = _resolve_logo_path(logo_url, prefer_pos=True, pos_logo_url=pos_logo_url)
+    return logo_path if logo_path.exists() else None
 
 
 def _save_company_asset(upload: Optional[UploadFile], *, asset_kind: str, allowed_exts: set[str]) -> Optional[str]:
@@ -2638,7 +2926,7 @@ def _save_company_asset(upload: Optional[UploadFile], *, asset_kind: str, allowe
         raise ValueError(f"Formato no permitido para {asset_kind}")
     active_company = (get_active_company_key() or "default").strip().lower() or "default"
     safe_company = re.sub(r"[^a-z0-9_-]+", "", active_company) or "default"
-    static_dir = Path(__file__).resolve().parents[1] / "static"
+    static_dir = _STATIC_DIR
     target_dir = static_dir / "company_assets" / safe_company
     target_dir.mkdir(parents=True, exist_ok=True)
     stamp = local_now().strftime("%Y%m%d%H%M%S%f")
@@ -2664,7 +2952,7 @@ def _save_product_asset(upload: Optional[UploadFile], *, asset_kind: str = "prod
         raise ValueError("Formato de imagen no permitido")
     active_company = (get_active_company_key() or "default").strip().lower() or "default"
     safe_company = re.sub(r"[^a-z0-9_-]+", "", active_company) or "default"
-    static_dir = Path(__file__).resolve().parents[1] / "static"
+    static_dir = _STATIC_DIR
     target_dir = static_dir / "product_assets" / safe_company
     target_dir.mkdir(parents=True, exist_ok=True)
     stamp = local_now().strftime("%Y%m%d%H%M%S%f")
@@ -2802,34 +3090,73 @@ def _render_sales_close_email_html(
     return html, inline_images
 
 
-def _build_pos_ticket_pdf_bytes(factura: VentaFactura, profile: Optional[dict[str, str]] = None) -> bytes:
-    from reportlab.lib.units import mm
-    from reportlab.pdfgen import canvas
+def _wrap_ticket_text(text: str, max_chars: int) -> list[str]:
+    if not text:
+        return [""]
+    # Se normalizan los espacios (dobles, tabuladores) como lo hacia text.split().
+    lines = textwrap.wrap(" ".join(text.split()), width=max_chars, break_long_words=False, break_on_hyphens=False)
+    return lines or [text]
 
-    def wrap_text(text: str, max_chars: int) -> list[str]:
-        if not text:
-            return [""]
-        words = text.split()
-        lines: list[str] = []
-        current = ""
-        for word in words:
-            candidate = f"{current} {word}".strip()
-            if len(candidate) > max_chars:
-                if current:
-                    lines.append(current)
-                current = word
-            else:
-                current = candidate
-        if current:
-            lines.append(current)
-        return lines or [text]
 
-    def format_qty(value: float) -> str:
-        return f"{value:.2f}".rstrip("0").rstrip(".")
+def _format_ticket_qty(value: float) -> str:
+    return f"{value:.2f}".rstrip("0").rstrip(".")
+
+
+def _format_ticket_amount(value: float) -> str:
+    return f"{value:,.2f}"
+
+
+@lru_cache(maxsize=8)
+def _ticket_logo_reader(path_str: str) -> ImageReader:
+    # El logo se decodifica una vez y se reutiliza en cada ticket impreso. La
+    # decodificacion de ImageReader es perezosa; se fuerza aqui para que los
+    # hilos que comparten el lector no la disputen (y pierdan la mascara).
+    reader = ImageReader(path_str)
+    reader.getRGBData()
+    return reader
 
-    def format_amount(value: float) -> str:
-        return f"{value:,.2f}"
 
+# Geometria comun de los tickets de 80 mm (POS, ROC y cierre).
+_TICKET_WIDTH = 80 * mm
+_TICKET_MARGIN = (_TICKET_WIDTH - 70 * mm) / 2
+_TICKET_VERTICAL_MARGIN = 6 * mm
+_CIERRE_LOGO_HEIGHT = 45 * mm
+_CIERRE_LOGO_SPACING = 2 * mm
+_CIERRE_LOGO_WIDTH = 65 * mm
+
+
+def _load_factura_for_ticket(db: Session, factura_id: int) -> Optional[VentaFactura]:
+    # El ticket recorre bodega/sucursal, cliente, vendedor, items y pagos; se cargan
+    # de una vez para no disparar un SELECT por item y por pago.
+    return db.get(
+        VentaFactura,
+        factura_id,
+        options=[
+            joinedload(VentaFactura.bodega).joinedload(Bodega.branch),
+            joinedload(VentaFactura.cliente),
+            joinedload(VentaFactura.vendedor),
+            selectinload(VentaFactura.items).joinedload(VentaItem.producto),
+            selectinload(VentaFactura.items).joinedload(VentaItem.variante),
+            selectinload(VentaFactura.pagos).joinedload(VentaPago.forma_pago),
+            selectinload(VentaFactura.pagos).joinedload(VentaPago.banco),
+        ],
+    )
+
+
+def _load_recibo_for_ticket(db: Session, recibo_id: int) -> Optional[ReciboCaja]:
+    return db.get(
+        ReciboCaja,
+        recibo_id,
+        options=[
+            joinedload(ReciboCaja.branch),
+            joinedload(ReciboCaja.bodega),
+            joinedload(ReciboCaja.rubro).joinedload(ReciboRubro.cuenta),
+            joinedload(ReciboCaja.motivo),
+        ],
+    )
+
+
+def _build_pos_ticket_pdf_bytes(factura: VentaFactura, profile: Optional[dict[str, str]] = None) -> bytes:
     def payment_render_payload(pago: VentaPago) -> dict[str, str | float]:
         forma = pago.forma_pago.nombre if pago.forma_pago else "Pago"
         banco = pago.banco.nombre if pago.banco else ""
@@ -2840,12 +3167,12 @@ def _build_pos_ticket_pdf_bytes(factura: VentaFactura, profile: Optional[dict[st
         monto_original = float(getattr(pago, "monto_original", 0) or 0)
         if monto_original <= 0:
             monto_original = float(pago.monto_usd or 0) if pago_moneda == "USD" else float(pago.monto_cs or 0)
-        amount_label = f"$ {format_amount(monto_original)}" if pago_moneda == "USD" else f"C$ {format_amount(monto_original)}"
+        amount_label = f"$ {_format_ticket_amount(monto_original)}" if pago_moneda == "USD" else f"C$ {_format_ticket_amount(monto_original)}"
         equivalent_label = ""
         if pago_moneda == "USD" and float(pago.monto_cs or 0) > 0:
-            equivalent_label = f"C$ {format_amount(float(pago.monto_cs or 0))}"
+            equivalent_label = f"C$ {_format_ticket_amount(float(pago.monto_cs or 0))}"
         elif pago_moneda == "CS" and float(pago.monto_usd or 0) > 0:
-            equivalent_label = f"$ {format_amount(float(pago.monto_usd or 0))}"
+            equivalent_label = f"$ {_format_ticket_amount(float(pago.monto_usd or 0))}"
         return {
             "label": label,
             "moneda": pago_moneda,
@@ -2918,28 +3245,27 @@ def _build_pos_ticket_pdf_bytes(factura: VentaFactura, profile: Optional[dict[st
 
     lines: list[tuple[str, str, bool, int]] = []
 
-    def add_line(text: str, align: str = "left", bold: bool = False, size: int = 8):
-        lines.append((text, align, bold, size))
+    add_line = lines.append
 
-    add_line(company_name.upper(), "center", True, title_size)
-    add_line(f"RUC: {ruc}", "center")
-    add_line(f"Tel: {telefono}", "center")
-    direccion_lines = wrap_text(direccion, 32)[:2]
+    add_line((company_name.upper(), "center", True, title_size))
+    add_line((f"RUC: {ruc}", "center", False, 8))
+    add_line((f"Tel: {telefono}", "center", False, 8))
+    direccion_lines = _wrap_ticket_text(direccion, 32)[:2]
     for line in direccion_lines:
-        add_line(line, "center")
-    add_line(f"Sucursal: {sucursal}", "center", True, normal_size)
-    add_line("-" * 32, "center")
-    add_line(f"Factura: {factura.numero}", "left", True)
+        add_line((line, "center", False, 8))
+    add_line((f"Sucursal: {sucursal}", "center", True, normal_size))
+    add_line(("-" * 32, "center", False, 8))
+    add_line((f"Factura: {factura.numero}", "left", True, 8))
     if not is_amajo_mode:
-        add_line(f"Tipo: {(factura.condicion_venta or 'CONTADO').upper()}", "left", True)
-    add_line(f"Fecha: {fecha_str} {hora_str}".strip())
-    add_line(f"Moneda origen: {moneda_origen}", "left")
+        add_line((f"Tipo: {(factura.condicion_venta or 'CONTADO').upper()}", "left", True, 8))
+    add_line((f"Fecha: {fecha_str} {hora_str}".strip(), "left", False, 8))
+    add_line((f"Moneda origen: {moneda_origen}", "left", False, 8))
     if factura.tasa_cambio:
-        add_line(f"Tasa aplicada: C$ {format_amount(float(factura.tasa_cambio or 0))}", "left")
-    add_line(f"Cliente: {cliente}")
-    add_line(f"Identificacion R/C: {cliente_id}")
-    add_line(f"Vendedor: {vendedor}")
-    add_line("-" * 32, "center")
+        add_line((f"Tasa aplicada: C$ {_format_ticket_amount(float(factura.tasa_cambio or 0))}", "left", False, 8))
+    add_line((f"Cliente: {cliente}", "left", False, 8))
+    add_line((f"Identificacion R/C: {cliente_id}", "left", False, 8))
+    add_line((f"Vendedor: {vendedor}", "left", False, 8))
+    add_line(("-" * 32, "center", False, 8))
 
     max_desc = 34 if is_amajo_mode else 32
     total_unidades = 0.0
@@ -2965,60 +3291,56 @@ def _build_pos_ticket_pdf_bytes(factura: VentaFactura, profile: Optional[dict[st
         line_discount = float(getattr(item, "descuento_cs", None) or 0)
         total_unidades += qty
         if show_item_code:
-            add_line(f"Codigo: {codigo}{combo_label}", "left", True, normal_size)
+            add_line((f"Codigo: {codigo}{combo_label}", "left", True, normal_size))
         elif combo_label:
-            add_line(combo_label.strip(), "left", True, normal_size)
-        for part in wrap_text(descripcion, max_desc):
-            add_line(part, "left", False, normal_size)
+            add_line((combo_label.strip(), "left", True, normal_size))
+        for part in _wrap_ticket_text(descripcion, max_desc):
+            add_line((part, "left", False, normal_size))
         if is_libreado_item and float(item.peso_lbs or 0) > 0:
-            add_line(f"Peso: {format_qty(float(item.peso_lbs or 0))} Lbs", "left", False, normal_size)
-        qty_label = f"{format_qty(qty)} serv" if is_service_item else format_qty(qty)
+            add_line((f"Peso: {_format_ticket_qty(float(item.peso_lbs or 0))} Lbs", "left", False, normal_size))
+        qty_label = f"{_format_ticket_qty(qty)} serv" if is_service_item else _format_ticket_qty(qty)
         if line_discount > 0:
-            add_line(f"Desc item: {currency_label} {format_amount(line_discount)}", "left", False, normal_size)
+            add_line((f"Desc item: {currency_label} {_format_ticket_amount(line_discount)}", "left", False, normal_size))
         add_line(
-            f"Cant: {qty_label}  Precio: {currency_label} {format_amount(price)}  Subtotal: {currency_label} {format_amount(subtotal)}",
-            "left",
-            False,
-            normal_size,
+            (
+                f"Cant: {qty_label}  Precio: {currency_label} {_format_ticket_amount(price)}  Subtotal: {currency_label} {_format_ticket_amount(subtotal)}",
+                "left",
+                False,
+                normal_size,
+            )
         )
-        add_line("-" * 32, "center")
+        add_line(("-" * 32, "center", False, 8))
 
-    add_line(f"Total unds: {format_qty(total_unidades)}", "left", True, normal_size)
-    add_line(f"Subtotal: {currency_label} {format_amount(subtotal_amount)}", "right", True, normal_size)
-    add_line(f"Descuentos: {currency_label} {format_amount(discount_amount)}", "right", False, normal_size)
-    add_line(f"Total: {currency_label} {format_amount(total_amount)}", "right", True, title_size)
-    add_line(f"Equivalente USD: $ {format_amount(total_amount_usd)}", "right", False, normal_size)
+    add_line((f"Total unds: {_format_ticket_qty(total_unidades)}", "left", True, normal_size))
+    add_line((f"Subtotal: {currency_label} {_format_ticket_amount(subtotal_amount)}", "right", True, normal_size))
+    add_line((f"Descuentos: {currency_label} {_format_ticket_amount(discount_amount)}", "right", False, normal_size))
+    add_line((f"Total: {currency_label} {_format_ticket_amount(total_amount)}", "right", True, title_size))
+    add_line((f"Equivalente USD: $ {_format_ticket_amount(total_amount_usd)}", "right", False, normal_size))
 
     if pagos:
-        add_line("-" * 32, "center")
-        add_line("Pagos aplicados", "left", True, normal_size)
+        add_line(("-" * 32, "center", False, 8))
+        add_line(("Pagos aplicados", "left", True, normal_size))
         for pago in pagos:
             payment = payment_render_payload(pago)
             equiv = f" ({payment['equivalent_label']})" if payment["equivalent_label"] else ""
-            add_line(f"{payment['label']}: {payment['amount_label']}{equiv}", "left", False, normal_size)
+            add_line((f"{payment['label']}: {payment['amount_label']}{equiv}", "left", False, normal_size))
 
     if saldo >= 0:
-        add_line(f"Vuelto: {currency_label} {format_amount(saldo)}", "left", True, normal_size)
+        add_line((f"Vuelto: {currency_label} {_format_ticket_amount(saldo)}", "left", True, normal_size))
     else:
-        add_line(f"Saldo: {currency_label} {format_amount(abs(saldo))}", "left", True, normal_size)
-
-    add_line("")
-    add_line("Gracias por su compra", "center", True, normal_size)
-    add_line("Revise su mercaderia antes de salir.", "center", False, normal_size)
-    add_line("No se aceptan cambios ni devoluciones", "center", False, normal_size)
-    add_line("de mercaderia ni de dinero.", "center", False, normal_size)
-
-    content_width = 70 * mm
-    width = 80 * mm
-    margin = (width - content_width) / 2
-    top_margin = 6 * mm
-    bottom_margin = 6 * mm
-    logo_path = _resolve_logo_path(
-        company_profile.get("logo_url", ""),
-        prefer_pos=True,
-        pos_logo_url=company_profile.get("pos_logo_url", ""),
-    )
-    logo_height = 60 * mm if logo_path.exists() else 0
+        add_line((f"Saldo: {currency_label} {_format_ticket_amount(abs(saldo))}", "left", True, normal_size))
+
+    add_line(("", "left", False, 8))
+    add_line(("Gracias por su compra", "center", True, normal_size))
+    add_line(("Revise su mercaderia antes de salir.", "center", False, normal_size))
+    add_line(("No se aceptan cambios ni devoluciones", "center", False, normal_size))
+    add_line(("de mercaderia ni de dinero.", "center", False, normal_size))
+
+    width = _TICKET_WIDTH
+    margin = _TICKET_MARGIN
+    top_margin = bottom_margin = _TICKET_VERTICAL_MARGIN
+    logo_path = _ticket_logo_path(company_profile.get("logo_url", ""), company_profile.get("pos_logo_url", ""))
+    logo_height = 60 * mm if logo_path else 0
     logo_spacing = 3 * mm if logo_height else 0
 
     def line_gap(size: int) -> float:
@@ -3035,7 +3357,7 @@ def _build_pos_ticket_pdf_bytes(factura: VentaFactura, profile: Optional[dict[st
     if logo_height:
         logo_width = 78 * mm
         pdf.drawImage(
-            str(logo_path),
+            _ticket_logo_reader(str(logo_path)),
             (width - logo_width) / 2,
             y - logo_height,
             width=logo_width,
@@ -3060,6 +3382,25 @@ def _build_pos_ticket_pdf_bytes(factura: VentaFactura, profile: Optional[dict[st
     return buffer.getvalue()
 
 
+def _sumatra_print(sumatra_path: Path, printer_name: str, pdf_path: str, copies: int) -> None:
+    # Sumatra acepta las copias en -print-settings ("2x"): un solo proceso por
+    # impresion en lugar de uno por copia.
+    copies = max(copies, 1)
+    print_settings = "noscale" if copies == 1 else f"noscale,{copies}x"
+    subprocess.run(
+        [
+            str(sumatra_path),
+            "-print-to",
+            printer_name,
+            "-print-settings",
+            print_settings,
+            "-silent",
+            pdf_path,
+        ],
+        check=False,
+    )
+
+
 def _print_pos_ticket(
     factura: VentaFactura,
     printer_name: str,
@@ -3075,19 +3416,7 @@ def _print_pos_ticket(
         tmp_file.write(pdf_bytes)
         tmp_path = tmp_file.name
     try:
-        for _ in range(max(copies, 1)):
-            subprocess.run(
-                [
-                    str(sumatra_path),
-                    "-print-to",
-                    printer_name,
-                    "-print-settings",
-                    "noscale",
-                    "-silent",
-                    tmp_path,
-                ],
-                check=False,
-            )
+        _sumatra_print(sumatra_path, printer_name, tmp_path, copies)
     finally:
         try:
             Path(tmp_path).unlink(missing_ok=True)
@@ -3095,31 +3424,26 @@ def _print_pos_ticket(
             pass
 
 
-def _build_roc_ticket_pdf_bytes(recibo: ReciboCaja, profile: Optional[dict[str, str]] = None) -> bytes:
-    from reportlab.lib.units import mm
-    from reportlab.pdfgen import canvas
-
-    def wrap_text(text: str, max_chars: int) -> list[str]:
-        if not text:
-            return [""]
-        words = text.split()
-        lines: list[str] = []
-        current = ""
-        for word in words:
-            candidate = f"{current} {word}".strip()
-            if len(candidate) > max_chars:
-                if current:
-                    lines.append(current)
-                current = word
-            else:
-                current = candidate
-        if current:
-            lines.append(current)
-        return lines or [text]
+def _print_pos_ticket_background(
+    *,
+    factura_id: int,
+    printer_name: str,
+    copies: int,
+    sumatra_override: Optional[str] = None,
+) -> None:
+    # Se ejecuta como tarea de fondo, despues de responder; usa su propia sesion.
+    db = get_session_local()()
+    try:
+        factura = _load_factura_for_ticket(db, factura_id)
+        if factura:
+            _print_pos_ticket(factura, printer_name, copies, _company_profile_payload(db), sumatra_override)
+    except Exception:
+        pass
+    finally:
+        db.close()
 
-    def format_amount(value: float) -> str:
-        return f"{value:,.2f}"
 
+def _write_roc_ticket_pdf(recibo: ReciboCaja, output: BinaryIO, profile: Optional[dict[str, str]] = None) -> None:
     branch = recibo.branch
     company_profile = profile or _default_company_profile_payload()
     identity = _company_identity(branch, company_profile)
@@ -3154,61 +3478,54 @@ def _build_roc_ticket_pdf_bytes(recibo: ReciboCaja, profile: Optional[dict[str,
 
     lines: list[tuple[str, str, bool, int]] = []
 
-    def add_line(text: str, align: str = "left", bold: bool = False, size: int = 8):
-        lines.append((text, align, bold, size))
+    add_line = lines.append
 
-    add_line(company_name.upper(), "center", True, 10)
-    add_line(f"RUC: {ruc}", "center")
-    add_line(f"Tel: {telefono}", "center")
-    direccion_lines = wrap_text(direccion, 32)[:2]
+    add_line((company_name.upper(), "center", True, 10))
+    add_line((f"RUC: {ruc}", "center", False, 8))
+    add_line((f"Tel: {telefono}", "center", False, 8))
+    direccion_lines = _wrap_ticket_text(direccion, 32)[:2]
     for line in direccion_lines:
-        add_line(line, "center")
-    add_line(f"Sucursal: {sucursal}", "center", True, 9)
-    add_line("-" * 32, "center")
-    add_line("RECIBO OFICIAL DE CAJA", "center", True, 10)
-    add_line("-" * 32, "center")
-    add_line(f"No. Recibo: {recibo.numero}", "left", True, 9)
-    add_line(f"Fecha: {fecha_str} {hora_str}".strip())
-    add_line(f"Bodega: {bodega_name}")
-    add_line(f"Tipo: {recibo.tipo}")
-    add_line(f"Rubro: {rubro}")
-    add_line(f"Motivo: {motivo}")
-    add_line(f"Monto: {currency_label} {format_amount(monto_total)}", "left", True, 9)
-    add_line(f"Equivalente C$: {format_amount(monto_cs)}")
-    add_line("-" * 32, "center")
-    add_line("Detalle", "left", True, 9)
-    for part in wrap_text(descripcion, 32):
-        add_line(part, "left", False, 9)
-
-    add_line("-" * 32, "center")
-    add_line("Mini asiento contable", "left", True, 9)
+        add_line((line, "center", False, 8))
+    add_line((f"Sucursal: {sucursal}", "center", True, 9))
+    add_line(("-" * 32, "center", False, 8))
+    add_line(("RECIBO OFICIAL DE CAJA", "center", True, 10))
+    add_line(("-" * 32, "center", False, 8))
+    add_line((f"No. Recibo: {recibo.numero}", "left", True, 9))
+    add_line((f"Fecha: {fecha_str} {hora_str}".strip(), "left", False, 8))
+    add_line((f"Bodega: {bodega_name}", "left", False, 8))
+    add_line((f"Tipo: {recibo.tipo}", "left", False, 8))
+    add_line((f"Rubro: {rubro}", "left", False, 8))
+    add_line((f"Motivo: {motivo}", "left", False, 8))
+    add_line((f"Monto: {currency_label} {_format_ticket_amount(monto_total)}", "left", True, 9))
+    add_line((f"Equivalente C$: {_format_ticket_amount(monto_cs)}", "left", False, 8))
+    add_line(("-" * 32, "center", False, 8))
+    add_line(("Detalle", "left", True, 9))
+    for part in _wrap_ticket_text(descripcion, 32):
+        add_line((part, "left", False, 9))
+
+    add_line(("-" * 32, "center", False, 8))
+    add_line(("Mini asiento contable", "left", True, 9))
     if recibo.tipo == "EGRESO":
-        add_line(f"Debe: {rubro_cuenta}", "left", False, 9)
-        add_line(f"{currency_label} {format_amount(monto_total)}", "right", True, 9)
-        add_line(f"Haber: {caja_cuenta}", "left", False, 9)
-        add_line(f"{currency_label} {format_amount(monto_total)}", "right", True, 9)
+        add_line((f"Debe: {rubro_cuenta}", "left", False, 9))
+        add_line((f"{currency_label} {_format_ticket_amount(monto_total)}", "right", True, 9))
+        add_line((f"Haber: {caja_cuenta}", "left", False, 9))
+        add_line((f"{currency_label} {_format_ticket_amount(monto_total)}", "right", True, 9))
     else:
-        add_line(f"Debe: {caja_cuenta}", "left", False, 9)
-        add_line(f"{currency_label} {format_amount(monto_total)}", "right", True, 9)
-        add_line(f"Haber: {rubro_cuenta}", "left", False, 9)
-        add_line(f"{currency_label} {format_amount(monto_total)}", "right", True, 9)
-
-    add_line("-" * 32, "center")
-    add_line("Realizado por: __________________", "left", False, 9)
-    add_line("Recibido por: ___________________", "left", False, 9)
-    add_line("Autorizado: _____________________", "left", False, 9)
-
-    content_width = 70 * mm
-    width = 80 * mm
-    margin = (width - content_width) / 2
-    top_margin = 6 * mm
-    bottom_margin = 6 * mm
-    logo_path = _resolve_logo_path(
-        company_profile.get("logo_url", ""),
-        prefer_pos=True,
-        pos_logo_url=company_profile.get("pos_logo_url", ""),
-    )
-    logo_height = 42 * mm if logo_path.exists() else 0
+        add_line((f"Debe: {caja_cuenta}", "left", False, 9))
+        add_line((f"{currency_label} {_format_ticket_amount(monto_total)}", "right", True, 9))
+        add_line((f"Haber: {rubro_cuenta}", "left", False, 9))
+        add_line((f"{currency_label} {_format_ticket_amount(monto_total)}", "right", True, 9))
+
+    add_line(("-" * 32, "center", False, 8))
+    add_line(("Realizado por: __________________", "left", False, 9))
+    add_line(("Recibido por: ___________________", "left", False, 9))
+    add_line(("Autorizado: _____________________", "left", False, 9))
+
+    width = _TICKET_WIDTH
+    margin = _TICKET_MARGIN
+    top_margin = bottom_margin = _TICKET_VERTICAL_MARGIN
+    logo_path = _ticket_logo_path(company_profile.get("logo_url", ""), company_profile.get("pos_logo_url", ""))
+    logo_height = 42 * mm if logo_path else 0
     logo_spacing = 2 * mm if logo_height else 0
 
     def line_gap(size: int) -> float:
@@ -3218,14 +3535,13 @@ def _build_roc_ticket_pdf_bytes(recibo: ReciboCaja, profile: Optional[dict[str,
     total_height += sum(line_gap(size) for _, _, _, size in lines)
     total_height = max(total_height, 140 * mm)
 
-    buffer = io.BytesIO()
-    pdf = canvas.Canvas(buffer, pagesize=(width, total_height))
+    pdf = canvas.Canvas(output, pagesize=(width, total_height))
     y = total_height - top_margin
 
     if logo_height:
         logo_width = 65 * mm
         pdf.drawImage(
-            str(logo_path),
+            _ticket_logo_reader(str(logo_path)),
             (width - logo_width) / 2,
             y - logo_height,
             width=logo_width,
@@ -3247,8 +3563,12 @@ def _build_roc_ticket_pdf_bytes(recibo: ReciboCaja, profile: Optional[dict[str,
 
     pdf.showPage()
     pdf.save()
-    buffer.seek(0)
-    return buffer.read()
+
+
+def _build_roc_ticket_pdf_bytes(recibo: ReciboCaja, profile: Optional[dict[str, str]] = None) -> bytes:
+    buffer = io.BytesIO()
+    _write_roc_ticket_pdf(recibo, buffer, profile)
+    return buffer.getvalue()
 
 
 def _print_roc_ticket(
@@ -3261,24 +3581,13 @@ def _print_roc_ticket(
     sumatra_path = _get_sumatra_path(sumatra_override)
     if not sumatra_path:
         return
-    pdf_bytes = _build_roc_ticket_pdf_bytes(recibo, profile)
+    # El PDF se dibuja directo al archivo temporal, sin copia intermedia en memoria.
     with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-        tmp_file.write(pdf_bytes)
         tmp_path = tmp_file.name
     try:
-        for _ in range(max(copies, 1)):
-            subprocess.run(
-                [
-                    str(sumatra_path),
-                    "-print-to",
-                    printer_name,
-                    "-print-settings",
-                    "noscale",
-                    "-silent",
-                    tmp_path,
-                ],
-                check=False,
-            )
+        with open(tmp_path, "wb") as pdf_file:
+            _write_roc_ticket_pdf(recibo, pdf_file, profile)
+        _sumatra_print(sumatra_path, printer_name, tmp_path, copies)
     finally:
         try:
             Path(tmp_path).unlink(missing_ok=True)
@@ -3286,37 +3595,48 @@ def _print_roc_ticket(
             pass
 
 
-def _build_cierre_ticket_pdf_bytes(
+def _cierre_denomination_rows(detalle: dict) -> tuple[list[tuple[Decimal, object, Decimal]], Decimal]:
+    # (denominacion, cantidad original, total) de mayor a menor, y la suma.
+    rows: list[tuple[Decimal, object, Decimal]] = []
+    for denom, qty in detalle.items():
+        try:
+            denom_dec = Decimal(str(denom))
+        except Exception:
+            denom_dec = Decimal("0")
+        rows.append((denom_dec, qty, denom_dec * Decimal(str(qty or 0))))
+    rows.sort(key=lambda row: row[0], reverse=True)
+    return rows, sum((row[2] for row in rows), Decimal("0"))
+
+
+def _cierre_draw_op(text: str, align: str, bold: bool, size: int) -> tuple[str, int, tuple]:
+    # Resuelve fuente, metodo de dibujo y x una sola vez por linea; "izq||der"
+    # se dibuja en dos columnas.
+    font = "Helvetica-Bold" if bold else "Helvetica"
+    if "||" in text:
+        left_text, right_text = (part.strip() for part in text.split("||", 1))
+        draws = ((canvas.Canvas.drawString, _TICKET_MARGIN, left_text),)
+        if right_text:
+            draws += ((canvas.Canvas.drawString, _TICKET_WIDTH / 2, right_text),)
+    elif align == "center":
+        draws = ((canvas.Canvas.drawCentredString, _TICKET_WIDTH / 2, text),)
+    elif align == "right":
+        draws = ((canvas.Canvas.drawRightString, _TICKET_WIDTH - _TICKET_MARGIN, text),)
+    else:
+        draws = ((canvas.Canvas.drawString, _TICKET_MARGIN, text),)
+    return font, size, draws
+
+
+def _write_cierre_ticket_pdf(
     cierre: CierreCaja,
     tasa: Decimal,
     resumen: dict,
     total_bultos: Decimal,
+    output: BinaryIO,
     profile: Optional[dict[str, str]] = None,
-) -> bytes:
-    from reportlab.lib.units import mm
-    from reportlab.pdfgen import canvas
-
+) -> None:
     def format_amount(value: Decimal) -> str:
         return f"{Decimal(str(value or 0)):,.2f}"
 
-    def wrap_text(text: str, max_chars: int) -> list[str]:
-        if not text:
-            return [""]
-        words = text.split()
-        lines: list[str] = []
-        current = ""
-        for word in words:
-            candidate = f"{current} {word}".strip()
-            if len(candidate) > max_chars:
-                if current:
-                    lines.append(current)
-                current = word
-            else:
-                current = candidate
-        if current:
-            lines.append(current)
-        return lines or [text]
-
     branch = cierre.branch
     company_profile = profile or _default_company_profile_payload()
     identity = _company_identity(branch, company_profile)
@@ -3331,41 +3651,40 @@ def _build_cierre_ticket_pdf_bytes(
 
     lines: list[tuple[str, str, bool, int]] = []
 
-    def add_line(text: str, align: str = "left", bold: bool = False, size: int = 9):
-        lines.append((text, align, bold, size))
+    add_line = lines.append
 
-    add_line(company_name.upper(), "center", True, 12)
-    add_line(f"RUC: {ruc}", "center")
-    add_line(f"Tel: {telefono}", "center")
-    direccion_lines = wrap_text(direccion, 32)[:2]
+    add_line((company_name.upper(), "center", True, 12))
+    add_line((f"RUC: {ruc}", "center", False, 9))
+    add_line((f"Tel: {telefono}", "center", False, 9))
+    direccion_lines = _wrap_ticket_text(direccion, 32)[:2]
     for line in direccion_lines:
-        add_line(line, "center")
-    add_line(f"Sucursal: {sucursal}", "center", True, 10)
-    add_line("-" * 32, "center")
-    add_line("CIERRE OFICIAL DE CAJA", "center", True, 12)
-    add_line("-" * 32, "center")
-    add_line(f"Fecha: {fecha_str}", "left", True, 10)
-    add_line(f"Bodega: {bodega_name}", "left", False, 10)
-    add_line("-" * 32, "center")
-
-    add_line("Resumen arqueo (USD)", "left", True, 10)
-    add_line(f"Ventas: $ {format_amount(resumen['ventas_usd'])}", "left", False, 10)
-    add_line(f"Ingresos: + $ {format_amount(resumen['ingresos_usd'])}", "left", False, 10)
-    add_line(f"Egresos: - $ {format_amount(resumen['egresos_usd'])}", "left", False, 10)
-    add_line(f"Depositos: - $ {format_amount(resumen['depositos_usd'])}", "left", False, 10)
-    add_line(f"Creditos: - $ {format_amount(resumen['creditos_usd'])}", "left", False, 10)
-    add_line(f"Total esperado: $ {format_amount(resumen['total_calculado_usd'])}", "left", True, 10)
-    add_line("")
-
-    add_line("Efectivo contado", "left", True, 10)
-    add_line(f"Total C$: {format_amount(cierre.total_efectivo_cs)}", "left", False, 10)
-    add_line(f"Total USD: {format_amount(cierre.total_efectivo_usd)}", "left", False, 10)
-    add_line(f"Total USD equiv: {format_amount(cierre.total_efectivo_usd_equiv)}", "left", True, 10)
-    add_line("-" * 32, "center")
-
-    add_line(f"Faltante/Sobrante: $ {format_amount(cierre.diferencia_usd)}", "left", True, 10)
-    add_line(f"Total bultos vendidos: {format_amount(total_bultos)}", "left", False, 10)
-    add_line("")
+        add_line((line, "center", False, 9))
+    add_line((f"Sucursal: {sucursal}", "center", True, 10))
+    add_line(("-" * 32, "center", False, 9))
+    add_line(("CIERRE OFICIAL DE CAJA", "center", True, 12))
+    add_line(("-" * 32, "center", False, 9))
+    add_line((f"Fecha: {fecha_str}", "left", True, 10))
+    add_line((f"Bodega: {bodega_name}", "left", False, 10))
+    add_line(("-" * 32, "center", False, 9))
+
+    add_line(("Resumen arqueo (USD)", "left", True, 10))
+    add_line((f"Ventas: $ {format_amount(resumen['ventas_usd'])}", "left", False, 10))
+    add_line((f"Ingresos: + $ {format_amount(resumen['ingresos_usd'])}", "left", False, 10))
+    add_line((f"Egresos: - $ {format_amount(resumen['egresos_usd'])}", "left", False, 10))
+    add_line((f"Depositos: - $ {format_amount(resumen['depositos_usd'])}", "left", False, 10))
+    add_line((f"Creditos: - $ {format_amount(resumen['creditos_usd'])}", "left", False, 10))
+    add_line((f"Total esperado: $ {format_amount(resumen['total_calculado_usd'])}", "left", True, 10))
+    add_line(("", "left", False, 9))
+
+    add_line(("Efectivo contado", "left", True, 10))
+    add_line((f"Total C$: {format_amount(cierre.total_efectivo_cs)}", "left", False, 10))
+    add_line((f"Total USD: {format_amount(cierre.total_efectivo_usd)}", "left", False, 10))
+    add_line((f"Total USD equiv: {format_amount(cierre.total_efectivo_usd_equiv)}", "left", True, 10))
+    add_line(("-" * 32, "center", False, 9))
+
+    add_line((f"Faltante/Sobrante: $ {format_amount(cierre.diferencia_usd)}", "left", True, 10))
+    add_line((f"Total bultos vendidos: {format_amount(total_bultos)}", "left", False, 10))
+    add_line(("", "left", False, 9))
 
     try:
         detalle_cs = json.loads(cierre.detalle_cs or "{}")
@@ -3376,62 +3695,35 @@ def _build_cierre_ticket_pdf_bytes(
     except Exception:
         detalle_usd = {}
 
-    add_line("Desglose USD (cantidades)", "left", True, 10)
-    usd_items = []
-    for denom, qty in detalle_usd.items():
-        try:
-            usd_items.append((Decimal(str(denom)), qty))
-        except Exception:
-            usd_items.append((Decimal("0"), qty))
-    usd_items = sorted(usd_items, key=lambda item: item[0], reverse=True)
-    subtotal_usd_breakdown = Decimal("0")
-    for denom, qty in usd_items:
-        qty_dec = Decimal(str(qty or 0))
-        total = denom * qty_dec
-        subtotal_usd_breakdown += total
-        add_line(f"$ {denom} x {qty} = $ {format_amount(total)}", "left", False, 9)
-    add_line("")
-    add_line(f"Total desglose USD: {format_amount(subtotal_usd_breakdown)}", "left", True, 10)
-    add_line("")
-
-    add_line("Desglose C$ (cantidades)", "left", True, 10)
-    cs_items = []
-    for denom, qty in detalle_cs.items():
-        try:
-            cs_items.append((Decimal(str(denom)), qty))
-        except Exception:
-            cs_items.append((Decimal("0"), qty))
-    cs_items = sorted(cs_items, key=lambda item: item[0], reverse=True)
-    subtotal_cs_breakdown = Decimal("0")
-    for denom, qty in cs_items:
-        qty_dec = Decimal(str(qty or 0))
-        total = denom * qty_dec
-        subtotal_cs_breakdown += total
-        add_line(f"C$ {denom} x {qty} = C$ {format_amount(total)}", "left", False, 9)
-    add_line("")
-    add_line(f"Total desglose C$: {format_amount(subtotal_cs_breakdown)}", "left", True, 10)
-    add_line("")
-    add_line(f"Total C$: {format_amount(cierre.total_efectivo_cs)}", "left", True, 10)
-    add_line(f"Total USD: {format_amount(cierre.total_efectivo_usd)}", "left", True, 10)
-    add_line(f"Total USD equiv: {format_amount(cierre.total_efectivo_usd_equiv)}", "left", True, 10)
-
-    add_line("-" * 32, "center")
-    add_line("Realizado por: __________________", "left", False, 9)
-    add_line("Recibido por: ___________________", "left", False, 9)
-    add_line("Autorizado: _____________________", "left", False, 9)
-
-    content_width = 70 * mm
-    width = 80 * mm
-    margin = (width - content_width) / 2
-    top_margin = 6 * mm
-    bottom_margin = 6 * mm
-    logo_path = _resolve_logo_path(
-        company_profile.get("logo_url", ""),
-        prefer_pos=True,
-        pos_logo_url=company_profile.get("pos_logo_url", ""),
-    )
-    logo_height = 45 * mm if logo_path.exists() else 0
-    logo_spacing = 2 * mm if logo_height else 0
+    add_line(("Desglose USD (cantidades)", "left", True, 10))
+    usd_rows, subtotal_usd_breakdown = _cierre_denomination_rows(detalle_usd)
+    for denom, qty, total in usd_rows:
+        add_line((f"$ {denom} x {qty} = $ {format_amount(total)}", "left", False, 9))
+    add_line(("", "left", False, 9))
+    add_line((f"Total desglose USD: {format_amount(subtotal_usd_breakdown)}", "left", True, 10))
+    add_line(("", "left", False, 9))
+
+    add_line(("Desglose C$ (cantidades)", "left", True, 10))
+    cs_rows, subtotal_cs_breakdown = _cierre_denomination_rows(detalle_cs)
+    for denom, qty, total in cs_rows:
+        add_line((f"C$ {denom} x {qty} = C$ {format_amount(total)}", "left", False, 9))
+    add_line(("", "left", False, 9))
+    add_line((f"Total desglose C$: {format_amount(subtotal_cs_breakdown)}", "left", True, 10))
+    add_line(("", "left", False, 9))
+    add_line((f"Total C$: {format_amount(cierre.total_efectivo_cs)}", "left", True, 10))
+    add_line((f"Total USD: {format_amount(cierre.total_efectivo_usd)}", "left", True, 10))
+    add_line((f"Total USD equiv: {format_amount(cierre.total_efectivo_usd_equiv)}", "left", True, 10))
+
+    add_line(("-" * 32, "center", False, 9))
+    add_line(("Realizado por: __________________", "left", False, 9))
+    add_line(("Recibido por: ___________________", "left", False, 9))
+    add_line(("Autorizado: _____________________", "left", False, 9))
+
+    width = _TICKET_WIDTH
+    top_margin = bottom_margin = _TICKET_VERTICAL_MARGIN
+    logo_path = _ticket_logo_path(company_profile.get("logo_url", ""), company_profile.get("pos_logo_url", ""))
+    logo_height = _CIERRE_LOGO_HEIGHT if logo_path else 0
+    logo_spacing = _CIERRE_LOGO_SPACING if logo_height else 0
 
     def line_gap(size: int) -> float:
         return size + 5
@@ -3440,14 +3732,13 @@ def _build_cierre_ticket_pdf_bytes(
     total_height += sum(line_gap(size) for _, _, _, size in lines)
     total_height = total_height
 
-    buffer = io.BytesIO()
-    pdf = canvas.Canvas(buffer, pagesize=(width, total_height))
+    pdf = canvas.Canvas(output, pagesize=(width, total_height))
     y = total_height - top_margin
 
     if logo_height:
-        logo_width = 65 * mm
+        logo_width = _CIERRE_LOGO_WIDTH
         pdf.drawImage(
-            str(logo_path),
+            _ticket_logo_reader(str(logo_path)),
             (width - logo_width) / 2,
             y - logo_height,
             width=logo_width,
@@ -3457,25 +3748,29 @@ def _build_cierre_ticket_pdf_bytes(
         )
         y -= logo_height + logo_spacing
 
-    for text, align, bold, size in lines:
-        pdf.setFont("Helvetica-Bold" if bold else "Helvetica", size)
-        if "||" in text:
-            left_text, right_text = text.split("||", 1)
-            pdf.drawString(margin, y, left_text.strip())
-            if right_text.strip():
-                pdf.drawString(width / 2, y, right_text.strip())
-        elif align == "center":
-            pdf.drawCentredString(width / 2, y, text)
-        elif align == "right":
-            pdf.drawRightString(width - margin, y, text)
-        else:
-            pdf.drawString(margin, y, text)
+    current_font = None
+    for font, size, draws in [_cierre_draw_op(*line) for line in lines]:
+        if (font, size) != current_font:
+            pdf.setFont(font, size)
+            current_font = (font, size)
+        for draw, x, text in draws:
+            draw(pdf, x, y, text)
         y -= line_gap(size)
 
     pdf.showPage()
     pdf.save()
-    buffer.seek(0)
-    return buffer.read()
+
+
+def _build_cierre_ticket_pdf_bytes(
+    cierre: CierreCaja,
+    tasa: Decimal,
+    resumen: dict,
+    total_bultos: Decimal,
+    profile: Optional[dict[str, str]] = None,
+) -> bytes:
+    buffer = io.BytesIO()
+    _write_cierre_ticket_pdf(cierre, tasa, resumen, total_bultos, buffer, profile)
+    return buffer.getvalue()
 
 
 def _print_cierre_ticket(
@@ -3491,24 +3786,12 @@ def _print_cierre_ticket(
     sumatra_path = _get_sumatra_path(sumatra_override)
     if not sumatra_path:
         return
-    pdf_bytes = _build_cierre_ticket_pdf_bytes(cierre, tasa, resumen, total_bultos, profile)
     with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-        tmp_file.write(pdf_bytes)
         tmp_path = tmp_file.name
     try:
-        for _ in range(max(copies, 1)):
-            subprocess.run(
-                [
-                    str(sumatra_path),
-                    "-print-to",
-                    printer_name,
-                    "-print-settings",
-                    "noscale",
-                    "-silent",
-                    tmp_path,
-                ],
-                check=False,
-            )
+        with open(tmp_path, "wb") as pdf_file:
+            _write_cierre_ticket_pdf(cierre, tasa, resumen, total_bultos, pdf_file, profile)
+        _sumatra_print(sumatra_path, printer_name, tmp_path, copies)
     finally:
         try:
             Path(tmp_path).unlink(missing_ok=True)
@@ -3516,11 +3799,12 @@ def _print_cierre_ticket(
             pass
 
 
-def _generate_token(length: int = 6) -> str:
-    import random
-    import string
+_TOKEN_ALPHABET = "0123456789"
 
-    return "".join(random.choice(string.digits) for _ in range(length))
+
+def _generate_token(length: int = 6) -> str:
+    # Autoriza reversiones y descuentos: se usa un generador criptografico.
+    return "".join(secrets.choice(_TOKEN_ALPHABET) for _ in range(length))
 
 
 def _discount_percent_value(value: object) -> Decimal:
@@ -3704,6 +3988,67 @@ def _resolve_weight_unit(
     return None
 
 
+# Sesiones SMTP reutilizadas entre envios (TLS + AUTH solo la primera vez).
+# smtplib no es thread-safe: el lock solo protege el diccionario; una conexion
+# sacada del pool es exclusiva del hilo que la tomo hasta que la devuelve.
+_smtp_pool: dict[tuple[str, int, str], smtplib.SMTP] = {}
+_smtp_pool_lock = Lock()
+_SMTP_TIMEOUT_SECONDS = 30
+
+
+def _close_smtp_pool() -> None:
+    with _smtp_pool_lock:
+        for smtp in _smtp_pool.values():
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp.close()
+        _smtp_pool.clear()
+
+
+atexit.register(_close_smtp_pool)
+
+
+def _send_smtp_message(config: dict, message: EmailMessage) -> None:
+    key = (config["host"], config["port"], config["user"])
+    with _smtp_pool_lock:
+        smtp = _smtp_pool.pop(key, None)
+    if smtp is not None:
+        try:
+            if smtp.noop()[0] != 250:
+                raise smtplib.SMTPServerDisconnected("noop")
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+            smtp = None
+    if smtp is None:
+        smtp = smtplib.SMTP(config["host"], config["port"], timeout=_SMTP_TIMEOUT_SECONDS)
+        try:
+            smtp.starttls()
+            smtp.login(config["user"], config["password"])
+        except Exception:
+            smtp.close()
+            raise
+    try:
+        smtp.send_message(message)
+    except Exception:
+        smtp.close()
+        raise
+    with _smtp_pool_lock:
+        pooled = _smtp_pool.setdefault(key, smtp)
+    if pooled is not smtp:
+        # Otro hilo ya devolvio una conexion para el mismo servidor.
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+
+@lru_cache(maxsize=4)
+def _cached_env_values(path_str: str, mtime: float) -> dict[str, Optional[str]]:
+    # La fecha de modificacion va en la clave: si editan el .env se vuelve a leer.
+    return dict(dotenv_values(path_str))
+
+
 def _send_reversion_email(
     subject: str,
     html_body: str,
@@ -3735,8 +4080,8 @@ def _send_html_email(
     smtp_host = settings.SMTP_HOST
     smtp_port = settings.SMTP_PORT
     if not smtp_user or not smtp_password:
-        env_path = Path(__file__).resolve().parents[2] / ".env"
-        env_values = dotenv_values(env_path)
+        env_path = _ENV_PATH
+        env_values = _cached_env_values(str(env_path), env_path.stat().st_mtime if env_path.exists() else 0.0)
         def _env_get(key: str) -> str:
             return (env_values.get(key) or env_values.get(f"\ufeff{key}") or "").strip()
         smtp_user = smtp_user or _env_get("SMTP_USER")
@@ -3789,14 +4134,19 @@ def _send_html_email(
             continue
 
     try:
-        with smtplib.SMTP(config["host"], config["port"]) as smtp:
-            smtp.starttls()
-            smtp.login(config["user"], config["password"])
-            smtp.send_message(message)
+        _send_smtp_message(config, message)
     except Exception as exc:
         return f"Error SMTP: {exc.__class__.__name__}"
     return None
 
+@lru_cache(maxsize=64)
+def _cookie_domain_for(host: str) -> Optional[str]:
+    # Comparte la cookie entre subdominios; en localhost o IP local no se fija dominio.
+    if not host or host in {"localhost", "127.0.0.1"} or host.count(".") < 1:
+        return None
+    return f".{host.split('.', 1)[1]}"
+
+
 @router.get("/login")
 def login_page(request: Request):
     return request.app.state.templates.TemplateResponse(
@@ -3848,10 +4198,7 @@ def login_action(
     response = RedirectResponse("/home", status_code=302)
     max_age = int(expires.total_seconds())
     expires_at = datetime.now(timezone.utc) + expires
-    host = request.url.hostname or ""
-    cookie_domain = None
-    if host and host not in {"localhost", "127.0.0.1"} and host.count(".") >= 1:
-        cookie_domain = f".{host.split('.', 1)[1]}"
+    cookie_domain = _cookie_domain_for(request.url.hostname or "")
     response.set_cookie(
         "access_token",
         token,
@@ -3868,10 +4215,7 @@ def login_action(
 @router.get("/logout")
 def logout(request: Request):
     response = RedirectResponse("/login", status_code=302)
-    host = request.url.hostname or ""
-    cookie_domain = None
-    if host and host not in {"localhost", "127.0.0.1"} and host.count(".") >= 1:
-        cookie_domain = f".{host.split('.', 1)[1]}"
+    cookie_domain = _cookie_domain_for(request.url.hostname or "")
     response.delete_cookie("access_token", path="/", domain=cookie_domain)
     return response
 
@@ -4307,6 +4651,18 @@ def _terms_from_csv(value: Optional[str], fallback: list[str]) -> list[str]:
 
 
 def _get_accounting_policy(db: Session) -> dict:
+    # Se consulta en cada venta/movimiento: se memoriza en la sesion (una por
+    # request) y no en el cache por proceso, para que un cambio guardado en un
+    # worker se vea de inmediato en los demas.
+    cached = db.info.get("accounting_policy")
+    if cached is None:
+        cached = _get_accounting_policy_uncached(db)
+        db.info["accounting_policy"] = cached
+    # Se copian tambien las listas de terminos: el llamador puede modificarlas.
+    return {key: list(value) if isinstance(value, list) else value for key, value in cached.items()}
+
+
+def _get_accounting_policy_uncached(db: Session) -> dict:
     row = db.query(AccountingPolicySetting).order_by(AccountingPolicySetting.id.asc()).first()
     defaults = {
         "strict_mode": True,
@@ -6292,6 +6648,13 @@ def _auto_accounting_entry_exists(db: Session, reference: str) -> bool:
     )
 
 
+_AUTO_ENTRY_VOUCHER_CODES = {
+    "SALE": "INGRESO",
+    "SALE_COST": "DIARIO",
+    "PAYROLL": "DIARIO",
+}
+
+
 def _build_auto_accounting_entry(
     db: Session,
     *,
@@ -6310,9 +6673,7 @@ def _build_auto_accounting_entry(
     if _auto_accounting_entry_exists(db, reference):
         return None
 
-    voucher_code = "INGRESO" if event_code == "SALE" else "EGRESO"
-    if event_code in {"SALE_COST", "PAYROLL"}:
-        voucher_code = "DIARIO"
+    voucher_code = _AUTO_ENTRY_VOUCHER_CODES.get(event_code, "EGRESO")
     voucher_type = _find_voucher_type_for_code(db, voucher_code)
     if not voucher_type:
         return None
@@ -6383,6 +6744,39 @@ def _build_auto_accounting_entry(
     return entry
 
 
+def _post_auto_accounting_entry(
+    *,
+    event_code: str,
+    branch_id: Optional[int],
+    entry_date: date,
+    amount: Decimal,
+    reference: str,
+    description: str,
+) -> None:
+    # Se ejecuta como tarea de fondo, despues de responder; usa su propia sesion.
+    db = get_session_local()()
+    try:
+        entry = _build_auto_accounting_entry(
+            db,
+            event_code=event_code,
+            branch_id=branch_id,
+            entry_date=entry_date,
+            amount=amount,
+            reference=reference,
+            description=description,
+        )
+        if entry:
+            db.add(entry)
+            db.commit()
+    except Exception:
+        # El movimiento ya quedo confirmado: se relanza para que el error quede
+        # en el log de la tarea de fondo.
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
 def _build_sale_accounting_entries(
     db: Session,
     *,
@@ -7408,6 +7802,7 @@ def accounting_policy_update(
     row.egreso_haber_terms = (egreso_haber_terms or "").strip()
     row.updated_by = user.email
     db.commit()
+    db.info.pop("accounting_policy", None)
     return RedirectResponse("/accounting/financial-data?success=Politicas+contables+actualizadas", status_code=303)
 
 
@@ -9104,7 +9499,6 @@ def inventory_page(
         for row in db.query(ProductoComision).filter(ProductoComision.producto_id.in_(product_ids)).all()
     } if product_ids else {}
     bodega_ids = [b.id for b in bodegas]
-    balances = _balances_by_bodega(db, bodega_ids, product_ids)
     selected_bodega_id: Optional[int] = None
     raw_bodega_id = (request.query_params.get("bodega_id") or "").strip()
     if raw_bodega_id:
@@ -9119,23 +9513,20 @@ def inventory_page(
         current_bodega = bodegas[0]
     current_bodega_saldos: dict[int, float] = {}
     if current_bodega:
+        # Solo la bodega actual necesita el saldo por producto; los totales de
+        # las tarjetas salen agregados por bodega desde SQL.
+        current_balances = (
+            _balances_by_bodega(db, [current_bodega.id], product_ids)
+            if current_bodega.id in bodega_ids
+            else {}
+        )
         for producto in productos:
-            current_bodega_saldos[producto.id] = float(balances.get((producto.id, current_bodega.id), Decimal("0")) or 0)
-    def _sum_for_bodega(bodega: Optional[Bodega]) -> tuple[Decimal, int]:
-        if not bodega:
-            return Decimal("0"), 0
-        total_qty = Decimal("0")
-        count_items = 0
-        for producto in productos:
-            qty = balances.get((producto.id, bodega.id), Decimal("0"))
-            total_qty += qty
-            if qty > 0:
-                count_items += 1
-        return total_qty, count_items
+            current_bodega_saldos[producto.id] = float(current_balances.get((producto.id, current_bodega.id), 0) or 0)
+    bodega_totals, total_global_items = _bodega_balance_totals(db, bodega_ids, product_ids)
 
     bodega_summary_cards: list[dict[str, object]] = []
     for bodega in bodegas:
-        total_qty, count_items = _sum_for_bodega(bodega)
+        total_qty, count_items = bodega_totals.get(bodega.id, (Decimal("0"), 0))
         bodega_summary_cards.append(
             {
                 "id": int(bodega.id),
@@ -9146,13 +9537,6 @@ def inventory_page(
             }
         )
     total_global_qty = sum(Decimal(str(card["qty"])) for card in bodega_summary_cards)
-    total_global_items = len(
-        {
-            p.id
-            for p in productos
-            if any(balances.get((p.id, bodega.id), Decimal("0")) > 0 for bodega in bodegas)
-        }
-    )
     inventory_cs_only = _inventory_cs_only_mode(db)
     recipe_explosion_on_ingreso = _recipe_explosion_on_ingreso_mode(db)
     weighted_inventory_enabled = _weighted_inventory_enabled_mode(db)
@@ -10743,14 +11127,7 @@ def inventory_ingresos_page(
     )
     product_ids = [p.id for p in productos]
     bodega_ids = [b.id for b in bodegas]
-    balances = _balances_by_bodega(db, bodega_ids, product_ids)
-    saldos_por_bodega: dict[int, dict[int, float]] = {}
-    for producto in productos:
-        per_bodega: dict[int, float] = {}
-        for bodega in bodegas:
-            qty = balances.get((producto.id, bodega.id), Decimal("0"))
-            per_bodega[bodega.id] = float(qty or 0)
-        saldos_por_bodega[producto.id] = per_bodega
+    saldos_por_bodega = _saldos_por_bodega_matrix(db, bodega_ids, product_ids)
     lineas = db.query(Linea).order_by(Linea.linea).all()
     segmentos = db.query(Segmento).order_by(Segmento.segmento).all()
     marcas = db.query(Marca).filter(Marca.activo.is_(True)).order_by(Marca.nombre).all()
@@ -10896,14 +11273,7 @@ def inventory_egresos_page(
     )
     product_ids = [p.id for p in productos]
     bodega_ids = [b.id for b in bodegas]
-    balances = _balances_by_bodega(db, bodega_ids, product_ids)
-    saldos_por_bodega: dict[int, dict[int, float]] = {}
-    for producto in productos:
-        per_bodega: dict[int, float] = {}
-        for bodega in bodegas:
-            qty = balances.get((producto.id, bodega.id), Decimal("0"))
-            per_bodega[bodega.id] = float(qty or 0)
-        saldos_por_bodega[producto.id] = per_bodega
+    saldos_por_bodega = _saldos_por_bodega_matrix(db, bodega_ids, product_ids)
     error = request.query_params.get("error")
     success = request.query_params.get("success")
     print_id = request.query_params.get("print_id")
@@ -11160,7 +11530,7 @@ def sales_page(
     branch, bodega = _resolve_branch_bodega(db, user)
     if bodega and not _bodega_permite_facturacion(bodega):
         error = error or "La bodega operativa no esta habilitada para facturacion"
-    vendedores = _vendedores_for_bodega(db, bodega)
+    vendedores, default_vendedor_id = _vendedores_with_default(db, bodega)
     next_invoice = None
     if branch and bodega:
         last_factura = (
@@ -11324,7 +11694,7 @@ def sales_page(
             "print_id": print_id,
             "next_invoice": next_invoice,
             "pos_print": pos_print,
-            "default_vendedor_id": _default_vendedor_id(db, bodega),
+            "default_vendedor_id": default_vendedor_id,
             "initial_preventa": initial_preventa,
             "restaurant_orders": restaurant_orders,
             "restaurant_tables": restaurant_tables,
@@ -11873,8 +12243,7 @@ def mobile_preventas_page(
     branch, bodega = _resolve_branch_bodega(db, user)
     if not branch or not bodega:
         raise HTTPException(status_code=400, detail="Usuario sin sucursal/bodega asignada")
-    vendedores = _vendedores_for_bodega(db, bodega)
-    default_vendedor_id = _default_vendedor_id(db, bodega)
+    vendedores, default_vendedor_id = _vendedores_with_default(db, bodega)
     vendedor_user_id = _vendedor_id_for_user(db, user, bodega)
     if vendedor_user_id:
         default_vendedor_id = vendedor_user_id
@@ -12780,7 +13149,7 @@ async def mobile_preventas_push_unsubscribe(
 
 @router.get("/m-preventas-sw.js")
 def mobile_preventas_service_worker():
-    sw_path = Path(__file__).resolve().parents[1] / "static" / "m_preventas_sw.js"
+    sw_path = _STATIC_DIR / "m_preventas_sw.js"
     if not sw_path.exists():
         raise HTTPException(status_code=404, detail="Service worker no disponible")
     return Response(
@@ -13812,7 +14181,7 @@ async def sales_etiquetas_upload_background(
     if len(payload) > 15 * 1024 * 1024:
         return JSONResponse({"ok": False, "message": "Archivo excede 15MB"}, status_code=400)
 
-    labels_dir = Path(__file__).resolve().parents[1] / "static" / "labels"
+    labels_dir = _STATIC_DIR / "labels"
     labels_dir.mkdir(parents=True, exist_ok=True)
     base_name = format_map[key]
     out_path = labels_dir / f"{base_name}{ext}"
@@ -16358,13 +16727,13 @@ def sales_cierre(
     total_creditos_usd = Decimal("0")
     for factura in creditos:
         if (factura.moneda or "CS") == "USD":
-            paid_usd = sum(Decimal(str(a.monto_usd or 0)) for a in factura.abonos)
+            paid_usd = sum((a.monto_usd or Decimal("0") for a in factura.abonos), Decimal("0"))
             due_usd = Decimal(str(factura.total_usd or 0))
             saldo_usd = max(due_usd - paid_usd, Decimal("0"))
             if saldo_usd > 0:
                 total_creditos_usd += saldo_usd
         else:
-            paid_cs = sum(Decimal(str(a.monto_cs or 0)) for a in factura.abonos)
+            paid_cs = sum((a.monto_cs or Decimal("0") for a in factura.abonos), Decimal("0"))
             due_cs = Decimal(str(factura.total_cs or 0))
             saldo_cs = max(due_cs - paid_cs, Decimal("0"))
             if saldo_cs > 0:
@@ -16532,13 +16901,13 @@ async def sales_cierre_create(
     total_creditos_usd = Decimal("0")
     for factura in creditos:
         if (factura.moneda or "CS") == "USD":
-            paid_usd = sum(Decimal(str(a.monto_usd or 0)) for a in factura.abonos)
+            paid_usd = sum((a.monto_usd or Decimal("0") for a in factura.abonos), Decimal("0"))
             due_usd = Decimal(str(factura.total_usd or 0))
             saldo_usd = max(due_usd - paid_usd, Decimal("0"))
             if saldo_usd > 0:
                 total_creditos_usd += saldo_usd
         else:
-            paid_cs = sum(Decimal(str(a.monto_cs or 0)) for a in factura.abonos)
+            paid_cs = sum((a.monto_cs or Decimal("0") for a in factura.abonos), Decimal("0"))
             due_cs = Decimal(str(factura.total_cs or 0))
             saldo_cs = max(due_cs - paid_cs, Decimal("0"))
             if saldo_cs > 0:
@@ -16649,7 +17018,8 @@ async def sales_cierre_create(
                 "creditos_usd": total_creditos_usd,
                 "total_calculado_usd": total_calculado_usd,
             }
-            _print_cierre_ticket(
+            await run_in_threadpool(
+                _print_cierre_ticket,
                 cierre,
                 tasa,
                 resumen,
@@ -16796,7 +17166,7 @@ async def sales_roc_create(
     )
     next_seq = (last_recibo.secuencia if last_recibo else 0) + 1
     branch_code = (branch.code or "").lower()
-    prefix = "ROC-C" if branch_code == "central" else "ROC-E" if branch_code == "esteli" else f"ROC-{branch_code[:1].upper()}"
+    prefix = f"ROC-{_BRANCH_SERIES_LETTERS.get(branch_code) or branch_code[:1].upper()}"
     numero = f"{prefix}-{next_seq:05d}"
 
     monto_usd = Decimal("0")
@@ -16863,7 +17233,8 @@ async def sales_roc_create(
     if pos_print and pos_print.roc_auto_print:
         try:
             company_profile = _company_profile_payload(db)
-            _print_roc_ticket(
+            await run_in_threadpool(
+                _print_roc_ticket,
                 recibo,
                 pos_print.roc_printer_name or pos_print.printer_name,
                 pos_print.roc_copies or pos_print.copies,
@@ -16883,7 +17254,7 @@ def sales_roc_pdf(
     user: User = Depends(_require_admin_web),
 ):
     _enforce_permission(request, user, "access.sales.roc")
-    recibo = db.query(ReciboCaja).filter(ReciboCaja.id == recibo_id).first()
+    recibo = _load_recibo_for_ticket(db, recibo_id)
     if not recibo:
         return JSONResponse({"ok": False, "message": "Recibo no encontrado"}, status_code=404)
     _, bodega = _resolve_branch_bodega(db, user)
@@ -23693,12 +24064,12 @@ def report_sales_export(
             moneda = factura.moneda or 'CS'
             tasa = Decimal(str(factura.tasa_cambio or 0))
             if moneda == 'USD':
-                paid_usd = sum(Decimal(str(a.monto_usd or 0)) for a in factura.abonos)
+                paid_usd = sum((a.monto_usd or Decimal("0") for a in factura.abonos), Decimal("0"))
                 due_usd = Decimal(str(factura.total_usd or 0))
                 saldo_usd = max(due_usd - paid_usd, Decimal('0'))
                 total_creditos_usd += saldo_usd
             else:
-                paid_cs = sum(Decimal(str(a.monto_cs or 0)) for a in factura.abonos)
+                paid_cs = sum((a.monto_cs or Decimal("0") for a in factura.abonos), Decimal("0"))
                 due_cs = Decimal(str(factura.total_cs or 0))
                 saldo_cs = max(due_cs - paid_cs, Decimal('0'))
                 total_creditos_usd += to_usd('CS', saldo_cs, Decimal('0'), tasa, factura.fecha)
@@ -24363,31 +24734,7 @@ async def sales_depositos_create(
     if moneda not in {"CS", "USD"}:
         return RedirectResponse("/sales/depositos?error=Moneda+no+valida", status_code=303)
 
-    def parse_decimal(value: str) -> Decimal:
-        raw = re.sub(r"[^0-9.,-]", "", str(value or "0"))
-        if "," in raw and "." in raw:
-            if raw.rfind(",") > raw.rfind("."):
-                raw = raw.replace(".", "").replace(",", ".")
-            else:
-                raw = raw.replace(",", "")
-        elif "," in raw and "." not in raw:
-            parts = raw.split(",")
-            if len(parts) == 2 and len(parts[1]) == 2:
-                raw = raw.replace(",", ".")
-            else:
-                raw = raw.replace(",", "")
-        elif "." in raw and "," not in raw:
-            parts = raw.split(".")
-            if len(parts) == 2 and len(parts[1]) == 2:
-                raw = raw
-            else:
-                raw = raw.replace(".", "")
-        try:
-            return Decimal(raw)
-        except Exception:
-            return Decimal("0")
-
-    monto = parse_decimal(monto_raw)
+    monto = _parse_money_decimal(monto_raw)
     if monto <= 0:
         return RedirectResponse("/sales/depositos?error=Monto+no+valido", status_code=303)
 
@@ -24595,7 +24942,7 @@ def sales_print_pos_direct(
     user: User = Depends(_require_admin_web),
 ):
     _enforce_permission(request, user, "access.sales")
-    factura = db.query(VentaFactura).filter(VentaFactura.id == venta_id).first()
+    factura = _load_factura_for_ticket(db, venta_id)
     if not factura or not factura.bodega or not factura.bodega.branch:
         return JSONResponse({"ok": False, "message": "Factura no encontrada"}, status_code=404)
 
@@ -25589,6 +25936,7 @@ def data_entornos_create(
         if activate_now or normalized_key == get_active_company_key():
             refresh_engine(force=True)
             init_db()
+            _invalidate_settings_cache()
     except ValueError as exc:
         return RedirectResponse(f"/data/entornos?{urlencode({'error': str(exc)})}", status_code=303)
 
@@ -25627,6 +25975,7 @@ def data_entornos_update(
         if activate_now or normalized_key == get_active_company_key():
             refresh_engine(force=True)
             init_db()
+            _invalidate_settings_cache()
     except ValueError as exc:
         return RedirectResponse(f"/data/entornos?{urlencode({'error': str(exc)})}", status_code=303)
 
@@ -25656,6 +26005,7 @@ def data_entornos_activate(
     set_active_company(normalized_key)
     refresh_engine(force=True)
     init_db()
+    _invalidate_settings_cache()
     return RedirectResponse("/data/entornos?success=Empresa+activa+actualizada", status_code=303)
 
 
@@ -25818,6 +26168,7 @@ async def data_empresa_update(
     profile.theme_code = selected_theme
     profile.updated_by = user.full_name
     db.commit()
+    _invalidate_settings_cache("inventory_cs_only")
     return RedirectResponse("/data/empresa?success=Perfil+empresarial+actualizado", status_code=303)
 
 
@@ -27168,7 +27519,7 @@ def data_create_usuario(
     email = email.strip().lower()
     if not full_name or not email or not password:
         return RedirectResponse("/data/usuarios?error=Datos+incompletos", status_code=303)
-    exists = db.query(User).filter(func.lower(User.email) == email).first()
+    exists = db.query(User).filter(User.email == email).first()
     if exists:
         return RedirectResponse("/data/usuarios?error=Email+ya+existe", status_code=303)
     roles = []
@@ -28910,11 +29261,7 @@ def sales_ticket_pos(
     except ImportError as exc:
         raise HTTPException(status_code=500, detail="ReportLab no esta instalado") from exc
 
-    factura = (
-        db.query(VentaFactura)
-        .filter(VentaFactura.id == venta_id)
-        .first()
-    )
+    factura = _load_factura_for_ticket(db, venta_id)
     if not factura:
         raise HTTPException(status_code=404, detail="Factura no encontrada")
 
@@ -28948,24 +29295,6 @@ def sales_ticket_print(
     if not factura:
         raise HTTPException(status_code=404, detail="Factura no encontrada")
 
-    def wrap_text(text: str, max_chars: int) -> list[str]:
-        if not text:
-            return [""]
-        words = text.split()
-        lines: list[str] = []
-        current = ""
-        for word in words:
-            candidate = f"{current} {word}".strip()
-            if len(candidate) > max_chars:
-                if current:
-                    lines.append(current)
-                current = word
-            else:
-                current = candidate
-        if current:
-            lines.append(current)
-        return lines or [text]
-
     profile = _company_profile_payload(db)
     branch = factura.bodega.branch if factura.bodega else None
     identity = _company_identity(branch, profile)
@@ -28973,7 +29302,7 @@ def sales_ticket_print(
     ruc = identity["ruc"]
     telefono = identity["telefono"]
     direccion = identity["direccion"]
-    direccion_lines = wrap_text(direccion, 32)[:2]
+    direccion_lines = _wrap_ticket_text(direccion, 32)[:2]
     sucursal = identity["sucursal"]
 
     cliente = factura.cliente.nombre if factura.cliente else "Consumidor final"
@@ -29008,9 +29337,6 @@ def sales_ticket_print(
     )
     saldo = total_paid - total_amount
 
-    def format_amount(value: float) -> str:
-        return f"{value:,.2f}"
-
     active_company_key = (get_active_company_key() or "").strip().lower()
     db_name = _current_db_name().strip().lower()
     is_amajo_mode = (
@@ -29058,7 +29384,7 @@ def sales_ticket_print(
             color_name = item.variante.color.nombre if item.variante.color else "-"
             talla_name = item.variante.talla or "-"
             descripcion = f"{descripcion} [{color_name} / Talla {talla_name}]"
-        desc_lines = wrap_text(descripcion, 32)
+        desc_lines = _wrap_ticket_text(descripcion, 32)
         if show_item_code:
             line_count += 1  # codigo
         line_count += len(desc_lines)
@@ -29096,12 +29422,12 @@ def sales_ticket_print(
         monto_original = float(getattr(pago, "monto_original", 0) or 0)
         if monto_original <= 0:
             monto_original = float(pago.monto_usd or 0) if pago_moneda == "USD" else float(pago.monto_cs or 0)
-        amount_label = f"$ {format_amount(monto_original)}" if pago_moneda == "USD" else f"C$ {format_amount(monto_original)}"
+        amount_label = f"$ {_format_ticket_amount(monto_original)}" if pago_moneda == "USD" else f"C$ {_format_ticket_amount(monto_original)}"
         equivalent_label = ""
         if pago_moneda == "USD" and float(pago.monto_cs or 0) > 0:
-            equivalent_label = f"C$ {format_amount(float(pago.monto_cs or 0))}"
+            equivalent_label = f"C$ {_format_ticket_amount(float(pago.monto_cs or 0))}"
         elif pago_moneda == "CS" and float(pago.monto_usd or 0) > 0:
-            equivalent_label = f"$ {format_amount(float(pago.monto_usd or 0))}"
+            equivalent_label = f"$ {_format_ticket_amount(float(pago.monto_usd or 0))}"
         pagos_render.append({
             "label": label,
             "moneda": pago_moneda,
@@ -29154,7 +29480,7 @@ def sales_ticket_print(
             "total_unidades": total_unidades,
             "items": items,
             "pagos": pagos_render,
-            "format_amount": format_amount,
+            "format_amount": _format_ticket_amount,
             "copies": copies,
             "page_height_mm": page_height_mm,
             "compact_ticket": is_amajo_mode,
@@ -29975,6 +30301,19 @@ def inventory_product_combo_list(
         return JSONResponse({"ok": False, "message": "Producto no encontrado"}, status_code=404)
     combos = (
         db.query(ProductoCombo)
+        .options(
+            load_only(ProductoCombo.id, ProductoCombo.cantidad),
+            joinedload(ProductoCombo.child)
+            .load_only(
+                Producto.id,
+                Producto.cod_producto,
+                Producto.descripcion,
+                Producto.precio_venta1,
+                Producto.precio_venta1_usd,
+            )
+            .joinedload(Producto.saldo)
+            .load_only(SaldoProducto.existencia),
+        )
         .filter(ProductoCombo.parent_producto_id == product_id)
         .order_by(ProductoCombo.id)
         .all()
@@ -29994,7 +30333,7 @@ def inventory_product_combo_list(
                 "existencia": float(child.saldo.existencia or 0) if child and child.saldo else 0.0,
             }
         )
-    return JSONResponse({"ok": True, "items": items})
+    return ORJSONResponse({"ok": True, "items": items})
 
 
 @router.post("/inventory/product/{product_id}/combo")
@@ -30104,18 +30443,19 @@ def inventory_create_linea(
         target = redirect_to or "/inventory"
         return RedirectResponse(f"{target}?error=Linea+ya+existe", status_code=303)
     # Codigo de linea 100% automatico, independiente del input del usuario.
-    base_code = re.sub(r"[^A-Za-z0-9]+", "_", linea.upper()).strip("_")
+    base_code = _CODE_SLUG_RE.sub("_", linea.upper()).strip("_")
     if not base_code:
         base_code = "LINEA"
     base_code = base_code[:40]
     generated_code = base_code
+    taken_codes = {
+        (code or "").lower()
+        for (code,) in db.query(Linea.cod_linea)
+        .filter(func.lower(Linea.cod_linea).like(f"{base_code.lower()}%"))
+        .all()
+    }
     seq = 2
-    while (
-        db.query(Linea)
-        .filter(func.lower(Linea.cod_linea) == generated_code.lower())
-        .first()
-        is not None
-    ):
+    while generated_code.lower() in taken_codes:
         suffix = f"_{seq}"
         generated_code = f"{base_code[: max(1, 50 - len(suffix))]}{suffix}"
         seq += 1
@@ -30275,9 +30615,10 @@ def inventory_create_proveedor(
     db: Session = Depends(get_db),
     _: User = Depends(_require_admin_web),
 ):
+    is_fetch = request.headers.get("x-requested-with") == "fetch"
     nombre = nombre.strip()
     if not nombre:
-        if request.headers.get("X-Requested-With") == "fetch":
+        if is_fetch:
             return JSONResponse({"ok": False, "message": "Nombre requerido"}, status_code=400)
         return RedirectResponse(redirect_to or "/inventory/ingresos", status_code=303)
     exists = db.query(Proveedor).filter(func.lower(Proveedor.nombre) == nombre.lower()).first()
@@ -30285,7 +30626,7 @@ def inventory_create_proveedor(
         proveedor = Proveedor(nombre=nombre, tipo=tipo, activo=activo == "on")
         db.add(proveedor)
         db.commit()
-        if request.headers.get("X-Requested-With") == "fetch":
+        if is_fetch:
             return JSONResponse(
                 {
                     "ok": True,
@@ -30295,7 +30636,7 @@ def inventory_create_proveedor(
                     "activo": proveedor.activo,
                 }
             )
-    if request.headers.get("X-Requested-With") == "fetch":
+    if is_fetch:
         return JSONResponse({"ok": False, "message": "Proveedor ya existe"}, status_code=409)
     return RedirectResponse(redirect_to or "/inventory/ingresos", status_code=303)
 
@@ -30311,13 +30652,14 @@ def inventory_update_proveedor(
     db: Session = Depends(get_db),
     _: User = Depends(_require_admin_web),
 ):
+    is_fetch = request.headers.get("x-requested-with") == "fetch"
     proveedor_obj = db.query(Proveedor).filter(Proveedor.id == proveedor_id).first()
     if proveedor_obj:
         proveedor_obj.nombre = nombre.strip()
         proveedor_obj.tipo = tipo
         proveedor_obj.activo = activo == "on"
         db.commit()
-        if request.headers.get("X-Requested-With") == "fetch":
+        if is_fetch:
             return JSONResponse(
                 {
                     "ok": True,
@@ -30327,7 +30669,7 @@ def inventory_update_proveedor(
                     "activo": proveedor_obj.activo,
                 }
             )
-    if request.headers.get("X-Requested-With") == "fetch":
+    if is_fetch:
         return JSONResponse({"ok": False, "message": "Proveedor no encontrado"}, status_code=404)
     return RedirectResponse(redirect_to or "/inventory/ingresos", status_code=303)
 
@@ -30840,6 +31182,7 @@ async def inventory_create_ingreso_zapatos(
 @router.post("/inventory/ingresos")
 async def inventory_create_ingreso(
     request: Request,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     user: User = Depends(_require_admin_web),
 ):
@@ -30878,13 +31221,9 @@ async def inventory_create_ingreso(
         )
     if tipo.requiere_proveedor and not proveedor_id:
         return RedirectResponse("/inventory/ingresos?error=Proveedor+requerido", status_code=303)
+    bodega_obj = db.query(Bodega).filter(Bodega.id == int(bodega_id)).first()
 
-    rate_today = (
-        db.query(ExchangeRate)
-        .filter(ExchangeRate.effective_date <= local_today())
-        .order_by(ExchangeRate.effective_date.desc())
-        .first()
-    )
+    rate_today = _latest_exchange_rate(db, request)
     if moneda == "USD" and not rate_today:
         return RedirectResponse("/inventory/ingresos?error=Tasa+de+cambio+no+configurada", status_code=303)
 
@@ -30899,6 +31238,19 @@ async def inventory_create_ingreso(
     def to_decimal(value: Optional[float]) -> Decimal:
         return Decimal(str(value or 0))
 
+    item_product_ids = {int(pid) for pid in item_ids if str(pid or "").isdigit()}
+    productos_by_id = (
+        {
+            p.id: p
+            for p in db.query(Producto)
+            .options(joinedload(Producto.saldo))
+            .filter(Producto.id.in_(item_product_ids))
+            .all()
+        }
+        if item_product_ids
+        else {}
+    )
+
     def _build_recipe_requirements() -> tuple[dict[int, dict[str, object]], Optional[str]]:
         if not _recipe_explosion_on_ingreso_mode(db):
             return {}, None
@@ -30909,7 +31261,7 @@ async def inventory_create_ingreso(
             qty = to_float(item_qtys[index] if index < len(item_qtys) else 0)
             if qty <= 0:
                 continue
-            producto = db.query(Producto).filter(Producto.id == int(product_id)).first()
+            producto = productos_by_id.get(int(product_id))
             if not producto:
                 return {}, "Producto no encontrado en ingreso"
             if (producto.tipo_producto or "DIRECTO").upper() != "RECETA":
@@ -30969,10 +31321,9 @@ async def inventory_create_ingreso(
         if not egreso_tipo:
             egreso_tipo = EgresoTipo(nombre="Produccion por receta")
             db.add(egreso_tipo)
-            db.flush()
 
         egreso = EgresoInventario(
-            tipo_id=egreso_tipo.id,
+            tipo=egreso_tipo,
             bodega_id=bodega_id_value,
             bodega_destino_id=None,
             fecha=fecha_ref,
@@ -31037,6 +31388,7 @@ async def inventory_create_ingreso(
 
     total_usd = 0.0
     total_cs = 0.0
+    ingreso_items: list[dict] = []
     for index, product_id in enumerate(item_ids):
         qty = to_float(item_qtys[index] if index < len(item_qtys) else 0)
         cost = to_float(item_costs[index] if index < len(item_costs) else 0)
@@ -31073,22 +31425,22 @@ async def inventory_create_ingreso(
         total_usd += subtotal_usd
         total_cs += subtotal_cs
 
-        item = IngresoItem(
-            ingreso_id=ingreso.id,
-            producto_id=int(product_id),
-            cantidad=qty,
-            costo_unitario_usd=costo_usd,
-            costo_unitario_cs=costo_cs,
-            subtotal_usd=subtotal_usd,
-            subtotal_cs=subtotal_cs,
+        ingreso_items.append(
+            {
+                "ingreso_id": ingreso.id,
+                "producto_id": int(product_id),
+                "cantidad": qty,
+                "costo_unitario_usd": costo_usd,
+                "costo_unitario_cs": costo_cs,
+                "subtotal_usd": subtotal_usd,
+                "subtotal_cs": subtotal_cs,
+            }
         )
-        db.add(item)
 
-        producto = db.query(Producto).filter(Producto.id == int(product_id)).first()
+        producto = productos_by_id.get(int(product_id))
         if producto:
             if producto.saldo:
-                current = Decimal(str(producto.saldo.existencia or 0))
-                producto.saldo.existencia = current + qty_dec
+                producto.saldo.existencia = (producto.saldo.existencia or Decimal("0")) + qty_dec
             else:
                 db.add(SaldoProducto(producto_id=producto.id, existencia=qty_dec))
             if cost > 0:
@@ -31101,6 +31453,8 @@ async def inventory_create_ingreso(
                     producto.precio_venta1_usd = precio_usd
                 if tasa > 0:
                     producto.tasa_cambio = tasa
+    if ingreso_items:
+        db.execute(insert(IngresoItem), ingreso_items)
 
     recipe_apply_error = _apply_recipe_explosion(
         ingreso_obj=ingreso,
@@ -31115,19 +31469,15 @@ async def inventory_create_ingreso(
 
     ingreso.total_usd = total_usd
     ingreso.total_cs = total_cs
-    bodega_obj = db.query(Bodega).filter(Bodega.id == int(bodega_id)).first()
-    auto_amount = to_decimal(total_cs)
-    auto_entry = _build_auto_accounting_entry(
-        db,
+    background_tasks.add_task(
+        _post_auto_accounting_entry,
         event_code="INV_IN",
         branch_id=bodega_obj.branch_id if bodega_obj else None,
         entry_date=fecha_value,
-        amount=auto_amount,
+        amount=to_decimal(total_cs),
         reference=f"AUTO-ING-{ingreso.id}",
         description=f"Asiento automatico por ingreso inventario #{ingreso.id}",
     )
-    if auto_entry:
-        db.add(auto_entry)
     db.commit()
     if _is_shoes_mode():
         return RedirectResponse(
@@ -31143,6 +31493,7 @@ async def inventory_create_ingreso(
 @router.post("/inventory/egresos")
 async def inventory_create_egreso(
     request: Request,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     user: User = Depends(_require_admin_web),
 ):
@@ -31183,6 +31534,7 @@ async def inventory_create_egreso(
         return RedirectResponse(f"{redirect_to}?error=Tipo+no+valido", status_code=303)
     es_traslado = "traslado" in (tipo.nombre or "").lower()
     es_abierta = "produccion de abierta" in (tipo.nombre or "").lower()
+    bodega_obj = db.query(Bodega).filter(Bodega.id == int(bodega_id)).first()
     bodega_destino_obj = None
     if es_traslado:
         moneda = "CS"
@@ -31203,12 +31555,7 @@ async def inventory_create_egreso(
             # El ingreso puede ir a una bodega no facturable; no bloquear operacion interna.
             pass
 
-    rate_today = (
-        db.query(ExchangeRate)
-        .filter(ExchangeRate.effective_date <= local_today())
-        .order_by(ExchangeRate.effective_date.desc())
-        .first()
-    )
+    rate_today = _latest_exchange_rate(db, request)
     if moneda == "USD" and not rate_today:
         return RedirectResponse(f"{redirect_to}?error=Tasa+de+cambio+no+configurada", status_code=303)
 
@@ -31239,8 +31586,25 @@ async def inventory_create_egreso(
     total_usd = 0.0
     total_cs = 0.0
     traslado_items: list[dict[str, float | int]] = []
-    product_ids = [int(pid) for pid in item_ids if str(pid).isdigit()]
-    balances = _balances_by_bodega(db, [int(bodega_id)], list(set(product_ids))) if product_ids else {}
+    egreso_items: list[dict] = []
+    saldo_deltas: dict[int, Decimal] = defaultdict(Decimal)
+    product_ids = list(dict.fromkeys(int(pid) for pid in item_ids if str(pid).isdigit()))
+    # Bloquea los productos antes de leer existencias: dos egresos simultaneos
+    # del mismo producto se serializan y no pueden sobregirar el saldo.
+    productos_by_id = (
+        {
+            p.id: p
+            for p in db.query(Producto)
+            .options(joinedload(Producto.saldo))
+            .filter(Producto.id.in_(product_ids))
+            .order_by(Producto.id)
+            .with_for_update(of=Producto)
+            .all()
+        }
+        if product_ids
+        else {}
+    )
+    balances = _balances_by_bodega(db, [int(bodega_id)], product_ids) if product_ids else {}
     for index, product_id in enumerate(item_ids):
         variant_id_raw = item_variant_ids[index] if index < len(item_variant_ids) else None
         variant_id = int(variant_id_raw) if str(variant_id_raw or "").isdigit() else None
@@ -31248,7 +31612,8 @@ async def inventory_create_egreso(
         cost = to_float(item_costs[index] if index < len(item_costs) else 0)
         if qty <= 0:
             continue
-        producto = db.query(Producto).filter(Producto.id == int(product_id)).first()
+        qty_dec = to_decimal(qty)
+        producto = productos_by_id.get(int(product_id)) if str(product_id).isdigit() else None
         if not producto:
             db.rollback()
             return RedirectResponse(f"{redirect_to}?error=Producto+no+encontrado", status_code=303)
@@ -31275,20 +31640,21 @@ async def inventory_create_egreso(
                 )
                 .first()
             )
-            variant_available = float(variant_stock.existencia or 0) if variant_stock else 0.0
-            if variant_available < qty:
+            variant_available = (variant_stock.existencia or Decimal("0")) if variant_stock else Decimal("0")
+            if variant_available < qty_dec:
                 db.rollback()
                 mensaje = f"Stock+insuficiente+para+variante+{variant.cod_variante}"
                 return RedirectResponse(f"{redirect_to}?error={mensaje}", status_code=303)
             if variant_stock:
-                variant_stock.existencia = Decimal(str(variant_available)) - to_decimal(qty)
+                variant_stock.existencia = variant_available - qty_dec
 
-        existencia = float(balances.get((producto.id, int(bodega_id)), Decimal("0")) or 0)
-        if existencia < qty:
+        balance_key = (producto.id, int(bodega_id))
+        existencia = balances.get(balance_key) or Decimal("0")
+        if existencia < qty_dec:
             db.rollback()
             mensaje = f"Stock+insuficiente+para+{producto.cod_producto}"
             return RedirectResponse(f"{redirect_to}?error={mensaje}", status_code=303)
-        balances[(producto.id, int(bodega_id))] = Decimal(str(existencia)) - to_decimal(qty)
+        balances[balance_key] = existencia - qty_dec
 
         if es_traslado:
             costo_cs = cost
@@ -31305,21 +31671,21 @@ async def inventory_create_egreso(
         total_usd += subtotal_usd
         total_cs += subtotal_cs
 
-        item = EgresoItem(
-            egreso_id=egreso.id,
-            producto_id=int(product_id),
-            variante_id=int(variant.id) if variant else None,
-            cantidad=qty,
-            costo_unitario_usd=costo_usd,
-            costo_unitario_cs=costo_cs,
-            subtotal_usd=subtotal_usd,
-            subtotal_cs=subtotal_cs,
+        egreso_items.append(
+            {
+                "egreso_id": egreso.id,
+                "producto_id": int(product_id),
+                "variante_id": int(variant.id) if variant else None,
+                "cantidad": qty,
+                "costo_unitario_usd": costo_usd,
+                "costo_unitario_cs": costo_cs,
+                "subtotal_usd": subtotal_usd,
+                "subtotal_cs": subtotal_cs,
+            }
         )
-        db.add(item)
 
         if producto.saldo:
-            existencia_actual = to_decimal(producto.saldo.existencia)
-            producto.saldo.existencia = existencia_actual - to_decimal(qty)
+            saldo_deltas[producto.id] -= qty_dec
         traslado_items.append(
             {
                 "producto_id": int(product_id),
@@ -31335,6 +31701,7 @@ async def inventory_create_egreso(
     if not traslado_items:
         db.rollback()
         return RedirectResponse(f"{redirect_to}?error=Agrega+items+validos+con+saldo", status_code=303)
+    db.execute(insert(EgresoItem), egreso_items)
 
     if es_traslado and bodega_destino_obj and traslado_items:
         ingreso_tipo = (
@@ -31345,16 +31712,14 @@ async def inventory_create_egreso(
         if not ingreso_tipo:
             ingreso_tipo = IngresoTipo(nombre="Traslado entre bodegas", requiere_proveedor=False)
             db.add(ingreso_tipo)
-            db.flush()
-        bodega_origen_obj = db.query(Bodega).filter(Bodega.id == int(bodega_id)).first()
         traslado_obs = (
-            f"Traslado desde {bodega_origen_obj.name if bodega_origen_obj else 'origen'} "
+            f"Traslado desde {bodega_obj.name if bodega_obj else 'origen'} "
             f"hacia {bodega_destino_obj.name}. Egreso #{egreso.id}"
         )
         if observacion:
             traslado_obs = f"{traslado_obs} | {observacion}"
         ingreso = IngresoInventario(
-            tipo_id=ingreso_tipo.id,
+            tipo=ingreso_tipo,
             bodega_id=bodega_destino_obj.id,
             proveedor_id=None,
             fecha=fecha_value,
@@ -31367,23 +31732,25 @@ async def inventory_create_egreso(
         )
         db.add(ingreso)
         db.flush()
+        db.execute(
+            insert(IngresoItem),
+            [
+                {
+                    "ingreso_id": ingreso.id,
+                    "producto_id": int(row["producto_id"]),
+                    "cantidad": float(row["cantidad"]),
+                    "costo_unitario_usd": 0,
+                    "costo_unitario_cs": float(row["costo_unitario_cs"]),
+                    "subtotal_usd": 0,
+                    "subtotal_cs": float(row["subtotal_cs"]),
+                }
+                for row in traslado_items
+            ],
+        )
         for row in traslado_items:
-            db.add(
-                IngresoItem(
-                    ingreso_id=ingreso.id,
-                    producto_id=int(row["producto_id"]),
-                    cantidad=float(row["cantidad"]),
-                    costo_unitario_usd=0,
-                    costo_unitario_cs=float(row["costo_unitario_cs"]),
-                    subtotal_usd=0,
-                    subtotal_cs=float(row["subtotal_cs"]),
-                )
-            )
-            producto = db.query(Producto).filter(Producto.id == int(row["producto_id"])).first()
-            if producto and producto.saldo:
-                producto.saldo.existencia = to_decimal(producto.saldo.existencia) + to_decimal(float(row["cantidad"]))
-            elif producto:
-                db.add(SaldoProducto(producto_id=producto.id, existencia=to_decimal(float(row["cantidad"]))))
+            cantidad_dec = to_decimal(row["cantidad"])
+            if int(row["producto_id"]) in productos_by_id:
+                saldo_deltas[int(row["producto_id"])] += cantidad_dec
             if row.get("variant_id"):
                 variant_dest = (
                     db.query(ShoeVariantStock)
@@ -31394,13 +31761,13 @@ async def inventory_create_egreso(
                     .first()
                 )
                 if variant_dest:
-                    variant_dest.existencia = to_decimal(variant_dest.existencia) + to_decimal(float(row["cantidad"]))
+                    variant_dest.existencia = (variant_dest.existencia or Decimal("0")) + cantidad_dec
                 else:
                     db.add(
                         ShoeVariantStock(
                             variante_id=int(row["variant_id"]),
                             bodega_id=int(bodega_destino_obj.id),
-                            existencia=to_decimal(float(row["cantidad"])),
+                            existencia=cantidad_dec,
                         )
                     )
 
@@ -31447,16 +31814,14 @@ async def inventory_create_egreso(
         if not ingreso_tipo:
             ingreso_tipo = IngresoTipo(nombre="Produccion", requiere_proveedor=False)
             db.add(ingreso_tipo)
-            db.flush()
-        bodega_origen_obj = db.query(Bodega).filter(Bodega.id == int(bodega_id)).first()
         abierta_obs = (
-            f"Resultado de Produccion de Abierta desde {bodega_origen_obj.name if bodega_origen_obj else 'origen'} "
+            f"Resultado de Produccion de Abierta desde {bodega_obj.name if bodega_obj else 'origen'} "
             f"hacia {bodega_destino_obj.name if bodega_destino_obj else 'destino'}. Egreso #{egreso.id}"
         )
         if observacion:
             abierta_obs = f"{abierta_obs} | {observacion}"
         ingreso_resultado = IngresoInventario(
-            tipo_id=ingreso_tipo.id,
+            tipo=ingreso_tipo,
             bodega_id=int(bodega_destino_obj.id),
             proveedor_id=None,
             fecha=fecha_value,
@@ -31470,24 +31835,29 @@ async def inventory_create_egreso(
         db.add(ingreso_resultado)
         db.flush()
         ingreso_resultado_id = int(ingreso_resultado.id)
+        result_product_ids = {int(row["producto_id"]) for row in result_rows}
+        result_productos_by_id = {
+            p.id: p for p in db.query(Producto).filter(Producto.id.in_(result_product_ids)).all()
+        }
+        db.execute(
+            insert(IngresoItem),
+            [
+                {
+                    "ingreso_id": ingreso_resultado.id,
+                    "producto_id": int(row["producto_id"]),
+                    "cantidad": float(row["cantidad"]),
+                    "costo_unitario_usd": float(row["costo_unitario_usd"]),
+                    "costo_unitario_cs": float(row["costo_unitario_cs"]),
+                    "subtotal_usd": float(row["subtotal_usd"]),
+                    "subtotal_cs": float(row["subtotal_cs"]),
+                }
+                for row in result_rows
+            ],
+        )
         for row in result_rows:
-            db.add(
-                IngresoItem(
-                    ingreso_id=ingreso_resultado.id,
-                    producto_id=int(row["producto_id"]),
-                    cantidad=float(row["cantidad"]),
-                    costo_unitario_usd=float(row["costo_unitario_usd"]),
-                    costo_unitario_cs=float(row["costo_unitario_cs"]),
-                    subtotal_usd=float(row["subtotal_usd"]),
-                    subtotal_cs=float(row["subtotal_cs"]),
-                )
-            )
-            producto_result = db.query(Producto).filter(Producto.id == int(row["producto_id"])).first()
-            if producto_result and producto_result.saldo:
-                producto_result.saldo.existencia = to_decimal(producto_result.saldo.existencia) + to_decimal(float(row["cantidad"]))
-            elif producto_result:
-                db.add(SaldoProducto(producto_id=producto_result.id, existencia=to_decimal(float(row["cantidad"]))))
+            producto_result = result_productos_by_id.get(int(row["producto_id"]))
             if producto_result:
+                saldo_deltas[producto_result.id] += to_decimal(row["cantidad"])
                 if float(row["costo_unitario_cs"] or 0) > 0:
                     producto_result.costo_producto = float(row["costo_unitario_cs"])
                     if tasa > 0:
@@ -31504,19 +31874,16 @@ async def inventory_create_egreso(
 
     egreso.total_usd = 0 if es_traslado else total_usd
     egreso.total_cs = total_cs
-    bodega_obj = db.query(Bodega).filter(Bodega.id == int(bodega_id)).first()
-    auto_amount = to_decimal(total_cs)
-    auto_entry = _build_auto_accounting_entry(
-        db,
+    _apply_saldo_deltas(db, saldo_deltas)
+    background_tasks.add_task(
+        _post_auto_accounting_entry,
         event_code="INV_OUT",
         branch_id=bodega_obj.branch_id if bodega_obj else None,
         entry_date=fecha_value,
-        amount=auto_amount,
+        amount=to_decimal(total_cs),
         reference=f"AUTO-EGR-{egreso.id}",
         description=f"Asiento automatico por egreso inventario #{egreso.id}",
     )
-    if auto_entry:
-        db.add(auto_entry)
     db.commit()
     if es_abierta and ingreso_resultado_id:
         return RedirectResponse(
@@ -31570,15 +31937,15 @@ def sales_clientes_search(
     _enforce_permission(request, user, "access.sales")
     term = (q or "").strip()
     if len(term) < 1:
-        return JSONResponse({"ok": True, "items": []})
-    clientes = (
-        db.query(Cliente)
-        .filter(func.lower(Cliente.nombre).like(f"%{term.lower()}%"))
+        return ORJSONResponse({"ok": True, "items": []})
+    rows = (
+        db.query(Cliente.id, Cliente.nombre)
+        .filter(Cliente.nombre.ilike(f"%{term}%"))
         .order_by(Cliente.nombre)
         .limit(25)
         .all()
     )
-    return JSONResponse({"ok": True, "items": [{"id": c.id, "nombre": c.nombre} for c in clientes]})
+    return ORJSONResponse({"ok": True, "items": [{"id": cliente_id, "nombre": nombre} for cliente_id, nombre in rows]})
 
 
 @router.post("/sales/cliente/{cliente_id}/update")
@@ -32408,13 +32775,7 @@ async def restaurant_order_invoice(
                 status_code=303,
             )
         balances[(item.producto_id, bodega.id)] = existencia - qty
-    last_factura = (
-        db.query(VentaFactura)
-        .filter(VentaFactura.bodega_id == bodega.id)
-        .order_by(VentaFactura.secuencia.desc())
-        .first()
-    )
-    next_seq = (last_factura.secuencia if last_factura else 0) + 1
+    next_seq = _next_venta_secuencia(db, bodega.id)
     prefix = _branch_sales_series_letter(branch.code)
     numero = f"{prefix}-{next_seq:06d}"
     cliente_id = int(cliente_id_raw) if cliente_id_raw.isdigit() else (order.cliente_id or _get_or_create_consumidor_final(db).id)
@@ -32546,7 +32907,14 @@ async def restaurant_order_invoice(
     if pos_print and pos_print.auto_print:
         try:
             company_profile = _company_profile_payload(db)
-            _print_pos_ticket(factura, pos_print.printer_name, max(int(pos_print.copies or 0), 1), company_profile, pos_print.sumatra_path)
+            await run_in_threadpool(
+                _print_pos_ticket,
+                factura,
+                pos_print.printer_name,
+                max(int(pos_print.copies or 0), 1),
+                company_profile,
+                pos_print.sumatra_path,
+            )
         except Exception:
             pass
     return RedirectResponse(f"/sales?success=Cuenta+facturada&print_id={factura.id}", status_code=303)
@@ -32555,11 +32923,23 @@ async def restaurant_order_invoice(
 @router.post("/sales")
 async def sales_create_invoice(
     request: Request,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     user: User = Depends(_require_admin_web),
 ):
     _enforce_permission(request, user, "access.sales.registrar")
     form = await request.form()
+    # La sesion es sincrona: el trabajo de BD corre en el threadpool para no bloquear el event loop.
+    return await run_in_threadpool(_sales_create_invoice_sync, request, form, db, user, background_tasks)
+
+
+def _sales_create_invoice_sync(
+    request: Request,
+    form,
+    db: Session,
+    user: User,
+    background_tasks: BackgroundTasks,
+):
     cliente_id = form.get("cliente_id") or None
     vendedor_id = form.get("vendedor_id") or None
     fecha = form.get("fecha")
@@ -32610,12 +32990,7 @@ async def sales_create_invoice(
         if not cliente_credito or nombre_cliente == "consumidor final":
             return RedirectResponse("/sales?error=Credito+no+permite+consumidor+final", status_code=303)
 
-    rate_today = (
-        db.query(ExchangeRate)
-        .filter(ExchangeRate.effective_date <= local_today())
-        .order_by(ExchangeRate.effective_date.desc())
-        .first()
-    )
+    rate_today = _latest_exchange_rate(db, request)
     if moneda == "USD" and not rate_today:
         return RedirectResponse("/sales?error=Tasa+de+cambio+no+configurada", status_code=303)
 
@@ -32627,8 +33002,10 @@ async def sales_create_invoice(
         except ValueError:
             return 0.0
 
-    def to_decimal(value: Optional[float]) -> Decimal:
-        return Decimal(str(value or 0))
+    def to_decimal(value: Optional[float | Decimal]) -> Decimal:
+        if isinstance(value, Decimal):
+            return value
+        return Decimal(repr(value)) if value else Decimal("0")
 
     tasa = float(rate_today.rate) if rate_today else 0
     pacasholl_libreado_enabled = _is_pacasholl_company()
@@ -32639,13 +33016,7 @@ async def sales_create_invoice(
         return RedirectResponse("/sales?error=Bodega+no+configurada+para+la+sucursal", status_code=303)
     if not _bodega_permite_facturacion(bodega):
         return RedirectResponse("/sales?error=La+bodega+operativa+no+esta+habilitada+para+facturacion", status_code=303)
-    last_factura = (
-        db.query(VentaFactura)
-        .filter(VentaFactura.bodega_id == bodega.id)
-        .order_by(VentaFactura.secuencia.desc())
-        .first()
-    )
-    next_seq = (last_factura.secuencia if last_factura else 0) + 1
+    next_seq = _next_venta_secuencia(db, bodega.id)
     prefix = _branch_sales_series_letter(branch.code)
     width = 6
     numero = f"{prefix}-{next_seq:0{width}d}"
@@ -32687,29 +33058,45 @@ async def sales_create_invoice(
         created_at=local_now_naive(),
     )
     db.add(factura)
-    db.flush()
     preventa: Optional[Preventa] = None
     source_items: list[dict[str, object]] = []
     preventa_locked_prices: dict[int, tuple[float, float]] = {}
 
     def append_form_source_items() -> None:
-        for index, product_id in enumerate(item_ids):
+        for (
+            product_id,
+            variant_id_raw,
+            qty_raw,
+            peso_raw,
+            price_raw,
+            discount_raw,
+            role,
+            combo_group,
+        ) in _zip_form_lists(
+            item_ids,
+            item_variant_ids,
+            item_qtys,
+            item_peso_lbs,
+            item_prices,
+            item_discount_pcts,
+            item_roles,
+            item_combo_groups,
+        ):
             if not str(product_id).isdigit():
                 continue
-            variant_id_raw = item_variant_ids[index] if index < len(item_variant_ids) else None
             variant_id = int(variant_id_raw) if str(variant_id_raw or "").isdigit() else None
             source_items.append(
                 {
                     "product_id": int(product_id),
                     "variant_id": variant_id,
-                    "qty": to_float(item_qtys[index] if index < len(item_qtys) else 0),
-                    "peso_lbs": to_float(item_peso_lbs[index] if index < len(item_peso_lbs) else 0),
+                    "qty": to_float(qty_raw),
+                    "peso_lbs": to_float(peso_raw),
                     "price_usd": None,
                     "price_cs": None,
-                    "price_input": to_float(item_prices[index] if index < len(item_prices) else 0),
-                    "discount_pct": _discount_percent_value(item_discount_pcts[index] if index < len(item_discount_pcts) else "0"),
-                    "role": item_roles[index] if index < len(item_roles) else None,
-                    "combo_group": item_combo_groups[index] if index < len(item_combo_groups) else None,
+                    "price_input": to_float(price_raw),
+                    "discount_pct": _discount_percent_value(discount_raw or "0"),
+                    "role": role,
+                    "combo_group": combo_group,
                 }
             )
 
@@ -32743,8 +33130,8 @@ async def sales_create_invoice(
         if pacasholl_libreado_enabled:
             preventa_locked_prices = {
                 int(p_item.producto_id): (
-                    to_float(str(p_item.precio_unitario_usd or 0)),
-                    to_float(str(p_item.precio_unitario_cs or 0)),
+                    float(p_item.precio_unitario_usd or 0),
+                    float(p_item.precio_unitario_cs or 0),
                 )
                 for p_item in p_items
             }
@@ -32754,9 +33141,9 @@ async def sales_create_invoice(
                 source_items.append(
                     {
                         "product_id": int(p_item.producto_id),
-                        "qty": to_float(str(p_item.cantidad or 0)),
-                        "price_usd": to_float(str(p_item.precio_unitario_usd or 0)),
-                        "price_cs": to_float(str(p_item.precio_unitario_cs or 0)),
+                        "qty": float(p_item.cantidad or 0),
+                        "price_usd": float(p_item.precio_unitario_usd or 0),
+                        "price_cs": float(p_item.precio_unitario_cs or 0),
                         "role": p_item.combo_role or None,
                         "combo_group": p_item.combo_group or None,
                     }
@@ -32799,14 +33186,25 @@ async def sales_create_invoice(
     total_items = 0.0
     total_cost_cs = Decimal("0")
     weighted_sales_enabled = _weighted_sales_enabled_mode(db)
-    product_ids = [int(it["product_id"]) for it in source_items if int(it["product_id"]) > 0]
-    balances = _balances_by_bodega(db, [bodega.id], list(set(product_ids))) if product_ids else {}
+    # product_id ya viene como int desde source_items.
+    bodega_id = bodega.id
+    product_ids = {it["product_id"] for it in source_items if it["product_id"] > 0}
+    balances = _balances_by_bodega(db, [bodega_id], list(product_ids)) if product_ids else {}
+    venta_items: list[dict[str, object]] = []
+    # Constantes del redondeo por linea, fuera del ciclo de items.
+    cent = Decimal("0.01")
+    hundred = Decimal("100")
+    zero = Decimal("0")
+    productos = {
+        p.id: p
+        for p in db.query(Producto).filter(Producto.id.in_(product_ids)).all()
+    } if product_ids else {}
     for src in source_items:
-        product_id = int(src["product_id"])
-        variant_id = int(src.get("variant_id") or 0) or None
-        qty = to_float(str(src.get("qty") or 0))
+        product_id = src["product_id"]
+        variant_id = src.get("variant_id") or None
+        qty = float(src.get("qty") or 0)
 
-        producto = db.query(Producto).filter(Producto.id == int(product_id)).first()
+        producto = productos.get(product_id)
         if not producto:
             db.rollback()
             return RedirectResponse("/sales?error=Producto+no+encontrado", status_code=303)
@@ -32816,7 +33214,7 @@ async def sales_create_invoice(
                 f"/sales?error={quote_plus(f'El producto {producto.cod_producto} esta configurado como insumo y no puede facturarse')}",
                 status_code=303,
             )
-        peso_lbs = to_float(str(src.get("peso_lbs") or 0))
+        peso_lbs = float(src.get("peso_lbs") or 0)
         is_libreado_product = pacasholl_libreado_enabled and bool(getattr(producto, "es_libreado", False))
         if is_libreado_product:
             if peso_lbs <= 0:
@@ -32835,19 +33233,21 @@ async def sales_create_invoice(
             return RedirectResponse("/sales?error=Debes+definir+el+peso+a+facturar", status_code=303)
 
         is_service_product = bool(getattr(producto, "servicio_producto", False))
-        existencia = float(balances.get((producto.id, bodega.id), Decimal("0")) or 0)
-        if (not is_service_product) and existencia < stock_qty:
+        stock_qty_dec = to_decimal(stock_qty)
+        balance_key = (product_id, bodega_id)
+        existencia = to_decimal(balances.get(balance_key))
+        if (not is_service_product) and existencia < stock_qty_dec:
             db.rollback()
             mensaje = f"Stock+insuficiente+para+{producto.cod_producto}"
             return RedirectResponse(f"/sales?error={mensaje}", status_code=303)
         if not is_service_product:
-            balances[(producto.id, bodega.id)] = Decimal(str(existencia)) - to_decimal(stock_qty)
+            balances[balance_key] = existencia - stock_qty_dec
         if variant_id:
             variant = (
                 db.query(ShoeProductVariant)
                 .filter(
-                    ShoeProductVariant.id == int(variant_id),
-                    ShoeProductVariant.producto_id == int(product_id),
+                    ShoeProductVariant.id == variant_id,
+                    ShoeProductVariant.producto_id == product_id,
                     ShoeProductVariant.activo.is_(True),
                 )
                 .first()
@@ -32859,34 +33259,34 @@ async def sales_create_invoice(
                 db.query(ShoeVariantStock)
                 .filter(
                     ShoeVariantStock.variante_id == variant.id,
-                    ShoeVariantStock.bodega_id == bodega.id,
+                    ShoeVariantStock.bodega_id == bodega_id,
                 )
                 .first()
             )
-            variant_available = float(variant_stock.existencia or 0) if variant_stock else 0.0
-            if variant_available < stock_qty:
+            variant_available = to_decimal(variant_stock.existencia) if variant_stock else Decimal("0")
+            if variant_available < stock_qty_dec:
                 db.rollback()
                 mensaje = f"Stock+insuficiente+para+variante+{variant.cod_variante}"
                 return RedirectResponse(f"/sales?error={mensaje}", status_code=303)
-            variant_stock.existencia = Decimal(str(variant_available)) - to_decimal(stock_qty)
+            variant_stock.existencia = variant_available - stock_qty_dec
 
         if preventa and (src.get("price_usd") is not None or src.get("price_cs") is not None):
-            precio_usd = to_float(str(src.get("price_usd") or 0))
-            precio_cs = to_float(str(src.get("price_cs") or 0))
+            precio_usd = float(src.get("price_usd") or 0)
+            precio_cs = float(src.get("price_cs") or 0)
         elif preventa and pacasholl_libreado_enabled:
-            locked_price = preventa_locked_prices.get(int(product_id))
+            locked_price = preventa_locked_prices.get(product_id)
             if locked_price:
-                precio_usd = to_float(str(locked_price[0] or 0))
-                precio_cs = to_float(str(locked_price[1] or 0))
+                precio_usd = float(locked_price[0] or 0)
+                precio_cs = float(locked_price[1] or 0)
             else:
-                precio_usd = to_float(str(producto.precio_venta1_usd or 0))
-                precio_cs = to_float(str(producto.precio_venta1 or 0))
+                precio_usd = float(producto.precio_venta1_usd or 0)
+                precio_cs = float(producto.precio_venta1 or 0)
             if precio_usd <= 0 and precio_cs > 0 and tasa:
                 precio_usd = precio_cs / tasa
             if precio_cs <= 0 and precio_usd > 0 and tasa:
                 precio_cs = precio_usd * tasa
         else:
-            price = to_float(str(src.get("price_input") or 0))
+            price = float(src.get("price_input") or 0)
             if moneda == "USD":
                 precio_usd = price
                 precio_cs = price * tasa
@@ -32895,12 +33295,16 @@ async def sales_create_invoice(
                 precio_usd = price / tasa if tasa else 0
 
         line_discount_pct = _discount_percent_value(src.get("discount_pct") or "0")
-        subtotal_bruto_usd = Decimal(str(precio_usd * billable_qty)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-        subtotal_bruto_cs = Decimal(str(precio_cs * billable_qty)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-        descuento_usd = (subtotal_bruto_usd * line_discount_pct / Decimal("100")).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-        descuento_cs = (subtotal_bruto_cs * line_discount_pct / Decimal("100")).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-        subtotal_usd_dec = max(Decimal("0"), subtotal_bruto_usd - descuento_usd).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-        subtotal_cs_dec = max(Decimal("0"), subtotal_bruto_cs - descuento_cs).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+        subtotal_bruto_usd = Decimal(str(precio_usd * billable_qty)).quantize(cent, rounding=ROUND_HALF_UP)
+        subtotal_bruto_cs = Decimal(str(precio_cs * billable_qty)).quantize(cent, rounding=ROUND_HALF_UP)
+        if line_discount_pct:
+            descuento_usd = (subtotal_bruto_usd * line_discount_pct / hundred).quantize(cent, rounding=ROUND_HALF_UP)
+            descuento_cs = (subtotal_bruto_cs * line_discount_pct / hundred).quantize(cent, rounding=ROUND_HALF_UP)
+        else:
+            descuento_usd = zero.quantize(cent)
+            descuento_cs = descuento_usd
+        subtotal_usd_dec = max(zero, subtotal_bruto_usd - descuento_usd).quantize(cent, rounding=ROUND_HALF_UP)
+        subtotal_cs_dec = max(zero, subtotal_bruto_cs - descuento_cs).quantize(cent, rounding=ROUND_HALF_UP)
         subtotal_usd = float(subtotal_usd_dec)
         subtotal_cs = float(subtotal_cs_dec)
         subtotal_bruto_usd_total += subtotal_bruto_usd
@@ -32910,32 +33314,32 @@ async def sales_create_invoice(
         total_usd += subtotal_usd
         total_cs += subtotal_cs
         total_items += stock_qty
-        if not bool(getattr(producto, "servicio_producto", False)):
-            total_cost_cs += (Decimal(str(producto.costo_producto or 0)) * Decimal(str(stock_qty))).quantize(Decimal("0.01"))
+        if not is_service_product:
+            total_cost_cs += (to_decimal(producto.costo_producto) * stock_qty_dec).quantize(cent)
 
         combo_role = src.get("role")
         combo_group = src.get("combo_group")
         combo_role = combo_role or None
         combo_group = combo_group or None
-        item = VentaItem(
-            factura_id=factura.id,
-            producto_id=int(product_id),
-            variante_id=int(variant_id) if variant_id else None,
-            cantidad=stock_qty,
-            peso_lbs=peso_lbs if peso_lbs > 0 else None,
-            precio_unitario_usd=precio_usd,
-            precio_unitario_cs=precio_cs,
-            descuento_porcentaje=line_discount_pct,
-            descuento_usd=descuento_usd,
-            descuento_cs=descuento_cs,
-            subtotal_bruto_usd=subtotal_bruto_usd,
-            subtotal_bruto_cs=subtotal_bruto_cs,
-            subtotal_usd=subtotal_usd,
-            subtotal_cs=subtotal_cs,
-            combo_role=combo_role,
-            combo_group=combo_group,
-        )
-        db.add(item)
+        venta_items.append(
+            {
+                "producto_id": product_id,
+                "variante_id": variant_id,
+                "cantidad": stock_qty,
+                "peso_lbs": peso_lbs if peso_lbs > 0 else None,
+                "precio_unitario_usd": precio_usd,
+                "precio_unitario_cs": precio_cs,
+                "descuento_porcentaje": line_discount_pct,
+                "descuento_usd": descuento_usd,
+                "descuento_cs": descuento_cs,
+                "subtotal_bruto_usd": subtotal_bruto_usd,
+                "subtotal_bruto_cs": subtotal_bruto_cs,
+                "subtotal_usd": subtotal_usd,
+                "subtotal_cs": subtotal_cs,
+                "combo_role": combo_role,
+                "combo_group": combo_group,
+            }
+        )
 
         # No usar saldo global; el stock se calcula por movimientos/bodega.
 
@@ -32947,6 +33351,12 @@ async def sales_create_invoice(
             db.rollback()
             return RedirectResponse("/sales?error=La+venta+debe+tener+un+total+positivo", status_code=303)
 
+    # La factura se inserta hasta aqui, ya validados los items; el mismo flush
+    # envia los cambios de existencia por variante.
+    db.flush()
+    for row in venta_items:
+        row["factura_id"] = factura.id
+
     net_after_item_discount_usd = Decimal(str(total_usd)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
     net_after_item_discount_cs = Decimal(str(total_cs)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
     descuento_global_usd = (net_after_item_discount_usd * descuento_global_pct / Decimal("100")).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
@@ -32966,14 +33376,19 @@ async def sales_create_invoice(
     factura.total_cs = total_cs
     factura.total_items = total_items
 
-    pagos = []
+    pago_rows: list[dict[str, object]] = []
     if condicion_venta != "CREDITO":
         if pago_forma_ids:
-            for index, forma_id in enumerate(pago_forma_ids):
-                moneda_pago = pago_monedas[index] if index < len(pago_monedas) else moneda
-                monto_pago = to_float(pago_montos[index] if index < len(pago_montos) else 0)
-                banco_pago = pago_banco_ids[index] if index < len(pago_banco_ids) else None
-                cuenta_pago = pago_cuenta_ids[index] if index < len(pago_cuenta_ids) else None
+            for forma_id, moneda_pago, monto_raw, banco_pago, cuenta_pago in _zip_form_lists(
+                pago_forma_ids,
+                pago_monedas,
+                pago_montos,
+                pago_banco_ids,
+                pago_cuenta_ids,
+            ):
+                if moneda_pago is None:
+                    moneda_pago = moneda
+                monto_pago = to_float(monto_raw)
                 if monto_pago <= 0:
                     continue
                 if moneda_pago != moneda and not tasa:
@@ -32981,34 +33396,36 @@ async def sales_create_invoice(
                     return RedirectResponse("/sales?error=Tasa+de+cambio+no+configurada", status_code=303)
                 pago_usd = monto_pago if moneda_pago == "USD" else monto_pago / tasa if tasa else 0
                 pago_cs = monto_pago if moneda_pago == "CS" else monto_pago * tasa
-                pagos.append(
-                    VentaPago(
-                        factura_id=factura.id,
-                        forma_pago_id=int(forma_id),
-                        banco_id=int(banco_pago) if banco_pago else None,
-                        cuenta_id=int(cuenta_pago) if cuenta_pago else None,
-                        moneda=moneda_pago,
-                        monto_original=Decimal(str(monto_pago)).quantize(Decimal("0.01")),
-                        monto_usd=pago_usd,
-                        monto_cs=pago_cs,
-                    )
+                pago_rows.append(
+                    {
+                        "factura_id": factura.id,
+                        "forma_pago_id": int(forma_id),
+                        "banco_id": int(banco_pago) if banco_pago else None,
+                        "cuenta_id": int(cuenta_pago) if cuenta_pago else None,
+                        "moneda": moneda_pago,
+                        "monto_original": Decimal(str(monto_pago)).quantize(Decimal("0.01")),
+                        "monto_usd": pago_usd,
+                        "monto_cs": pago_cs,
+                    }
                 )
         elif forma_pago_id:
             monto_pago = to_float(pago_monto) if pago_monto is not None else (total_usd if moneda == "USD" else total_cs)
             pago_usd = monto_pago if moneda == "USD" else monto_pago / tasa if tasa else 0
             pago_cs = monto_pago if moneda == "CS" else monto_pago * tasa
-            pagos.append(
-                VentaPago(
-                    factura_id=factura.id,
-                    forma_pago_id=int(forma_pago_id),
-                    banco_id=int(banco_id) if banco_id else None,
-                    cuenta_id=int(cuenta_id) if cuenta_id else None,
-                    moneda=moneda,
-                    monto_original=Decimal(str(monto_pago)).quantize(Decimal("0.01")),
-                    monto_usd=pago_usd,
-                    monto_cs=pago_cs,
-                )
+            pago_rows.append(
+                {
+                    "factura_id": factura.id,
+                    "forma_pago_id": int(forma_pago_id),
+                    "banco_id": int(banco_id) if banco_id else None,
+                    "cuenta_id": int(cuenta_id) if cuenta_id else None,
+                    "moneda": moneda,
+                    "monto_original": Decimal(str(monto_pago)).quantize(Decimal("0.01")),
+                    "monto_usd": pago_usd,
+                    "monto_cs": pago_cs,
+                }
             )
+    # Objetos transitorios solo para validar montos y armar el asiento automatico.
+    pagos = [VentaPago(**row) for row in pago_rows]
 
     if condicion_venta == "CREDITO":
         factura.estado_cobranza = "PENDIENTE"
@@ -33034,8 +33451,10 @@ async def sales_create_invoice(
     if discount_token_row:
         discount_token_row.used_at = local_now_naive()
         discount_token_row.factura_id = factura.id
-    for pago in pagos:
-        db.add(pago)
+    if venta_items:
+        db.execute(insert(VentaItem), venta_items)
+    if pago_rows:
+        db.execute(insert(VentaPago), pago_rows)
 
     auto_entries = _build_sale_accounting_entries(
         db,
@@ -33070,18 +33489,13 @@ async def sales_create_invoice(
         .first()
     )
     if pos_print and (pos_print.auto_print or quick_print):
-        try:
-            company_profile = _company_profile_payload(db)
-            copies_to_print = max(int(pos_print.copies or 0), 2)
-            _print_pos_ticket(
-                factura,
-                pos_print.printer_name,
-                copies_to_print,
-                company_profile,
-                pos_print.sumatra_path,
-            )
-        except Exception:
-            pass
+        background_tasks.add_task(
+            _print_pos_ticket_background,
+            factura_id=factura.id,
+            printer_name=pos_print.printer_name,
+            copies=max(int(pos_print.copies or 0), 2),
+            sumatra_override=pos_print.sumatra_path,
+        )
     return RedirectResponse(
         f"/sales?success=Venta+registrada&print_id={factura.id}",
         status_code=303,
@@ -33380,7 +33794,10 @@ def sales_cobranza(
     if include_all_facturas:
         scoped_bodega_ids = []
     _, bodega = _resolve_branch_bodega(db, user)
-    ventas_query = db.query(VentaFactura)
+    ventas_query = db.query(VentaFactura).options(
+        joinedload(VentaFactura.vendedor),
+        joinedload(VentaFactura.cliente),
+    )
     if not include_all_facturas:
         ventas_query = ventas_query.filter(VentaFactura.condicion_venta == "CREDITO")
     if scoped_bodega_ids:
@@ -33405,18 +33822,17 @@ def sales_cobranza(
     if producto_q:
         ventas_query = ventas_query.join(VentaItem).join(Producto).filter(
             or_(
-                func.lower(Producto.cod_producto).like(f"%{producto_q.lower()}%"),
-                func.lower(Producto.descripcion).like(f"%{producto_q.lower()}%"),
+                Producto.cod_producto.ilike(f"%{producto_q}%"),
+                Producto.descripcion.ilike(f"%{producto_q}%"),
             )
         )
-    ventas = ventas_query.order_by(VentaFactura.fecha.desc(), VentaFactura.id.desc()).all()
-
-    rate_today = (
-        db.query(ExchangeRate)
-        .filter(ExchangeRate.effective_date <= local_today())
-        .order_by(ExchangeRate.effective_date.desc())
-        .first()
+    ventas = (
+        _with_cobranza_totals(ventas_query)
+        .order_by(VentaFactura.fecha.desc(), VentaFactura.id.desc())
+        .all()
     )
+
+    rate_today = _latest_exchange_rate(db, request)
     tasa_actual = Decimal(str(rate_today.rate if rate_today else 0))
 
     def _money_views(amount_usd: Decimal, amount_cs: Decimal) -> tuple[Decimal, Decimal]:
@@ -33441,19 +33857,7 @@ def sales_cobranza(
     total_vendido_usd = Decimal("0")
     display_total_vendido = Decimal("0")
     display_total_saldo = Decimal("0")
-    def _abono_factor(tipo_mov: Optional[str]) -> Decimal:
-        return Decimal("-1") if (tipo_mov or "").strip().upper() == "NOTA_DEBITO" else Decimal("1")
-
-    def _abonos_signed_totals(abonos: list[CobranzaAbono]) -> tuple[Decimal, Decimal]:
-        total_usd = Decimal("0")
-        total_cs = Decimal("0")
-        for a in abonos:
-            factor = _abono_factor(getattr(a, "tipo_mov", "ABONO"))
-            total_usd += Decimal(str(a.monto_usd or 0)) * factor
-            total_cs += Decimal(str(a.monto_cs or 0)) * factor
-        return total_usd, total_cs
-
-    for factura in ventas:
+    for factura, abonos_usd, abonos_cs, pagos_usd, pagos_cs in ventas:
         if factura.estado == "ANULADA":
             total_abono_usd = Decimal("0")
             total_abono_cs = Decimal("0")
@@ -33466,16 +33870,17 @@ def sales_cobranza(
             total_vendido_cs += factura_total_cs
             total_vendido_usd += factura_total_usd
             display_total_vendido += _display_amount(factura_total_usd, factura_total_cs)
-            total_abono_usd, total_abono_cs = _abonos_signed_totals(list(factura.abonos or []))
-            total_due_usd = Decimal(str(factura.total_usd or 0))
-            total_due_cs = Decimal(str(factura.total_cs or 0))
+            total_abono_usd = Decimal(abonos_usd)
+            total_abono_cs = Decimal(abonos_cs)
+            total_due_usd = factura_total_usd
+            total_due_cs = factura_total_cs
 
             if factura.estado_cobranza == "PENDIENTE":
                 total_paid_usd = total_abono_usd
                 total_paid_cs = total_abono_cs
             else:
-                total_paid_usd = sum(Decimal(str(p.monto_usd or 0)) for p in factura.pagos) + total_abono_usd
-                total_paid_cs = sum(Decimal(str(p.monto_cs or 0)) for p in factura.pagos) + total_abono_cs
+                total_paid_usd = Decimal(pagos_usd) + total_abono_usd
+                total_paid_cs = Decimal(pagos_cs) + total_abono_cs
 
             saldo_usd = max(total_due_usd - total_paid_usd, Decimal("0"))
             saldo_cs = max(total_due_cs - total_paid_cs, Decimal("0"))
@@ -33499,7 +33904,7 @@ def sales_cobranza(
         )
 
     default_bodega = bodega if len(scoped_bodega_ids) == 1 else None
-    vendedores = _vendedores_for_bodega(db, default_bodega)
+    vendedores, default_vendedor_id = _vendedores_with_default(db, default_bodega)
     clientes = (
         db.query(Cliente)
         .filter(Cliente.activo.is_(True))
@@ -33558,15 +33963,16 @@ def sales_cobranza(
             estado_query = estado_query.filter(VentaFactura.bodega_id.in_(scoped_bodega_ids))
         elif bodega and not include_all_facturas:
             estado_query = estado_query.filter(VentaFactura.bodega_id == bodega.id)
-        estado_facturas = estado_query.order_by(VentaFactura.fecha.desc(), VentaFactura.id.desc()).all()
-        for factura in estado_facturas:
+        estado_facturas = (
+            _with_cobranza_totals(estado_query)
+            .order_by(VentaFactura.fecha.desc(), VentaFactura.id.desc())
+            .all()
+        )
+        for factura, abonos_usd, abonos_cs, pagos_usd, pagos_cs in estado_facturas:
             total_due_usd = Decimal(str(factura.total_usd or 0))
             total_due_cs = Decimal(str(factura.total_cs or 0))
-            total_abono_usd, total_abono_cs = _abonos_signed_totals(list(factura.abonos or []))
-            total_pago_usd = sum(Decimal(str(p.monto_usd or 0)) for p in factura.pagos)
-            total_pago_cs = sum(Decimal(str(p.monto_cs or 0)) for p in factura.pagos)
-            paid_usd = total_abono_usd + total_pago_usd
-            paid_cs = total_abono_cs + total_pago_cs
+            paid_usd = Decimal(abonos_usd) + Decimal(pagos_usd)
+            paid_cs = Decimal(abonos_cs) + Decimal(pagos_cs)
             saldo_usd = max(total_due_usd - paid_usd, Decimal("0"))
             saldo_cs = max(total_due_cs - paid_cs, Decimal("0"))
             cliente_totals["facturado_cs"] += total_due_cs
@@ -33618,7 +34024,7 @@ def sales_cobranza(
                 "abonado_usd": float(cliente_totals["abonado_usd"]),
                 "saldo_usd": float(cliente_totals["saldo_usd"]),
             },
-            "default_vendedor_id": _default_vendedor_id(db, default_bodega),
+            "default_vendedor_id": default_vendedor_id,
             "total_saldo_cs": float(total_saldo_cs),
             "total_saldo_usd": float(total_saldo_usd),
             "total_pacas": float(total_pacas),
@@ -33702,17 +34108,12 @@ def sales_cobranza_detalle_filtrado(
     if producto_q:
         query = query.join(VentaItem).join(Producto).filter(
             or_(
-                func.lower(Producto.cod_producto).like(f"%{producto_q.lower()}%"),
-                func.lower(Producto.descripcion).like(f"%{producto_q.lower()}%"),
+                Producto.cod_producto.ilike(f"%{producto_q}%"),
+                Producto.descripcion.ilike(f"%{producto_q}%"),
             )
         )
     facturas = query.order_by(VentaFactura.fecha.desc(), VentaFactura.id.desc()).all()
-    rate_today = (
-        db.query(ExchangeRate)
-        .filter(ExchangeRate.effective_date <= local_today())
-        .order_by(ExchangeRate.effective_date.desc())
-        .first()
-    )
+    rate_today = _latest_exchange_rate(db, request)
     tasa_actual = Decimal(str(rate_today.rate if rate_today else 0))
 
     def _money_views(amount_usd: Decimal, amount_cs: Decimal) -> tuple[Decimal, Decimal]:
@@ -33790,6 +34191,137 @@ def sales_cobranza_detalle_filtrado(
     )
 
 
+def _render_cobranza_pdf(
+    *,
+    logo_path: Path,
+    branch_name: str,
+    start_date: Optional[date],
+    end_date: Optional[date],
+    vendedor_name: Optional[str],
+    rate_label: str,
+    resumen: dict[str, dict[str, Decimal]],
+    rows: list[dict[str, object]],
+    total_saldo_cs: Decimal,
+    total_saldo_usd: Decimal,
+) -> bytes:
+    # Render puro (sin sesion de BD) para poder ejecutarlo fuera del handler.
+    buffer = io.BytesIO()
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import letter
+
+    c = canvas.Canvas(buffer, pagesize=letter)
+    width, height = letter
+    y = height - 40
+    if logo_path.exists():
+        c.drawImage(str(logo_path), 40, y - 30, width=90, height=30, mask="auto")
+    c.setFont("Times-Bold", 14)
+    c.drawString(150, y - 8, "Informe de Cuentas por Cobrar")
+    y -= 35
+    c.setFont("Times-Roman", 10)
+    c.drawString(40, y, f"Sucursal: {branch_name}")
+    y -= 14
+    start_label = start_date.isoformat() if start_date else "Todo"
+    end_label = end_date.isoformat() if end_date else "Todo"
+    c.drawString(40, y, f"Rango: {start_label} a {end_label}")
+    y -= 14
+    if vendedor_name is not None:
+        c.drawString(40, y, f"Vendedor: {vendedor_name}")
+        y -= 14
+    c.drawString(40, y, f"Tasa: {rate_label}")
+    y -= 16
+    c.line(40, y, width - 40, y)
+    y -= 16
+
+    c.setFont("Times-Bold", 11)
+    c.drawString(40, y, "Resumen por vendedor")
+    y -= 12
+    c.setFont("Times-Bold", 9)
+    c.drawString(50, y, "Vendedor")
+    c.drawString(320, y, "Saldo C$")
+    c.drawString(430, y, "Saldo $")
+    y -= 8
+    c.line(40, y, width - 40, y)
+    y -= 10
+    c.setFont("Times-Roman", 9)
+    resumen_total_cs = Decimal("0")
+    resumen_total_usd = Decimal("0")
+    for vend, totals in resumen.items():
+        if y < 120:
+            c.showPage()
+            y = height - 60
+        c.drawString(50, y, vend)
+        c.setFillColor(colors.HexColor("#1d4ed8"))
+        c.drawRightString(400, y, f"C$ {totals['cs']:,.2f}")
+        c.setFillColor(colors.HexColor("#16a34a"))
+        c.drawRightString(500, y, f"$ {totals['usd']:,.2f}")
+        c.setFillColor(colors.black)
+        resumen_total_cs += totals["cs"]
+        resumen_total_usd += totals["usd"]
+        y -= 12
+
+    y -= 4
+    c.setFillColor(colors.HexColor("#1e3a8a"))
+    c.roundRect(40, y - 6, width - 80, 12, 4, fill=1, stroke=0)
+    c.setFillColor(colors.white)
+    c.setFont("Times-Bold", 9)
+    c.drawString(50, y - 2, "Total resumen")
+    c.drawRightString(400, y - 2, f"C$ {resumen_total_cs:,.2f}")
+    c.drawRightString(500, y - 2, f"$ {resumen_total_usd:,.2f}")
+    c.setFillColor(colors.black)
+    y -= 18
+
+    c.setFillColor(colors.HexColor("#1e3a8a"))
+    c.roundRect(40, y - 6, width - 80, 12, 4, fill=1, stroke=0)
+    c.setFillColor(colors.white)
+    c.setFont("Times-Bold", 9)
+    c.drawString(50, y - 2, "Detalle de creditos")
+    c.setFillColor(colors.black)
+    y -= 18
+
+    c.setFillColor(colors.black)
+    c.setFont("Times-Bold", 11)
+    c.setFont("Times-Bold", 9)
+    c.drawString(40, y, "Factura")
+    c.drawString(110, y, "Cliente")
+    c.drawString(260, y, "Vendedor")
+    c.drawString(370, y, "Estado")
+    c.drawString(430, y, "Saldo C$")
+    c.drawString(510, y, "Saldo $")
+    y -= 8
+    c.line(40, y, width - 40, y)
+    y -= 12
+    c.setFont("Times-Roman", 9)
+    for row in rows:
+        if y < 80:
+            c.showPage()
+            y = height - 60
+        c.drawString(40, y, row["numero"])
+        c.drawString(110, y, (row["cliente"][:20] + "...") if len(row["cliente"]) > 20 else row["cliente"])
+        c.drawString(260, y, (row["vendedor"][:14] + "...") if len(row["vendedor"]) > 14 else row["vendedor"])
+        c.drawString(370, y, row["estado"])
+        c.setFillColor(colors.HexColor("#1d4ed8"))
+        c.drawRightString(495, y, f"C$ {row['saldo_cs']:,.2f}")
+        c.setFillColor(colors.HexColor("#16a34a"))
+        c.drawRightString(570, y, f"$ {row['saldo_usd']:,.2f}")
+        c.setFillColor(colors.black)
+        y -= 12
+
+    y -= 4
+    c.line(40, y, width - 40, y)
+    y -= 14
+    c.setFont("Times-Bold", 10)
+    c.drawString(40, y, "Totales pendientes:")
+    c.setFillColor(colors.HexColor("#1d4ed8"))
+    c.drawRightString(495, y, f"C$ {total_saldo_cs:,.2f}")
+    c.setFillColor(colors.HexColor("#16a34a"))
+    c.drawRightString(570, y, f"$ {total_saldo_usd:,.2f}")
+    c.setFillColor(colors.black)
+    y -= 14
+    c.showPage()
+    c.save()
+    return buffer.getvalue()
+
+
 @router.get("/sales/cobranza/export")
 def sales_cobranza_export(
     request: Request,
@@ -33834,7 +34366,10 @@ def sales_cobranza_export(
     if include_all_facturas:
         scoped_bodega_ids = []
     _, bodega = _resolve_branch_bodega(db, user)
-    ventas_query = db.query(VentaFactura)
+    ventas_query = db.query(VentaFactura).options(
+        joinedload(VentaFactura.vendedor),
+        joinedload(VentaFactura.cliente),
+    )
     if not include_all_facturas:
         ventas_query = ventas_query.filter(VentaFactura.condicion_venta == "CREDITO")
     if scoped_bodega_ids:
@@ -33859,52 +34394,40 @@ def sales_cobranza_export(
     if producto_q:
         ventas_query = ventas_query.join(VentaItem).join(Producto).filter(
             or_(
-                func.lower(Producto.cod_producto).like(f"%{producto_q.lower()}%"),
-                func.lower(Producto.descripcion).like(f"%{producto_q.lower()}%"),
+                Producto.cod_producto.ilike(f"%{producto_q}%"),
+                Producto.descripcion.ilike(f"%{producto_q}%"),
             )
         )
-    ventas = ventas_query.order_by(VentaFactura.fecha.desc(), VentaFactura.id.desc()).all()
-
-    rate_today = (
-        db.query(ExchangeRate)
-        .filter(ExchangeRate.effective_date <= local_today())
-        .order_by(ExchangeRate.effective_date.desc())
-        .first()
+    ventas = (
+        _with_cobranza_totals(ventas_query)
+        .order_by(VentaFactura.fecha.desc(), VentaFactura.id.desc())
+        .all()
     )
-    tasa = Decimal(str(rate_today.rate)) if rate_today else Decimal("0")
-
-    def _abono_factor(tipo_mov: Optional[str]) -> Decimal:
-        return Decimal("-1") if (tipo_mov or "").strip().upper() == "NOTA_DEBITO" else Decimal("1")
 
-    def _abonos_signed_totals(abonos: list[CobranzaAbono]) -> tuple[Decimal, Decimal]:
-        total_usd = Decimal("0")
-        total_cs = Decimal("0")
-        for a in abonos:
-            factor = _abono_factor(getattr(a, "tipo_mov", "ABONO"))
-            total_usd += Decimal(str(a.monto_usd or 0)) * factor
-            total_cs += Decimal(str(a.monto_cs or 0)) * factor
-        return total_usd, total_cs
+    rate_today = _latest_exchange_rate(db, request)
+    tasa = Decimal(str(rate_today.rate)) if rate_today else Decimal("0")
 
     rows = []
     resumen = {}
     total_saldo_cs = Decimal("0")
     total_saldo_usd = Decimal("0")
-    for factura in ventas:
+    for factura, abonos_usd, abonos_cs, pagos_usd, pagos_cs in ventas:
         if factura.estado == "ANULADA":
             total_abono_usd = Decimal("0")
             total_abono_cs = Decimal("0")
             saldo_usd = Decimal("0")
             saldo_cs = Decimal("0")
         else:
-            total_abono_usd, total_abono_cs = _abonos_signed_totals(list(factura.abonos or []))
+            total_abono_usd = Decimal(abonos_usd)
+            total_abono_cs = Decimal(abonos_cs)
             total_due_usd = Decimal(str(factura.total_usd or 0))
             total_due_cs = Decimal(str(factura.total_cs or 0))
             if factura.estado_cobranza == "PENDIENTE":
                 total_paid_usd = total_abono_usd
                 total_paid_cs = total_abono_cs
             else:
-                total_paid_usd = sum(Decimal(str(p.monto_usd or 0)) for p in factura.pagos) + total_abono_usd
-                total_paid_cs = sum(Decimal(str(p.monto_cs or 0)) for p in factura.pagos) + total_abono_cs
+                total_paid_usd = Decimal(pagos_usd) + total_abono_usd
+                total_paid_cs = Decimal(pagos_cs) + total_abono_cs
             saldo_usd = max(total_due_usd - total_paid_usd, Decimal("0"))
             saldo_cs = max(total_due_cs - total_paid_cs, Decimal("0"))
             total_saldo_cs += saldo_cs
@@ -33928,130 +34451,33 @@ def sales_cobranza_export(
     if format.lower() != "pdf":
         return JSONResponse({"ok": False, "message": "Formato no soportado"}, status_code=400)
 
-    buffer = io.BytesIO()
-    from reportlab.pdfgen import canvas
-    from reportlab.lib.pagesizes import letter
-
-    c = canvas.Canvas(buffer, pagesize=letter)
-    width, height = letter
-    y = height - 40
-    logo_path = _resolve_logo_path(company_profile.get("logo_url", ""))
-    if logo_path.exists():
-        c.drawImage(str(logo_path), 40, y - 30, width=90, height=30, mask="auto")
-    c.setFont("Times-Bold", 14)
-    c.drawString(150, y - 8, "Informe de Cuentas por Cobrar")
-    y -= 35
-    c.setFont("Times-Roman", 10)
     branch_name = "Todas"
     if len(scoped_bodegas) == 1 and scoped_bodegas[0].branch:
         branch_name = scoped_bodegas[0].branch.name
     elif not scoped_bodegas and bodega and bodega.branch:
         branch_name = bodega.branch.name
-    c.drawString(40, y, f"Sucursal: {branch_name}")
-    y -= 14
-    start_label = start_date.isoformat() if start_date else "Todo"
-    end_label = end_date.isoformat() if end_date else "Todo"
-    c.drawString(40, y, f"Rango: {start_label} a {end_label}")
-    y -= 14
+    vendedor_name = None
     if vendedor_q:
-        vendedor_name = next((v.nombre for v in db.query(Vendedor).all() if str(v.id) == vendedor_q), "")
-        c.drawString(40, y, f"Vendedor: {vendedor_name}")
-        y -= 14
-    c.drawString(40, y, f"Tasa: {rate_today.rate if rate_today else 'N/D'}")
-    y -= 16
-    c.line(40, y, width - 40, y)
-    y -= 16
-
-    c.setFont("Times-Bold", 11)
-    c.drawString(40, y, "Resumen por vendedor")
-    y -= 12
-    c.setFont("Times-Bold", 9)
-    c.drawString(50, y, "Vendedor")
-    c.drawString(320, y, "Saldo C$")
-    c.drawString(430, y, "Saldo $")
-    y -= 8
-    c.line(40, y, width - 40, y)
-    y -= 10
-    c.setFont("Times-Roman", 9)
-    resumen_total_cs = Decimal("0")
-    resumen_total_usd = Decimal("0")
-    for vend, totals in resumen.items():
-        if y < 120:
-            c.showPage()
-            y = height - 60
-        c.drawString(50, y, vend)
-        c.setFillColor(colors.HexColor("#1d4ed8"))
-        c.drawRightString(400, y, f"C$ {totals['cs']:,.2f}")
-        c.setFillColor(colors.HexColor("#16a34a"))
-        c.drawRightString(500, y, f"$ {totals['usd']:,.2f}")
-        c.setFillColor(colors.black)
-        resumen_total_cs += totals["cs"]
-        resumen_total_usd += totals["usd"]
-        y -= 12
-
-    y -= 4
-    c.setFillColor(colors.HexColor("#1e3a8a"))
-    c.roundRect(40, y - 6, width - 80, 12, 4, fill=1, stroke=0)
-    c.setFillColor(colors.white)
-    c.setFont("Times-Bold", 9)
-    c.drawString(50, y - 2, "Total resumen")
-    c.drawRightString(400, y - 2, f"C$ {resumen_total_cs:,.2f}")
-    c.drawRightString(500, y - 2, f"$ {resumen_total_usd:,.2f}")
-    c.setFillColor(colors.black)
-    y -= 18
-
-    c.setFillColor(colors.HexColor("#1e3a8a"))
-    c.roundRect(40, y - 6, width - 80, 12, 4, fill=1, stroke=0)
-    c.setFillColor(colors.white)
-    c.setFont("Times-Bold", 9)
-    c.drawString(50, y - 2, "Detalle de creditos")
-    c.setFillColor(colors.black)
-    y -= 18
-
-    c.setFillColor(colors.black)
-    c.setFont("Times-Bold", 11)
-    c.setFont("Times-Bold", 9)
-    c.drawString(40, y, "Factura")
-    c.drawString(110, y, "Cliente")
-    c.drawString(260, y, "Vendedor")
-    c.drawString(370, y, "Estado")
-    c.drawString(430, y, "Saldo C$")
-    c.drawString(510, y, "Saldo $")
-    y -= 8
-    c.line(40, y, width - 40, y)
-    y -= 12
-    c.setFont("Times-Roman", 9)
-    for row in rows:
-        if y < 80:
-            c.showPage()
-            y = height - 60
-        c.drawString(40, y, row["numero"])
-        c.drawString(110, y, (row["cliente"][:20] + "...") if len(row["cliente"]) > 20 else row["cliente"])
-        c.drawString(260, y, (row["vendedor"][:14] + "...") if len(row["vendedor"]) > 14 else row["vendedor"])
-        c.drawString(370, y, row["estado"])
-        c.setFillColor(colors.HexColor("#1d4ed8"))
-        c.drawRightString(495, y, f"C$ {row['saldo_cs']:,.2f}")
-        c.setFillColor(colors.HexColor("#16a34a"))
-        c.drawRightString(570, y, f"$ {row['saldo_usd']:,.2f}")
-        c.setFillColor(colors.black)
-        y -= 12
-
-    y -= 4
-    c.line(40, y, width - 40, y)
-    y -= 14
-    c.setFont("Times-Bold", 10)
-    c.drawString(40, y, "Totales pendientes:")
-    c.setFillColor(colors.HexColor("#1d4ed8"))
-    c.drawRightString(495, y, f"C$ {total_saldo_cs:,.2f}")
-    c.setFillColor(colors.HexColor("#16a34a"))
-    c.drawRightString(570, y, f"$ {total_saldo_usd:,.2f}")
-    c.setFillColor(colors.black)
-    y -= 14
-    c.showPage()
-    c.save()
-    buffer.seek(0)
-    return StreamingResponse(
-        buffer,
+        try:
+            vendedor_name = db.query(Vendedor.nombre).filter(Vendedor.id == int(vendedor_q)).scalar() or ""
+        except ValueError:
+            vendedor_name = ""
+    pdf_bytes = _render_cobranza_pdf(
+        logo_path=_resolve_logo_path(company_profile.get("logo_url", "")),
+        branch_name=branch_name,
+        start_date=start_date,
+        end_date=end_date,
+        vendedor_name=vendedor_name,
+        rate_label=str(rate_today.rate) if rate_today else "N/D",
+        resumen=resumen,
+        rows=rows,
+        total_saldo_cs=total_saldo_cs,
+        total_saldo_usd=total_saldo_usd,
+    )
+    # ReportLab arma el documento completo en memoria al guardar; se envia tal cual
+    # (con Content-Length) en lugar de envolverlo de nuevo en un BytesIO.
+    return Response(
+        content=pdf_bytes,
         media_type="application/pdf",
         headers={"Content-Disposition": "attachment; filename=cobranza.pdf"},
     )
@@ -34178,11 +34604,144 @@ def _cobranza_abonos_totals(abonos: list[CobranzaAbono]) -> tuple[Decimal, Decim
     total_cs = Decimal("0")
     for abono in abonos:
         factor = _cobranza_abono_factor(getattr(abono, "tipo_mov", "ABONO"))
-        total_usd += Decimal(str(abono.monto_usd or 0)) * factor
-        total_cs += Decimal(str(abono.monto_cs or 0)) * factor
+        total_usd += (abono.monto_usd or Decimal("0")) * factor
+        total_cs += (abono.monto_cs or Decimal("0")) * factor
     return total_usd, total_cs
 
 
+def _cobranza_abono_sign_expr():
+    # Version SQL de _cobranza_abono_factor: NOTA_DEBITO resta, el resto suma.
+    return case((func.upper(func.trim(CobranzaAbono.tipo_mov)) == "NOTA_DEBITO", -1), else_=1)
+
+
+def _cobranza_error(message: str, status_code: int) -> JSONResponse:
+    return JSONResponse({"ok": False, "message": message}, status_code=status_code)
+
+
+def _parse_cobranza_movimiento(form) -> tuple[Optional[tuple[str, str, Decimal, str, bool]], Optional[JSONResponse]]:
+    # Campos comunes del formulario de abono / nota; devuelve (valores, None) o (None, error).
+    tipo_mov = (form.get("tipo_mov") or "ABONO").strip().upper()
+    moneda = (form.get("moneda") or "CS").upper()
+    monto_raw = form.get("monto")
+    observacion = (form.get("observacion") or "").strip()
+    afecta_caja = (form.get("afecta_caja") or "").strip().lower() in {"1", "true", "on", "yes"}
+    if not monto_raw:
+        return None, _cobranza_error("Monto requerido", 400)
+    if moneda not in {"CS", "USD"}:
+        return None, _cobranza_error("Moneda invalida", 400)
+    if tipo_mov not in {"ABONO", "NOTA_CREDITO", "NOTA_DEBITO"}:
+        return None, _cobranza_error("Tipo de movimiento invalido", 400)
+    monto = _parse_money_decimal(monto_raw)
+    if monto <= 0:
+        return None, _cobranza_error("Monto invalido", 400)
+    return (tipo_mov, moneda, monto, observacion, afecta_caja), None
+
+
+def _load_cobranza_ctx(
+    db: Session,
+    request: Request,
+    user: User,
+    venta_id: int,
+    *,
+    moneda: Optional[str] = None,
+    reject_anulada: bool = False,
+    with_branch: bool = False,
+) -> tuple[Optional[VentaFactura], Decimal, Optional[JSONResponse]]:
+    # Preambulo de los handlers de cobranza: factura, alcance de bodega y,
+    # si se indica moneda, la tasa vigente. Devuelve (factura, tasa, error).
+    options = [joinedload(VentaFactura.bodega).joinedload(Bodega.branch)] if with_branch else None
+    factura = db.get(VentaFactura, venta_id, options=options)
+    if not factura:
+        return None, Decimal("0"), _cobranza_error("Factura no encontrada", 404)
+    if reject_anulada and factura.estado == "ANULADA":
+        return None, Decimal("0"), _cobranza_error("Factura anulada", 400)
+    _, bodega = _resolve_branch_bodega(db, user)
+    if bodega and factura.bodega_id != bodega.id:
+        return None, Decimal("0"), _cobranza_error("Factura fuera de tu bodega", 403)
+    tasa = Decimal("0")
+    if moneda is not None:
+        rate_today = _latest_exchange_rate(db, request)
+        if moneda == "USD" and not rate_today:
+            return None, Decimal("0"), _cobranza_error("Tasa no configurada", 400)
+        tasa = Decimal(str(rate_today.rate)) if rate_today else Decimal("0")
+    return factura, tasa, None
+
+
+def _cobranza_signed_cents(monto: Decimal, tipo_mov: Optional[str]) -> Decimal:
+    # Monto firmado redondeado como lo guarda la columna Numeric(14, 2).
+    return (Decimal(str(monto or 0)) * _cobranza_abono_factor(tipo_mov)).quantize(
+        Decimal("0.01"), rounding=ROUND_HALF_UP
+    )
+
+
+def _apply_cobranza_abono_delta(
+    db: Session,
+    factura: VentaFactura,
+    delta_usd: Decimal,
+    delta_cs: Decimal,
+) -> None:
+    # Ajusta el acumulado persistido de abonos con un UPDATE atomico (no se
+    # pierden incrementos concurrentes) y recalcula el estado sin sumar abonos.
+    stmt = (
+        update(VentaFactura)
+        .where(VentaFactura.id == factura.id)
+        .values(
+            total_abonado_usd=func.coalesce(VentaFactura.total_abonado_usd, 0) + delta_usd,
+            total_abonado_cs=func.coalesce(VentaFactura.total_abonado_cs, 0) + delta_cs,
+        )
+        .returning(VentaFactura.total_abonado_usd, VentaFactura.total_abonado_cs)
+        .execution_options(synchronize_session=False)
+    )
+    total_usd, total_cs = db.execute(stmt).one()
+    if (factura.moneda or "CS") == "USD":
+        paid, due = Decimal(total_usd), Decimal(str(factura.total_usd or 0))
+    else:
+        paid, due = Decimal(total_cs), Decimal(str(factura.total_cs or 0))
+    factura.estado_cobranza = "PAGADA" if paid >= due else "PENDIENTE"
+
+
+def _cobranza_abonos_totals_subquery():
+    # Totales firmados de abonos por factura (NOTA_DEBITO resta), calculados en SQL.
+    factor = _cobranza_abono_sign_expr()
+    return (
+        select(
+            CobranzaAbono.factura_id.label("factura_id"),
+            func.sum(CobranzaAbono.monto_usd * factor).label("abonos_usd"),
+            func.sum(CobranzaAbono.monto_cs * factor).label("abonos_cs"),
+        )
+        .group_by(CobranzaAbono.factura_id)
+        .subquery()
+    )
+
+
+def _cobranza_pagos_totals_subquery():
+    return (
+        select(
+            VentaPago.factura_id.label("factura_id"),
+            func.sum(VentaPago.monto_usd).label("pagos_usd"),
+            func.sum(VentaPago.monto_cs).label("pagos_cs"),
+        )
+        .group_by(VentaPago.factura_id)
+        .subquery()
+    )
+
+
+def _with_cobranza_totals(query):
+    """Agrega a una consulta de VentaFactura los totales de abonos y pagos por factura."""
+    abonos_sq = _cobranza_abonos_totals_subquery()
+    pagos_sq = _cobranza_pagos_totals_subquery()
+    return (
+        query.outerjoin(abonos_sq, abonos_sq.c.factura_id == VentaFactura.id)
+        .outerjoin(pagos_sq, pagos_sq.c.factura_id == VentaFactura.id)
+        .add_columns(
+            func.coalesce(abonos_sq.c.abonos_usd, 0),
+            func.coalesce(abonos_sq.c.abonos_cs, 0),
+            func.coalesce(pagos_sq.c.pagos_usd, 0),
+            func.coalesce(pagos_sq.c.pagos_cs, 0),
+        )
+    )
+
+
 @router.get("/sales/cobranza/{venta_id}/abonos")
 def sales_cobranza_abonos(
     request: Request,
@@ -34191,12 +34750,9 @@ def sales_cobranza_abonos(
     user: User = Depends(_require_user_web),
 ):
     _enforce_permission(request, user, "access.sales.cobranza")
-    factura = db.query(VentaFactura).filter(VentaFactura.id == venta_id).first()
-    if not factura:
-        return JSONResponse({"ok": False, "message": "Factura no encontrada"}, status_code=404)
-    _, bodega = _resolve_branch_bodega(db, user)
-    if bodega and factura.bodega_id != bodega.id:
-        return JSONResponse({"ok": False, "message": "Factura fuera de tu bodega"}, status_code=403)
+    factura, _tasa, error = _load_cobranza_ctx(db, request, user, venta_id)
+    if error:
+        return error
     abonos = (
         db.query(CobranzaAbono)
         .filter(CobranzaAbono.factura_id == factura.id)
@@ -34212,7 +34768,7 @@ def sales_cobranza_abonos(
             {
                 "id": abono.id,
                 "numero": abono.numero,
-                "fecha": abono.fecha.isoformat() if abono.fecha else "",
+                "fecha": abono.fecha or "",
                 "tipo_mov": tipo_mov,
                 "naturaleza": "AUMENTA" if tipo_mov == "NOTA_DEBITO" else "DISMINUYE",
                 "moneda": abono.moneda,
@@ -34221,7 +34777,8 @@ def sales_cobranza_abonos(
                 "afecta_caja": bool(getattr(abono, "afecta_caja", False)),
             }
         )
-    return JSONResponse({"ok": True, "items": items})
+    # orjson serializa la fecha directamente (ISO "YYYY-MM-DD").
+    return ORJSONResponse({"ok": True, "items": items})
 
 
 @router.post("/sales/cobranza/{venta_id}/abono")
@@ -34233,65 +34790,23 @@ async def sales_cobranza_abono(
 ):
     _enforce_permission(request, user, "access.sales.pagos")
     form = await request.form()
-    tipo_mov = (form.get("tipo_mov") or "ABONO").strip().upper()
-    moneda = (form.get("moneda") or "CS").upper()
-    monto_raw = form.get("monto")
-    observacion = (form.get("observacion") or "").strip()
-    afecta_caja = (form.get("afecta_caja") or "").strip().lower() in {"1", "true", "on", "yes"}
+    return await run_in_threadpool(_sales_cobranza_abono_sync, venta_id, request, form, db, user)
+
+
+def _sales_cobranza_abono_sync(venta_id: int, request: Request, form, db: Session, user: User):
     return_to = (form.get("return_to") or "/sales/cobranza").strip()
     if not return_to.startswith("/sales/cobranza"):
         return_to = "/sales/cobranza"
-    if not monto_raw:
-        return JSONResponse({"ok": False, "message": "Monto requerido"}, status_code=400)
-    if moneda not in {"CS", "USD"}:
-        return JSONResponse({"ok": False, "message": "Moneda invalida"}, status_code=400)
-    if tipo_mov not in {"ABONO", "NOTA_CREDITO", "NOTA_DEBITO"}:
-        return JSONResponse({"ok": False, "message": "Tipo de movimiento invalido"}, status_code=400)
+    movimiento, error = _parse_cobranza_movimiento(form)
+    if error:
+        return error
+    tipo_mov, moneda, monto, observacion, afecta_caja = movimiento
 
-    def parse_decimal(value: str) -> Decimal:
-        raw = re.sub(r"[^0-9.,-]", "", str(value or "0"))
-        if "," in raw and "." in raw:
-            if raw.rfind(",") > raw.rfind("."):
-                raw = raw.replace(".", "").replace(",", ".")
-            else:
-                raw = raw.replace(",", "")
-        elif "," in raw and "." not in raw:
-            parts = raw.split(",")
-            if len(parts) == 2 and len(parts[1]) == 2:
-                raw = raw.replace(",", ".")
-            else:
-                raw = raw.replace(",", "")
-        elif "." in raw and "," not in raw:
-            parts = raw.split(".")
-            if not (len(parts) == 2 and len(parts[1]) == 2):
-                raw = raw.replace(".", "")
-        try:
-            return Decimal(raw)
-        except Exception:
-            return Decimal("0")
-
-    monto = parse_decimal(monto_raw)
-    if monto <= 0:
-        return JSONResponse({"ok": False, "message": "Monto invalido"}, status_code=400)
-
-    factura = db.query(VentaFactura).filter(VentaFactura.id == venta_id).first()
-    if not factura:
-        return JSONResponse({"ok": False, "message": "Factura no encontrada"}, status_code=404)
-    if factura.estado == "ANULADA":
-        return JSONResponse({"ok": False, "message": "Factura anulada"}, status_code=400)
-    _, bodega = _resolve_branch_bodega(db, user)
-    if bodega and factura.bodega_id != bodega.id:
-        return JSONResponse({"ok": False, "message": "Factura fuera de tu bodega"}, status_code=403)
-
-    rate_today = (
-        db.query(ExchangeRate)
-        .filter(ExchangeRate.effective_date <= local_today())
-        .order_by(ExchangeRate.effective_date.desc())
-        .first()
+    factura, tasa, error = _load_cobranza_ctx(
+        db, request, user, venta_id, moneda=moneda, reject_anulada=True, with_branch=True
     )
-    if moneda == "USD" and not rate_today:
-        return JSONResponse({"ok": False, "message": "Tasa no configurada"}, status_code=400)
-    tasa = Decimal(str(rate_today.rate)) if rate_today else Decimal("0")
+    if error:
+        return error
 
     if moneda == "USD":
         monto_usd = monto
@@ -34331,18 +34846,12 @@ async def sales_cobranza_abono(
         usuario_registro=user.full_name,
     )
     db.add(abono)
-
-    existing_paid_usd, existing_paid_cs = _cobranza_abonos_totals(list(factura.abonos or []))
-    factor = _cobranza_abono_factor(tipo_mov)
-    total_paid_usd = existing_paid_usd + (monto_usd * factor)
-    total_paid_cs = existing_paid_cs + (monto_cs * factor)
-    due_usd = Decimal(str(factura.total_usd or 0))
-    due_cs = Decimal(str(factura.total_cs or 0))
-    if (factura.moneda or "CS") == "USD":
-        factura.estado_cobranza = "PAGADA" if total_paid_usd >= due_usd else "PENDIENTE"
-    else:
-        factura.estado_cobranza = "PAGADA" if total_paid_cs >= due_cs else "PENDIENTE"
-
+    _apply_cobranza_abono_delta(
+        db,
+        factura,
+        _cobranza_signed_cents(monto_usd, tipo_mov),
+        _cobranza_signed_cents(monto_cs, tipo_mov),
+    )
     db.commit()
     active_company_key = (get_active_company_key() or "").strip().lower()
     db_name = _current_db_name().lower()
@@ -34380,64 +34889,29 @@ async def sales_cobranza_abono_update(
 ):
     _enforce_permission(request, user, "access.sales.pagos")
     form = await request.form()
-    tipo_mov = (form.get("tipo_mov") or "ABONO").strip().upper()
-    moneda = (form.get("moneda") or "CS").upper()
-    monto_raw = form.get("monto")
-    observacion = (form.get("observacion") or "").strip()
-    afecta_caja = (form.get("afecta_caja") or "").strip().lower() in {"1", "true", "on", "yes"}
-    if not monto_raw:
-        return JSONResponse({"ok": False, "message": "Monto requerido"}, status_code=400)
-    if moneda not in {"CS", "USD"}:
-        return JSONResponse({"ok": False, "message": "Moneda invalida"}, status_code=400)
-    if tipo_mov not in {"ABONO", "NOTA_CREDITO", "NOTA_DEBITO"}:
-        return JSONResponse({"ok": False, "message": "Tipo de movimiento invalido"}, status_code=400)
-
-    def parse_decimal(value: str) -> Decimal:
-        raw = re.sub(r"[^0-9.,-]", "", str(value or "0"))
-        if "," in raw and "." in raw:
-            if raw.rfind(",") > raw.rfind("."):
-                raw = raw.replace(".", "").replace(",", ".")
-            else:
-                raw = raw.replace(",", "")
-        elif "," in raw and "." not in raw:
-            parts = raw.split(",")
-            if len(parts) == 2 and len(parts[1]) == 2:
-                raw = raw.replace(",", ".")
-            else:
-                raw = raw.replace(",", "")
-        elif "." in raw and "," not in raw:
-            parts = raw.split(".")
-            if not (len(parts) == 2 and len(parts[1]) == 2):
-                raw = raw.replace(".", "")
-        try:
-            return Decimal(raw)
-        except Exception:
-            return Decimal("0")
+    return await run_in_threadpool(_sales_cobranza_abono_update_sync, venta_id, abono_id, request, form, db, user)
 
-    monto = parse_decimal(monto_raw)
-    if monto <= 0:
-        return JSONResponse({"ok": False, "message": "Monto invalido"}, status_code=400)
 
-    factura = db.query(VentaFactura).filter(VentaFactura.id == venta_id).first()
-    if not factura:
-        return JSONResponse({"ok": False, "message": "Factura no encontrada"}, status_code=404)
-    _, bodega = _resolve_branch_bodega(db, user)
-    if bodega and factura.bodega_id != bodega.id:
-        return JSONResponse({"ok": False, "message": "Factura fuera de tu bodega"}, status_code=403)
+def _sales_cobranza_abono_update_sync(
+    venta_id: int,
+    abono_id: int,
+    request: Request,
+    form,
+    db: Session,
+    user: User,
+):
+    movimiento, error = _parse_cobranza_movimiento(form)
+    if error:
+        return error
+    tipo_mov, moneda, monto, observacion, afecta_caja = movimiento
 
-    abono = db.query(CobranzaAbono).filter(CobranzaAbono.id == abono_id, CobranzaAbono.factura_id == factura.id).first()
-    if not abono:
-        return JSONResponse({"ok": False, "message": "Abono no encontrado"}, status_code=404)
+    factura, tasa, error = _load_cobranza_ctx(db, request, user, venta_id, moneda=moneda)
+    if error:
+        return error
 
-    rate_today = (
-        db.query(ExchangeRate)
-        .filter(ExchangeRate.effective_date <= local_today())
-        .order_by(ExchangeRate.effective_date.desc())
-        .first()
-    )
-    if moneda == "USD" and not rate_today:
-        return JSONResponse({"ok": False, "message": "Tasa no configurada"}, status_code=400)
-    tasa = Decimal(str(rate_today.rate)) if rate_today else Decimal("0")
+    abono = db.get(CobranzaAbono, abono_id)
+    if not abono or abono.factura_id != factura.id:
+        return _cobranza_error("Abono no encontrado", 404)
 
     if moneda == "USD":
         monto_usd = monto
@@ -34446,6 +34920,8 @@ async def sales_cobranza_abono_update(
         monto_cs = monto
         monto_usd = monto / tasa if tasa else Decimal("0")
 
+    delta_usd = _cobranza_signed_cents(monto_usd, tipo_mov) - _cobranza_signed_cents(abono.monto_usd, abono.tipo_mov)
+    delta_cs = _cobranza_signed_cents(monto_cs, tipo_mov) - _cobranza_signed_cents(abono.monto_cs, abono.tipo_mov)
     abono.tipo_mov = tipo_mov
     abono.moneda = moneda
     abono.tasa_cambio = tasa if tasa else None
@@ -34453,15 +34929,7 @@ async def sales_cobranza_abono_update(
     abono.monto_cs = monto_cs
     abono.afecta_caja = afecta_caja if _is_shoes_mode() else False
     abono.observacion = observacion
-    db.commit()
-
-    total_abono_usd, total_abono_cs = _cobranza_abonos_totals(list(factura.abonos or []))
-    due_usd = Decimal(str(factura.total_usd or 0))
-    due_cs = Decimal(str(factura.total_cs or 0))
-    if (factura.moneda or "CS") == "USD":
-        factura.estado_cobranza = "PAGADA" if total_abono_usd >= due_usd else "PENDIENTE"
-    else:
-        factura.estado_cobranza = "PAGADA" if total_abono_cs >= due_cs else "PENDIENTE"
+    _apply_cobranza_abono_delta(db, factura, delta_usd, delta_cs)
     db.commit()
 
     return JSONResponse({"ok": True, "message": "Movimiento actualizado"})
@@ -34476,32 +34944,21 @@ def sales_cobranza_abono_delete(
     user: User = Depends(_require_user_web),
 ):
     _enforce_permission(request, user, "access.sales.pagos")
-    factura = db.query(VentaFactura).filter(VentaFactura.id == venta_id).first()
-    if not factura:
-        return JSONResponse({"ok": False, "message": "Factura no encontrada"}, status_code=404)
-    if factura.estado == "ANULADA":
-        return JSONResponse({"ok": False, "message": "Factura anulada"}, status_code=400)
-    _, bodega = _resolve_branch_bodega(db, user)
-    if bodega and factura.bodega_id != bodega.id:
-        return JSONResponse({"ok": False, "message": "Factura fuera de tu bodega"}, status_code=403)
+    factura, _tasa, error = _load_cobranza_ctx(db, request, user, venta_id, reject_anulada=True)
+    if error:
+        return error
 
-    abono = (
-        db.query(CobranzaAbono)
-        .filter(CobranzaAbono.id == abono_id, CobranzaAbono.factura_id == factura.id)
-        .first()
-    )
-    if not abono:
-        return JSONResponse({"ok": False, "message": "Abono no encontrado"}, status_code=404)
+    abono = db.get(CobranzaAbono, abono_id)
+    if not abono or abono.factura_id != factura.id:
+        return _cobranza_error("Abono no encontrado", 404)
 
+    _apply_cobranza_abono_delta(
+        db,
+        factura,
+        -_cobranza_signed_cents(abono.monto_usd, abono.tipo_mov),
+        -_cobranza_signed_cents(abono.monto_cs, abono.tipo_mov),
+    )
     db.delete(abono)
-
-    total_abono_usd, total_abono_cs = _cobranza_abonos_totals([a for a in factura.abonos if a.id != abono_id])
-    due_usd = Decimal(str(factura.total_usd or 0))
-    due_cs = Decimal(str(factura.total_cs or 0))
-    if (factura.moneda or "CS") == "USD":
-        factura.estado_cobranza = "PAGADA" if total_abono_usd >= due_usd else "PENDIENTE"
-    else:
-        factura.estado_cobranza = "PAGADA" if total_abono_cs >= due_cs else "PENDIENTE"
     db.commit()
 
     return JSONResponse({"ok": True, "message": "Movimiento eliminado"})
@@ -34517,10 +34974,10 @@ def sales_cobranza_abono_ticket_print(
     user: User = Depends(_require_user_web),
 ):
     _enforce_permission(request, user, "access.sales.cobranza")
-    abono = db.query(CobranzaAbono).filter(CobranzaAbono.id == abono_id).first()
+    abono = db.get(CobranzaAbono, abono_id)
     if not abono:
         raise HTTPException(status_code=404, detail="Abono no encontrado")
-    factura = db.query(VentaFactura).filter(VentaFactura.id == abono.factura_id).first()
+    factura = db.get(VentaFactura, abono.factura_id)
     if not factura:
         raise HTTPException(status_code=404, detail="Factura no encontrada")
     _, bodega = _resolve_branch_bodega(db, user)
@@ -34655,7 +35112,7 @@ async def sales_cobranza_estado(
     estado = (form.get("estado") or "PENDIENTE").upper()
     if estado not in {"PENDIENTE", "PAGADA"}:
         return JSONResponse({"ok": False, "message": "Estado invalido"}, status_code=400)
-    factura = db.query(VentaFactura).filter(VentaFactura.id == venta_id).first()
+    factura = db.get(VentaFactura, venta_id)
     if not factura:
         return JSONResponse({"ok": False, "message": "Factura no encontrada"}, status_code=404)
     _, bodega = _resolve_branch_bodega(db, user)
@@ -34682,53 +35139,61 @@ async def sales_cobranza_estado(
     return JSONResponse({"ok": True, "message": "Estado actualizado"})
 
 
-@router.post("/inventory/import")
-def inventory_import_products(
-    request: Request,
-    file: UploadFile = File(...),
-    redirect_to: Optional[str] = Form(None),
-    db: Session = Depends(get_db),
-    user: User = Depends(_require_admin_web),
-):
-    _enforce_permission(request, user, "access.inventory.productos")
-    active_company = (get_active_company_key() or "").strip().lower()
-    racing_mode = active_company == "racingmoto"
-    if not file.filename or not file.filename.lower().endswith(".xlsx"):
-        target = redirect_to or "/inventory"
-        return RedirectResponse(f"{target}?error=Archivo+Excel+(.xlsx)+requerido", status_code=303)
+def _read_import_sheet(content: bytes) -> tuple[tuple, list[tuple]]:
+    # read_only evita construir objetos Cell; se leen tuplas de valores. La
+    # dimension declarada por el archivo puede faltar o venir corta, asi que se
+    # descarta para leer la hoja completa.
+    wb = load_workbook(io.BytesIO(content), data_only=True, read_only=True)
+    try:
+        ws = wb.active
+        ws.reset_dimensions()
+        sheet_rows = ws.iter_rows(values_only=True)
+        header_values = next(sheet_rows, ())
+        data_rows = list(sheet_rows)
+    finally:
+        wb.close()
+    return header_values, data_rows
 
-    rate_today = (
-        db.query(ExchangeRate)
-        .filter(ExchangeRate.effective_date <= local_today())
-        .order_by(ExchangeRate.effective_date.desc())
-        .first()
-    )
-    if not rate_today:
-        target = redirect_to or "/inventory"
-        return RedirectResponse(f"{target}?error=Tasa+de+cambio+no+configurada", status_code=303)
 
-    content = file.file.read()
-    if not content:
-        target = redirect_to or "/inventory"
-        return RedirectResponse(f"{target}?error=Archivo+vacio", status_code=303)
+# Alias aceptados para las columnas obligatorias de la importacion.
+_IMPORT_CODIGO_COLUMNS = ("codigo", "cod_producto", "cod")
+_IMPORT_DESC_COLUMNS = ("descripcion", "descripci\u00f3n", "nombre")
+
+
+def _import_has_required_columns(header_values) -> bool:
+    names = {str(value).strip().lower() for value in header_values if value is not None}
+    return bool(names & set(_IMPORT_CODIGO_COLUMNS)) and bool(names & set(_IMPORT_DESC_COLUMNS))
+
+
+def _import_cell(row: tuple, idx: Optional[int]):
+    # Sin dimension declarada las filas llegan recortadas (o vacias).
+    if idx is None or idx >= len(row):
+        return None
+    return row[idx]
+
+
+def _run_inventory_import(db: Session, content: bytes, tasa: Decimal, racing_mode: bool) -> str:
+    zero = Decimal("0")
 
     def to_decimal(value) -> Decimal:
+        # Se llama por cada celda numerica: primero los tipos que entrega openpyxl.
         if value is None:
-            return Decimal("0")
-        if isinstance(value, (int, float, Decimal)):
+            return zero
+        value_type = type(value)
+        if value_type is Decimal:
+            return value
+        if value_type is int or value_type is float:
             return Decimal(str(value))
         cleaned = str(value).strip().replace(",", "")
         if not cleaned:
-            return Decimal("0")
+            return zero
         try:
             return Decimal(cleaned)
         except Exception:
-            return Decimal("0")
+            return zero
 
-    tasa = Decimal(str(rate_today.rate))
-    wb = load_workbook(io.BytesIO(content), data_only=True)
-    ws = wb.active
-    header_row = [str(cell.value).strip() if cell.value is not None else "" for cell in ws[1]]
+    header_values, data_rows = _read_import_sheet(content)
+    header_row = [str(value).strip() if value is not None else "" for value in header_values]
     header_map = {name.lower(): idx for idx, name in enumerate(header_row)}
 
     def col_idx(*names: str) -> Optional[int]:
@@ -34738,8 +35203,8 @@ def inventory_import_products(
                 return idx
         return None
 
-    idx_codigo = col_idx("codigo", "cod_producto", "cod")
-    idx_desc = col_idx("descripcion", "descripci\u00f3n", "nombre")
+    idx_codigo = col_idx(*_IMPORT_CODIGO_COLUMNS)
+    idx_desc = col_idx(*_IMPORT_DESC_COLUMNS)
     idx_linea = col_idx("linea")
     idx_segmento = col_idx("segmento")
     idx_costo_usd = col_idx("costo_usd", "costo_producto_usd", "costo")
@@ -34749,24 +35214,30 @@ def inventory_import_products(
     idx_saldo_esteli = None if racing_mode else col_idx("saldo_esteli", "existencia_esteli")
 
     if idx_codigo is None or idx_desc is None:
-        target = redirect_to or "/inventory"
-        return RedirectResponse(f"{target}?error=Columnas+requeridas:+codigo+y+descripcion", status_code=303)
+        raise ValueError("Columnas requeridas: codigo y descripcion")
 
-    bodegas = _scoped_bodegas_query(db).all()
-    bodega_central = next(
-        (b for b in bodegas if (b.code or "").lower() == "central"),
-        None,
+    # Solo se cargan las bodegas candidatas (por codigo o, como respaldo, por nombre).
+    target_keys = ["central"] if racing_mode else ["central", "esteli"]
+    candidate_bodegas = (
+        _scoped_bodegas_query(db)
+        .filter(
+            or_(
+                func.lower(Bodega.code).in_(target_keys),
+                *(Bodega.name.ilike(f"%{key}%") for key in target_keys),
+            )
+        )
+        .all()
     )
-    if not bodega_central:
-        bodega_central = next((b for b in bodegas if "central" in (b.name or "").lower()), None)
-    bodega_esteli = None
-    if not racing_mode:
-        bodega_esteli = next(
-            (b for b in bodegas if (b.code or "").lower() == "esteli"),
+    bodegas_by_code = {(b.code or "").lower(): b for b in candidate_bodegas}
+
+    def find_bodega(key: str) -> Optional[Bodega]:
+        return bodegas_by_code.get(key) or next(
+            (b for b in candidate_bodegas if key in (b.name or "").lower()),
             None,
         )
-        if not bodega_esteli:
-            bodega_esteli = next((b for b in bodegas if "esteli" in (b.name or "").lower()), None)
+
+    bodega_central = find_bodega("central")
+    bodega_esteli = None if racing_mode else find_bodega("esteli")
 
     ingreso_tipo = (
         db.query(IngresoTipo)
@@ -34789,54 +35260,80 @@ def inventory_import_products(
     created_count = 0
     updated_count = 0
 
-    for row in ws.iter_rows(min_row=2, values_only=True):
+    def cell_text(row, idx: Optional[int]) -> str:
+        value = _import_cell(row, idx)
+        return str(value).strip() if value is not None else ""
+
+    # Precarga en lote de productos, lineas, segmentos y saldos del archivo.
+    codigos = {cell_text(row, idx_codigo) for row in data_rows} - {""}
+    linea_names = {cell_text(row, idx_linea).lower() for row in data_rows} - {""}
+    segmento_names = {cell_text(row, idx_segmento).lower() for row in data_rows} - {""}
+    productos_by_cod = {
+        p.cod_producto: p
+        for p in db.query(Producto).filter(Producto.cod_producto.in_(codigos)).all()
+    } if codigos else {}
+    lineas_by_name = {
+        l.linea.lower(): l
+        for l in db.query(Linea)
+        .filter(func.lower(Linea.linea).in_(linea_names))
+        .order_by(Linea.id.desc())
+        .all()
+    } if linea_names else {}
+    segmentos_by_name = {
+        seg.segmento.lower(): seg
+        for seg in db.query(Segmento)
+        .filter(func.lower(Segmento.segmento).in_(segmento_names))
+        .order_by(Segmento.id.desc())
+        .all()
+    } if segmento_names else {}
+    existing_producto_ids = [p.id for p in productos_by_cod.values()]
+    saldos_by_producto = {
+        saldo.producto_id: saldo
+        for saldo in db.query(SaldoProducto).filter(SaldoProducto.producto_id.in_(existing_producto_ids)).all()
+    } if existing_producto_ids else {}
+    productos_sin_saldo: list[Producto] = []
+    productos_sin_saldo_ids: set[int] = set()
+
+    for row in data_rows:
         total_rows += 1
-        cod = str(row[idx_codigo]).strip() if row[idx_codigo] is not None else ""
-        descripcion = str(row[idx_desc]).strip() if row[idx_desc] is not None else ""
+        cod = cell_text(row, idx_codigo)
+        descripcion = cell_text(row, idx_desc)
         if not cod or not descripcion:
             skipped_rows += 1
             continue
 
         linea = None
         segmento = None
-        linea_name = str(row[idx_linea]).strip() if idx_linea is not None and row[idx_linea] is not None else ""
-        segmento_name = str(row[idx_segmento]).strip() if idx_segmento is not None and row[idx_segmento] is not None else ""
+        linea_name = cell_text(row, idx_linea)
+        segmento_name = cell_text(row, idx_segmento)
         if linea_name:
-            linea = (
-                db.query(Linea)
-                .filter(func.lower(Linea.linea) == linea_name.lower())
-                .first()
-            )
+            linea = lineas_by_name.get(linea_name.lower())
             if not linea:
                 linea = Linea(cod_linea=linea_name[:50], linea=linea_name, activo=True)
                 db.add(linea)
-                db.flush()
+                lineas_by_name[linea_name.lower()] = linea
         if segmento_name:
-            segmento = (
-                db.query(Segmento)
-                .filter(func.lower(Segmento.segmento) == segmento_name.lower())
-                .first()
-            )
+            segmento = segmentos_by_name.get(segmento_name.lower())
             if not segmento:
                 segmento = Segmento(segmento=segmento_name)
                 db.add(segmento)
-                db.flush()
+                segmentos_by_name[segmento_name.lower()] = segmento
 
-        costo_usd = to_decimal(row[idx_costo_usd]) if idx_costo_usd is not None else Decimal("0")
-        precio_usd = to_decimal(row[idx_precio_usd]) if idx_precio_usd is not None else Decimal("0")
-        precio_cs = to_decimal(row[idx_precio_cs]) if idx_precio_cs is not None else Decimal("0")
+        costo_usd = to_decimal(_import_cell(row, idx_costo_usd))
+        precio_usd = to_decimal(_import_cell(row, idx_precio_usd))
+        precio_cs = to_decimal(_import_cell(row, idx_precio_cs))
         if precio_usd == 0 and precio_cs > 0:
             precio_usd = (precio_cs / tasa) if tasa else Decimal("0")
         if precio_cs == 0 and precio_usd > 0:
             precio_cs = precio_usd * tasa
 
-        producto = db.query(Producto).filter(Producto.cod_producto == cod).first()
+        producto = productos_by_cod.get(cod)
         if not producto:
             producto = Producto(
                 cod_producto=cod,
                 descripcion=descripcion,
-                linea_id=linea.id if linea else None,
-                segmento_id=segmento.id if segmento else None,
+                linea=linea,
+                segmento=segmento,
                 precio_venta1=precio_cs,
                 precio_venta2=Decimal("0"),
                 precio_venta3=Decimal("0"),
@@ -34848,14 +35345,14 @@ def inventory_import_products(
                 activo=True,
             )
             db.add(producto)
-            db.flush()
+            productos_by_cod[cod] = producto
             created_count += 1
         else:
             producto.descripcion = descripcion
             if linea:
-                producto.linea_id = linea.id
+                producto.linea = linea
             if segmento:
-                producto.segmento_id = segmento.id
+                producto.segmento = segmento
             if precio_usd > 0:
                 producto.precio_venta1_usd = precio_usd
                 producto.precio_venta1 = precio_cs
@@ -34864,8 +35361,8 @@ def inventory_import_products(
             producto.tasa_cambio = tasa
             updated_count += 1
 
-        saldo_central = to_decimal(row[idx_saldo_central]) if idx_saldo_central is not None else Decimal("0")
-        saldo_esteli = to_decimal(row[idx_saldo_esteli]) if idx_saldo_esteli is not None else Decimal("0")
+        saldo_central = to_decimal(_import_cell(row, idx_saldo_central))
+        saldo_esteli = to_decimal(_import_cell(row, idx_saldo_esteli))
 
         if bodega_central and saldo_central > 0:
             central_items.append((producto, saldo_central))
@@ -34874,11 +35371,32 @@ def inventory_import_products(
 
         # No mezclar bodegas en el saldo global: se mantiene en cero y
         # el saldo por bodega se calcula desde los movimientos.
-        saldo_row = db.query(SaldoProducto).filter(SaldoProducto.producto_id == producto.id).first()
-        if not saldo_row:
-            db.add(SaldoProducto(producto_id=producto.id, existencia=Decimal("0")))
-        else:
+        saldo_row = saldos_by_producto.get(producto.id) if producto.id else None
+        if saldo_row:
             saldo_row.existencia = Decimal("0")
+        elif id(producto) not in productos_sin_saldo_ids:
+            productos_sin_saldo_ids.add(id(producto))
+            productos_sin_saldo.append(producto)
+
+    # Un solo flush para lineas, segmentos y productos nuevos (INSERT por lote
+    # con RETURNING) en lugar de un viaje a la base por cada fila.
+    db.flush()
+    if productos_sin_saldo:
+        db.execute(
+            insert(SaldoProducto),
+            [{"producto_id": producto.id, "existencia": Decimal("0")} for producto in productos_sin_saldo],
+        )
+
+    # Costos unitarios por producto, compartidos entre los ingresos de ambas
+    # bodegas: el mismo producto suele aparecer en central y esteli.
+    unit_cost_cache: dict[int, tuple[Decimal, Decimal]] = {}
+
+    def unit_costs(producto: Producto) -> tuple[Decimal, Decimal]:
+        cached = unit_cost_cache.get(producto.id)
+        if cached is None:
+            costo_unit_usd = (producto.costo_producto or Decimal("0")) / tasa if tasa else Decimal("0")
+            cached = unit_cost_cache[producto.id] = (costo_unit_usd, costo_unit_usd * tasa)
+        return cached
 
     def create_ingreso(bodega: Bodega, items: list[tuple[Producto, Decimal]]) -> None:
         if not items:
@@ -34898,26 +35416,26 @@ def inventory_import_products(
         db.add(ingreso)
         db.flush()
         total_usd = Decimal("0")
-        total_cs = Decimal("0")
+        item_rows = []
         for producto, qty in items:
-            costo_unit_usd = Decimal(str(producto.costo_producto or 0)) / tasa if tasa else Decimal("0")
+            costo_unit_usd, costo_unit_cs = unit_costs(producto)
             subtotal_usd = costo_unit_usd * qty
-            subtotal_cs = subtotal_usd * tasa
             total_usd += subtotal_usd
-            total_cs += subtotal_cs
-            db.add(
-                IngresoItem(
-                    ingreso_id=ingreso.id,
-                    producto_id=producto.id,
-                    cantidad=qty,
-                    costo_unitario_usd=costo_unit_usd,
-                    costo_unitario_cs=costo_unit_usd * tasa,
-                    subtotal_usd=subtotal_usd,
-                    subtotal_cs=subtotal_cs,
-                )
+            item_rows.append(
+                {
+                    "ingreso_id": ingreso.id,
+                    "producto_id": producto.id,
+                    "cantidad": qty,
+                    "costo_unitario_usd": costo_unit_usd,
+                    "costo_unitario_cs": costo_unit_cs,
+                    "subtotal_usd": subtotal_usd,
+                    "subtotal_cs": subtotal_usd * tasa,
+                }
             )
+        db.execute(insert(IngresoItem), item_rows)
         ingreso.total_usd = total_usd
-        ingreso.total_cs = total_cs
+        # El total en cordobas es el total USD a la tasa del ingreso.
+        ingreso.total_cs = total_usd * tasa
 
     if bodega_central:
         create_ingreso(bodega_central, central_items)
@@ -34925,21 +35443,152 @@ def inventory_import_products(
         create_ingreso(bodega_esteli, esteli_items)
 
     db.commit()
-    target = redirect_to or "/inventory"
-    msg = (
+    return (
         f"Importacion completa. Filas: {total_rows}. "
         f"Creados: {created_count}. Actualizados: {updated_count}. Omitidos: {skipped_rows}."
     )
-    return RedirectResponse(f"{target}?success={msg}", status_code=303)
 
 
-@router.get("/inventory/import/template")
-def inventory_import_template(
+def _inventory_import_background(*, job_id: int, content: bytes, tasa: Decimal, racing_mode: bool) -> None:
+    # Se ejecuta como tarea de fondo, despues de responder; usa su propia sesion
+    # y deja el resultado (o el error) en el registro de la importacion.
+    db = get_session_local()()
+    try:
+        job = db.get(InventoryImportJob, job_id)
+        if not job:
+            return
+        job.estado = "PROCESANDO"
+        db.commit()
+        try:
+            mensaje = _run_inventory_import(db, content, tasa, racing_mode)
+            estado = "COMPLETADO"
+        except ValueError as exc:
+            db.rollback()
+            mensaje, estado = str(exc), "ERROR"
+        except Exception as exc:
+            db.rollback()
+            mensaje, estado = f"Error al importar: {exc}", "ERROR"
+        job = db.get(InventoryImportJob, job_id)
+        job.estado = estado
+        job.mensaje = mensaje[:300]
+        job.finished_at = local_now_naive()
+        db.commit()
+    except Exception:
+        db.rollback()
+    finally:
+        db.close()
+
+
+@router.post("/inventory/import")
+def inventory_import_products(
     request: Request,
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    redirect_to: Optional[str] = Form(None),
+    db: Session = Depends(get_db),
     user: User = Depends(_require_admin_web),
 ):
     _enforce_permission(request, user, "access.inventory.productos")
     active_company = (get_active_company_key() or "").strip().lower()
+    racing_mode = active_company == "racingmoto"
+    if not file.filename or not file.filename.lower().endswith(".xlsx"):
+        target = redirect_to or "/inventory"
+        return RedirectResponse(f"{target}?error=Archivo+Excel+(.xlsx)+requerido", status_code=303)
+
+    rate_today = _latest_exchange_rate(db, request)
+    if not rate_today:
+        target = redirect_to or "/inventory"
+        return RedirectResponse(f"{target}?error=Tasa+de+cambio+no+configurada", status_code=303)
+
+    content = file.file.read()
+    if not content:
+        target = redirect_to or "/inventory"
+        return RedirectResponse(f"{target}?error=Archivo+vacio", status_code=303)
+
+    # Las columnas se validan antes de encolar para responder el error de inmediato.
+    try:
+        wb = load_workbook(io.BytesIO(content), data_only=True, read_only=True)
+        try:
+            ws = wb.active
+            ws.reset_dimensions()
+            header_values = next(ws.iter_rows(max_row=1, values_only=True), ())
+        finally:
+            wb.close()
+    except Exception:
+        return RedirectResponse(f"{target}?error=Archivo+Excel+invalido", status_code=303)
+    if not _import_has_required_columns(header_values):
+        return RedirectResponse(f"{target}?error=Columnas+requeridas:+codigo+y+descripcion", status_code=303)
+
+    # Token de idempotencia: el mismo archivo no se encola de nuevo mientras
+    # una importacion del mismo contenido siga activa. El indice unico parcial
+    # ix_inventory_import_jobs_token_active hace atomica la verificacion; las
+    # importaciones activas de mas de una hora se dan por interrumpidas.
+    token = hashlib.sha256(content).hexdigest()
+    db.execute(
+        update(InventoryImportJob)
+        .where(
+            InventoryImportJob.token == token,
+            InventoryImportJob.estado.in_(["PENDIENTE", "PROCESANDO"]),
+            InventoryImportJob.created_at < func.now() - timedelta(hours=1),
+        )
+        .values(estado="ERROR", mensaje="Importacion interrumpida", finished_at=local_now_naive())
+    )
+    job_id = db.execute(
+        pg_insert(InventoryImportJob)
+        .values(
+            token=token,
+            filename=(file.filename or "")[:255],
+            estado="PENDIENTE",
+            usuario_registro=user.full_name,
+        )
+        .on_conflict_do_nothing(
+            index_elements=[InventoryImportJob.token],
+            index_where=InventoryImportJob.estado.in_(["PENDIENTE", "PROCESANDO"]),
+        )
+        .returning(InventoryImportJob.id)
+    ).scalar()
+    db.commit()
+    if job_id is None:
+        return RedirectResponse(f"{target}?error=Este+archivo+ya+se+esta+importando", status_code=303)
+    background_tasks.add_task(
+        _inventory_import_background,
+        job_id=job_id,
+        content=content,
+        tasa=Decimal(str(rate_today.rate)),
+        racing_mode=racing_mode,
+    )
+    return RedirectResponse(
+        f"{target}?success=Importacion+en+proceso&import_job={job_id}",
+        status_code=303,
+    )
+
+
+@router.get("/inventory/import/jobs/{job_id}")
+def inventory_import_job_status(
+    request: Request,
+    job_id: int,
+    db: Session = Depends(get_db),
+    user: User = Depends(_require_admin_web),
+):
+    _enforce_permission(request, user, "access.inventory.productos")
+    job = db.get(InventoryImportJob, job_id)
+    if not job:
+        return JSONResponse({"ok": False, "message": "Importacion no encontrada"}, status_code=404)
+    return JSONResponse(
+        {
+            "ok": True,
+            "id": job.id,
+            "estado": job.estado,
+            "mensaje": job.mensaje or "",
+            "archivo": job.filename or "",
+            "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+        }
+    )
+
+
+@lru_cache(maxsize=2)
+def _inventory_template_bytes(include_esteli: bool) -> bytes:
+    # La plantilla es fija por modo de empresa: se genera una vez por proceso.
     headers = [
         "codigo",
         "descripcion",
@@ -34950,7 +35599,7 @@ def inventory_import_template(
         "precio_cs",
         "saldo_central",
     ]
-    if active_company != "racingmoto":
+    if include_esteli:
         headers.append("saldo_esteli")
     wb = Workbook()
     ws = wb.active
@@ -34961,14 +35610,26 @@ def inventory_import_template(
         cell.alignment = Alignment(horizontal="center")
     stream = io.BytesIO()
     wb.save(stream)
-    stream.seek(0)
-    return StreamingResponse(
-        stream,
+    return stream.getvalue()
+
+
+@router.get("/inventory/import/template")
+def inventory_import_template(
+    request: Request,
+    user: User = Depends(_require_admin_web),
+):
+    _enforce_permission(request, user, "access.inventory.productos")
+    active_company = (get_active_company_key() or "").strip().lower()
+    return Response(
+        content=_inventory_template_bytes(active_company != "racingmoto"),
         media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         headers={"Content-Disposition": "attachment; filename=productos_template.xlsx"},
     )
 
 
+_IMPORT_PREVIEW_MAX_ROWS = 500
+
+
 @router.post("/inventory/import/preview")
 def inventory_import_preview(
     request: Request,
@@ -34985,51 +35646,64 @@ def inventory_import_preview(
         return HTMLResponse(
             "<div class='alert alert-warning py-2 px-3'>Archivo vacio.</div>"
         )
-    wb = load_workbook(io.BytesIO(content), data_only=True)
-    ws = wb.active
-    headers = [str(cell.value).strip() if cell.value is not None else "" for cell in ws[1]]
+    wb = load_workbook(io.BytesIO(content), data_only=True, read_only=True)
     rows = []
     total_rows = 0
     skipped_rows = 0
-    idx_codigo = None
-    idx_desc = None
-    for row in ws.iter_rows(min_row=2, values_only=True):
-        if not row:
-            continue
-        total_rows += 1
-        rows.append([cell if cell is not None else "" for cell in row])
-    if headers:
+    try:
+        ws = wb.active
+        ws.reset_dimensions()
+        sheet_rows = ws.iter_rows(values_only=True)
+        headers = [str(value).strip() if value is not None else "" for value in next(sheet_rows, ())]
         header_map = {name.lower(): idx for idx, name in enumerate(headers)}
         idx_codigo = header_map.get("codigo")
         idx_desc = header_map.get("descripcion")
-    if idx_codigo is not None or idx_desc is not None:
-        for row in rows:
-            cod = str(row[idx_codigo]).strip() if idx_codigo is not None and row[idx_codigo] is not None else ""
-            desc = str(row[idx_desc]).strip() if idx_desc is not None and row[idx_desc] is not None else ""
-            if not cod or not desc:
-                skipped_rows += 1
+        check_required = idx_codigo is not None or idx_desc is not None
+        for row in sheet_rows:
+            if not row:
+                continue
+            total_rows += 1
+            if check_required:
+                cod_value = _import_cell(row, idx_codigo)
+                cod = str(cod_value).strip() if cod_value is not None else ""
+                desc_value = _import_cell(row, idx_desc)
+                desc = str(desc_value).strip() if desc_value is not None else ""
+                if not cod or not desc:
+                    skipped_rows += 1
+            # Solo se envian al navegador las primeras filas; el conteo cubre todo el archivo
+            if len(rows) < _IMPORT_PREVIEW_MAX_ROWS:
+                rows.append(row)
+    finally:
+        wb.close()
     if not headers:
         return HTMLResponse(
             "<div class='alert alert-warning py-2 px-3'>No se detectaron columnas.</div>"
         )
-    table = [
-        "<div class='mt-3'>",
-        "<div class='fw-semibold mb-2'>Vista previa (todas las filas)</div>",
-        f"<div class='small text-muted mb-2'>Filas detectadas: {total_rows}. Omitidas por codigo/descripcion vacios: {skipped_rows}.</div>",
-        "<div class='table-responsive'>",
-        "<table class='table table-sm table-striped align-middle'>",
-        "<thead><tr>",
-    ]
-    for h in headers:
-        table.append(f"<th class='text-nowrap'>{h}</th>")
-    table.append("</tr></thead><tbody>")
-    for row in rows:
-        table.append("<tr>")
-        for cell in row:
-            table.append(f"<td class='text-nowrap'>{cell}</td>")
-        table.append("</tr>")
-    table.append("</tbody></table></div></div>")
-    return HTMLResponse("".join(table))
+    escape = html_lib.escape
+    header_html = "".join(f"<th class='text-nowrap'>{escape(h)}</th>" for h in headers)
+    body_html = "".join(
+        "<tr>"
+        + "".join(
+            f"<td class='text-nowrap'>{escape(str(cell)) if cell is not None else ''}</td>"
+            # Las filas en modo read_only terminan en la ultima celda con dato.
+            for cell in chain(row, repeat(None, len(headers) - len(row)))
+        )
+        + "</tr>"
+        for row in rows
+    )
+    preview_label = (
+        "todas las filas"
+        if total_rows <= _IMPORT_PREVIEW_MAX_ROWS
+        else f"primeras {_IMPORT_PREVIEW_MAX_ROWS} filas"
+    )
+    return HTMLResponse(
+        "<div class='mt-3'>"
+        f"<div class='fw-semibold mb-2'>Vista previa ({preview_label})</div>"
+        f"<div class='small text-muted mb-2'>Filas detectadas: {total_rows}. Omitidas por codigo/descripcion vacios: {skipped_rows}.</div>"
+        "<div class='table-responsive'>"
+        "<table class='table table-sm table-striped align-middle'>"
+        f"<thead><tr>{header_html}</tr></thead><tbody>{body_html}</tbody></table></div></div>"
+    )
 
 
 @router.post("/inventory/import/reset")
@@ -35049,13 +35723,14 @@ def inventory_import_reset(
             status_code=303,
         )
 
-    db.query(IngresoItem).delete()
-    db.query(IngresoInventario).delete()
-    db.query(EgresoItem).delete()
-    db.query(EgresoInventario).delete()
-    db.query(SaldoProducto).delete()
-    db.query(ProductoCombo).delete()
-    db.query(Producto).delete()
+    # DELETE masivo sin sincronizar el identity map; la sesion se descarta al commit.
+    db.query(IngresoItem).delete(synchronize_session=False)
+    db.query(IngresoInventario).delete(synchronize_session=False)
+    db.query(EgresoItem).delete(synchronize_session=False)
+    db.query(EgresoInventario).delete(synchronize_session=False)
+    db.query(SaldoProducto).delete(synchronize_session=False)
+    db.query(ProductoCombo).delete(synchronize_session=False)
+    db.query(Producto).delete(synchronize_session=False)
     db.commit()
 
     target = redirect_to or "/inventory"
@@ -35097,14 +35772,14 @@ def finance_rates_create(
     _enforce_permission(request, user, "access.finance.rates")
     if rate <= 0:
         return RedirectResponse("/finance/rates?error=Tasa+no+valida", status_code=303)
-    exists = (
+    exists = db.query(
         db.query(ExchangeRate)
         .filter(
             ExchangeRate.effective_date == effective_date,
             ExchangeRate.period == period,
         )
-        .first()
-    )
+        .exists()
+    ).scalar()
     if not exists:
         db.add(ExchangeRate(effective_date=effective_date, period=period, rate=rate))
         db.commit()
@@ -35125,18 +35800,18 @@ def finance_rates_update(
     _enforce_permission(request, user, "access.finance.rates")
     if rate <= 0:
         return RedirectResponse("/finance/rates?error=Tasa+no+valida", status_code=303)
-    row = db.query(ExchangeRate).filter(ExchangeRate.id == rate_id).first()
+    row = db.get(ExchangeRate, rate_id)
     if not row:
         return RedirectResponse("/finance/rates?error=Registro+no+encontrado", status_code=303)
-    exists = (
+    exists = db.query(
         db.query(ExchangeRate)
         .filter(
             ExchangeRate.effective_date == effective_date,
             ExchangeRate.period == period,
             ExchangeRate.id != rate_id,
         )
-        .first()
-    )
+        .exists()
+    ).scalar()
     if exists:
         return RedirectResponse("/finance/rates?error=Ya+existe+otra+tasa+con+esa+fecha+y+periodo", status_code=303)
     row.effective_date = effective_date
@@ -35154,7 +35829,7 @@ def finance_rates_delete(
     user: User = Depends(_require_admin_web),
 ):
     _enforce_permission(request, user, "access.finance.rates")
-    row = db.query(ExchangeRate).filter(ExchangeRate.id == rate_id).first()
+    row = db.get(ExchangeRate, rate_id)
     if not row:
         return RedirectResponse("/finance/rates?error=Registro+no+encontrado", status_code=303)
     db.delete(row)
@@ -35170,7 +35845,7 @@ def inventory_deactivate_product(
     user: User = Depends(_require_admin_web),
 ):
     _enforce_permission(request, user, "access.inventory.productos")
-    producto = db.query(Producto).filter(Producto.id == product_id).first()
+    producto = db.get(Producto, product_id)
     if producto:
         existencia = float(producto.saldo.existencia) if producto.saldo else 0
         if existencia <= 0:
@@ -35189,7 +35864,7 @@ def inventory_activate_product(
     user: User = Depends(_require_admin_web),
 ):
     _enforce_permission(request, user, "access.inventory.productos")
-    producto = db.query(Producto).filter(Producto.id == product_id).first()
+    producto = db.get(Producto, product_id)
     if producto:
         producto.activo = True
         db.commit()